@@ -0,0 +1,90 @@
+"""
+Time the construction, start and stop of service containers, with the
+introspection of the service class cached (warm) and not (cold).
+
+Usage::
+
+    python benchmarks/bench_containers.py [iterations]
+"""
+from __future__ import print_function
+import sys
+
+import eventlet
+eventlet.monkey_patch()  # noqa (code before rest of imports)
+
+import timeit
+
+from nameko.containers import ServiceContainer, WorkerContext
+from nameko.cron import cron
+from nameko.dependencies import introspected_classes
+from nameko.events import event_dispatcher
+from nameko.messaging import publisher
+from nameko.parallel import parallel_provider
+from nameko.timer import timer
+
+
+class Service(object):
+
+    dispatch = event_dispatcher()
+    publish = publisher()
+    parallel = parallel_provider()
+
+    @timer(interval=3600)
+    def hourly(self):
+        pass
+
+    @timer(interval=60)
+    def minutely(self):
+        pass
+
+    @cron('0 0 * * *')
+    def nightly(self):
+        pass
+
+    def helper(self):
+        pass
+
+
+CONFIG = {'AMQP_URI': 'memory://'}
+
+
+def construct():
+    return ServiceContainer(Service, WorkerContext, CONFIG)
+
+
+def start_and_stop():
+    container = construct()
+    container.start()
+    container.stop()
+
+
+def cold(benchmark):
+    def run():
+        introspected_classes.clear()
+        benchmark()
+    return run
+
+
+BENCHMARKS = [
+    ('construct', construct),
+    ('start+stop', start_and_stop),
+]
+
+
+def main(iterations):
+    print('{:<12}{:>12}{:>12}{:>10}'.format(
+        'benchmark', 'cold (us)', 'warm (us)', 'speedup'))
+
+    for name, benchmark in BENCHMARKS:
+        timings = []
+        for run in (cold(benchmark), benchmark):
+            seconds = min(timeit.repeat(run, number=iterations, repeat=3))
+            timings.append(seconds / iterations * 1e6)
+
+        cold_time, warm_time = timings
+        print('{:<12}{:>12.1f}{:>12.1f}{:>9.1f}x'.format(
+            name, cold_time, warm_time, cold_time / warm_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
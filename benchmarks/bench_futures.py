@@ -0,0 +1,61 @@
+"""
+Compare the cost of nameko's GreenFuture with concurrent.futures.Future,
+under eventlet's monkey patching as when running services.
+
+Usage::
+
+    python benchmarks/bench_futures.py [iterations]
+"""
+from __future__ import print_function
+import sys
+
+import eventlet
+eventlet.monkey_patch()  # noqa (code before rest of imports)
+
+from concurrent.futures import Future
+import timeit
+
+from nameko.futures import GreenFuture
+
+
+def resolved(future_cls):
+    future = future_cls()
+    future.set_running_or_notify_cancel()
+    future.set_result(None)
+    return future.result()
+
+
+def callback(future_cls):
+    future = future_cls()
+    future.add_done_callback(lambda future: None)
+    future.set_result(None)
+
+
+def waited(future_cls):
+    # the result is set by another greenthread while this one waits
+    future = future_cls()
+    eventlet.spawn_n(future.set_result, None)
+    return future.result()
+
+
+BENCHMARKS = [resolved, callback, waited]
+
+
+def main(iterations):
+    print('{:<12}{:>16}{:>18}{:>10}'.format(
+        'benchmark', 'Future (us)', 'GreenFuture (us)', 'speedup'))
+
+    for benchmark in BENCHMARKS:
+        timings = []
+        for future_cls in (Future, GreenFuture):
+            seconds = min(timeit.repeat(
+                lambda: benchmark(future_cls), number=iterations, repeat=3))
+            timings.append(seconds / iterations * 1e6)
+
+        threaded, green = timings
+        print('{:<12}{:>16.2f}{:>18.2f}{:>9.1f}x'.format(
+            benchmark.__name__, threaded, green, threaded / green))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,222 @@
+"""
+Windowed aggregation of events.
+
+A :func:`window_handler` accumulates the events it receives into time
+windows and calls the service method once per window with the aggregated
+:class:`Window`, e.g. to count events per minute::
+
+    def count(total, data):
+        return total + 1
+
+    class Stats(object):
+
+        @window_handler('shop', 'order_placed', size=60,
+                        aggregate=count, initial=int)
+        def orders_per_minute(self, window):
+            ...
+
+Windows are *tumbling* by default: each event belongs to exactly one window
+and windows don't overlap. Given a ``slide`` shorter than the ``size``,
+windows are *sliding*: a new window opens every ``slide`` seconds and each
+event belongs to every window open when it is received.
+
+Events are only acknowledged once every window they belong to has been
+handled, so events received by a service that dies before its windows close
+are delivered again. Delivery is at-least-once; an event redelivered after
+some of its windows were handled is aggregated again.
+"""
+from __future__ import absolute_import
+from functools import partial
+from logging import getLogger
+import math
+import time
+
+import eventlet
+from eventlet.event import Event
+
+from nameko.dependencies import entrypoint, DependencyFactory
+from nameko.events import (
+    EventHandler, EventHandlerConfigurationError, get_event_type,
+    SERVICE_POOL, BROADCAST, PARTITIONED)
+from nameko.messaging import queue_consumer
+
+_log = getLogger(__name__)
+
+
+DEFAULT_MAX_PENDING = 10000
+
+
+def append(events, data):
+    events.append(data)
+    return events
+
+
+class Window(object):
+    """ The events received between ``start`` and ``end``, aggregated into
+    ``value``.
+    """
+    def __init__(self, start, end, value):
+        self.start = start
+        self.end = end
+        self.value = value
+        self.count = 0
+        self._messages = []
+
+    def __repr__(self):
+        return '<Window {}-{}: {} event(s)>'.format(
+            self.start, self.end, self.count)
+
+
+class WindowedEventHandler(EventHandler):
+
+    local_fanout = False
+
+    # a queue consumer of its own, so that its channel's prefetch limit of
+    # ``max_pending`` doesn't apply to the container's other consumers
+    queue_consumer = queue_consumer()
+
+    def __init__(self, service_name, event_type, handler_type,
+                 reliable_delivery, requeue_on_error, size, slide,
+                 aggregate, initial, max_pending):
+
+        self.size = size
+        self.slide = slide or size
+        self.aggregate = aggregate
+        self.initial = initial
+        self.prefetch_count = max_pending
+        self._windows = {}
+        self._timers = {}
+        self._holds = {}
+
+        super(WindowedEventHandler, self).__init__(
+            service_name, event_type, handler_type, reliable_delivery,
+            requeue_on_error)
+
+    def stop(self):
+        super(WindowedEventHandler, self).stop()
+
+        # don't wait for open windows to close
+        for start in sorted(self._timers):
+            timer, closing = self._timers[start]
+            closing.send()
+            timer.wait()
+
+    def kill(self, exc=None):
+        timers, self._timers = self._timers.values(), {}
+        self._windows.clear()
+        self._holds.clear()
+        for _, closing in timers:
+            closing.send()
+        super(WindowedEventHandler, self).kill(exc)
+
+    def window_starts(self, now):
+        """ Return the start times of the windows open at ``now``.
+        """
+        last = math.floor(now / self.slide) * self.slide
+        starts = []
+        start = last
+        while start > now - self.size:
+            starts.append(start)
+            start -= self.slide
+        return starts
+
+    def spawn_worker(self, message, args, kwargs, context_data):
+        data, = args
+        starts = self.window_starts(time.time())
+
+        # the message is acked once all its windows have been handled
+        self._holds[message] = [len(starts), None]
+
+        for start in starts:
+            window = self._windows.get(start)
+            if window is None:
+                window = Window(start, start + self.size, self.initial())
+                self._windows[start] = window
+                closing = Event()
+                timer = self.container.spawn_managed_thread(
+                    partial(self._close_after_window, start, window.end,
+                            closing))
+                self._timers[start] = (timer, closing)
+
+            window.value = self.aggregate(window.value, data)
+            window.count += 1
+            window._messages.append(message)
+
+    def _close_after_window(self, start, end, closing):
+        with eventlet.Timeout(max(0, end - time.time()), False):
+            closing.wait()
+
+        # the window is discarded if the entrypoint was killed
+        if start in self._windows:
+            self.close_window(start)
+
+    def close_window(self, start):
+        """ Spawn a worker to handle the window starting at ``start``.
+
+        Windows are closed by their timers when they end, or early once the
+        timer's ``closing`` event is sent when the entrypoint stops.
+        """
+        window = self._windows.pop(start)
+        del self._timers[start]
+
+        _log.debug('closing %s', window)
+        self.container.spawn_worker(
+            self, (window,), {},
+            handle_result=partial(self.handle_window_result, window))
+
+    def handle_window_result(self, window, worker_ctx, result=None,
+                             exc=None):
+        for message in window._messages:
+            hold = self._holds[message]
+            hold[0] -= 1
+            if exc is not None:
+                hold[1] = exc
+            if hold[0] == 0:
+                del self._holds[message]
+                self.handle_message_processed(message, result, hold[1])
+
+
+@entrypoint
+def window_handler(service_name, event_type, size, slide=None,
+                   aggregate=append, initial=list, handler_type=SERVICE_POOL,
+                   reliable_delivery=True, requeue_on_error=False,
+                   max_pending=DEFAULT_MAX_PENDING):
+    """ Decorate a method as a handler of windows of ``event_type`` events
+    on the service called ``service_name``.
+
+    Windows last ``size`` seconds, and a new one opens every ``slide``
+    seconds (every ``size`` seconds by default). Windows are aligned to
+    multiples of ``slide`` since the epoch.
+
+    Each window's value starts as ``initial()``; as each event is received,
+    the value becomes ``aggregate(value, payload)``. By default the value
+    is the list of payloads. When a window closes, the decorated method is
+    called with the :class:`Window`.
+
+    ``handler_type``, ``reliable_delivery`` and ``requeue_on_error`` are as
+    for :func:`~nameko.events.event_handler`; if a window's worker fails and
+    ``requeue_on_error`` is set, its events are requeued.
+
+    Events are held unacknowledged until their windows are handled, so up
+    to ``max_pending`` messages may be prefetched from the broker. Each
+    window handler consumes on a connection of its own, so this limit
+    doesn't apply to the container's other consumers.
+    """
+    if reliable_delivery and handler_type is BROADCAST:
+        raise EventHandlerConfigurationError(
+            "Broadcast event handlers cannot be configured with reliable "
+            "delivery.")
+
+    if handler_type is PARTITIONED:
+        raise EventHandlerConfigurationError(
+            "Window handlers cannot be partitioned.")
+
+    if slide is not None and not 0 < slide <= size:
+        raise EventHandlerConfigurationError(
+            "A window's slide must be positive and no longer than its size.")
+
+    event_type = get_event_type(event_type)
+
+    return DependencyFactory(WindowedEventHandler, service_name, event_type,
+                             handler_type, reliable_delivery, requeue_on_error,
+                             size, slide, aggregate, initial, max_pending)
@@ -0,0 +1,162 @@
+"""
+In-process caches.
+
+:class:`LruCache` is a size-bounded least-recently-used cache with optional
+expiry. Caches that should be shared by every container in the process are
+created and looked up by name with :func:`shared_cache`.
+"""
+from __future__ import absolute_import
+from collections import OrderedDict
+import json
+import time
+
+from nameko.utils import SingleFlight
+
+
+DEFAULT_MAX_SIZE = 1000
+
+# returned by :meth:`LruCache.get` for missing or expired keys
+MISSING = type('missing', (), {})()
+
+_shared_caches = {}
+
+
+class LruCache(object):
+    """ A least-recently-used cache of at most ``max_size`` entries.
+
+    If ``ttl`` is given, entries expire ``ttl`` seconds after they were set.
+    Expired entries are dropped when they are next looked up, or evicted
+    when they become the least recently used.
+
+    If ``max_bytes`` is given, the cache also evicts entries to keep the sum
+    of ``sizeof(value)`` for all values within ``max_bytes``. Values larger
+    than ``max_bytes`` are not cached at all. Caches of arbitrary values
+    should measure them with :func:`json_size`.
+
+    Concurrent loads of a missing key can be coalesced through the cache's
+    :attr:`single_flight`.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=None, max_bytes=None,
+                 sizeof=len):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.single_flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=MISSING):
+        """ Return the value for ``key``, or ``default`` if the key is missing
+        or has expired.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            expires_at, value, size = entry
+            if expires_at is None or expires_at > time.time():
+                # re-insert to mark as most recently used
+                self._entries[key] = entry
+                self.hits += 1
+                return value
+            self.bytes -= size
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        """ Set the value for ``key``, returning the number of entries
+        evicted to make space for it.
+        """
+        self.invalidate(key)
+
+        size = 0
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+            if size > self.max_bytes:
+                return 0
+
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        self._entries[key] = (expires_at, value, size)
+        self.bytes += size
+
+        evicted = 0
+        while (len(self._entries) > self.max_size or
+               self.max_bytes is not None and self.bytes > self.max_bytes):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def invalidate(self, key):
+        """ Remove ``key`` from the cache, if present.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        """ Remove all entries from the cache.
+        """
+        self._entries.clear()
+        self.bytes = 0
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def json_size(value):
+    """ Return the length of ``value`` serialized as JSON, or 0 if it
+    cannot be serialized.
+    """
+    try:
+        return len(json.dumps(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def shared_cache(name, **options):
+    """ Return the process-wide :class:`LruCache` called ``name``, creating it
+    with ``options`` if it doesn't exist yet.
+
+    Raises ``ValueError`` if the cache exists with different options.
+    """
+    entry = _shared_caches.get(name)
+    if entry is None:
+        entry = _shared_caches[name] = (LruCache(**options), options)
+
+    cache, created_with = entry
+    if options != created_with:
+        raise ValueError(
+            'shared cache {!r} exists with options {!r}, not {!r}'.format(
+                name, created_with, options))
+    return cache
+
+
+def get_shared_cache(name):
+    """ Return the process-wide :class:`LruCache` called ``name``, or None if
+    it hasn't been created.
+    """
+    entry = _shared_caches.get(name)
+    if entry is not None:
+        return entry[0]
+
+
+def reset():
+    """ Forget all process-wide caches.
+    """
+    _shared_caches.clear()
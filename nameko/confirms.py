@@ -0,0 +1,308 @@
+"""
+Pipelined publisher confirms.
+
+With confirms enabled, the broker acknowledges every message it has taken
+responsibility for. Waiting for each acknowledgement in turn costs a round
+trip per message, so a :class:`Confirmer` instead publishes on a dedicated
+channel, keeps a window of unconfirmed messages and resolves them as the
+broker's acknowledgements arrive. Messages the broker rejects are published
+again. If the connection is lost, the messages awaiting confirmation fail,
+and a new connection is opened.
+
+Callers that need to know a message is safe wait on the
+:class:`PendingConfirm` returned by :meth:`Confirmer.publish`.
+"""
+from __future__ import absolute_import
+from collections import OrderedDict
+from logging import getLogger
+import socket
+import time
+
+import eventlet
+from eventlet import Timeout
+from eventlet.event import Event
+from eventlet.queue import LightQueue
+from eventlet.semaphore import Semaphore
+from kombu import Connection, Producer
+
+from nameko.exceptions import PublishNotConfirmed
+
+_log = getLogger(__name__)
+
+
+DEFAULT_CONFIRM_WINDOW = 100
+DEFAULT_MAX_REPUBLISH = 3
+
+# how long each wait for acknowledgements blocks the connection
+DRAIN_TIMEOUT = 1
+
+# how long to wait between attempts to open a lost connection again
+RECONNECT_INTERVAL = 1
+
+
+class PendingConfirm(object):
+    """ A message waiting to be confirmed by the broker.
+    """
+    def __init__(self, body, kwargs):
+        self.body = body
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.published_at = None
+        self._confirmed = Event()
+
+    @property
+    def confirmed(self):
+        return self._confirmed.ready()
+
+    def wait(self, timeout=None):
+        """ Wait until the broker has confirmed the message.
+
+        Raises :class:`~nameko.exceptions.PublishNotConfirmed` if the
+        message was rejected too many times, or lost when the confirmer was
+        killed, and ``eventlet.Timeout`` if it isn't confirmed within
+        ``timeout`` seconds.
+        """
+        with Timeout(timeout):
+            self._confirmed.wait()
+
+
+class Confirmer(object):
+    """ Publishes messages with confirms on a dedicated connection.
+
+    At most ``window`` messages are unconfirmed at any time; publishing
+    blocks while the window is full. Rejected messages are published again
+    up to ``max_republish`` times.
+
+    If ``metrics`` is given, confirm latencies are recorded in its
+    ``publish.confirm_latency`` histogram along with ``publish.confirmed``,
+    ``publish.republished`` and ``publish.failed`` counters.
+    """
+    def __init__(self, amqp_uri, window=DEFAULT_CONFIRM_WINDOW,
+                 max_republish=DEFAULT_MAX_REPUBLISH, metrics=None):
+        self.amqp_uri = amqp_uri
+        self.window = window
+        self.max_republish = max_republish
+        self.metrics = metrics
+
+        self._connection = None
+        self._producer = None
+        self._errors = (IOError,)
+        self._drainer = None
+        self._republisher = None
+        self._republish = LightQueue()
+        self._window = Semaphore(window)
+        self._lock = Semaphore(1)
+        self._delivery_tag = 0
+        self._unconfirmed = OrderedDict()
+        self._idle = None
+
+    def start(self, spawn):
+        """ Open the confirm channel and spawn threads with ``spawn`` to
+        receive the broker's acknowledgements and to publish rejected
+        messages again.
+        """
+        self._open()
+        self._drainer = spawn(self._drain)
+        self._republisher = spawn(self._republish_forever)
+
+    def _open(self):
+        connection = Connection(self.amqp_uri)
+        self._errors = (IOError,) + connection.connection_errors + (
+            connection.channel_errors)
+        channel = connection.channel()
+        channel.confirm_select()
+        channel.events['basic_ack'].add(self._handle_ack)
+        channel.events['basic_nack'].add(self._handle_nack)
+
+        # the broker numbers the messages published on each channel from 1
+        self._connection = connection
+        self._producer = Producer(channel)
+        self._delivery_tag = 0
+
+    def _discard(self, reason):
+        """ Fail the messages awaiting confirmation, which can't be
+        confirmed once their channel is gone, and drop the connection. A
+        new one is opened by the next publish, or by the drainer.
+
+        Must be called holding the lock.
+        """
+        unconfirmed = self._unconfirmed.values()
+        self._unconfirmed.clear()
+        if unconfirmed:
+            _log.warning('failing %s unconfirmed message(s): %s',
+                         len(unconfirmed), reason)
+        for pending in unconfirmed:
+            self._fail(pending, reason)
+
+        connection, self._connection = self._connection, None
+        self._producer = None
+        try:
+            connection.release()
+        except self._errors:
+            pass
+
+    @property
+    def outstanding(self):
+        """ The number of messages not yet confirmed or failed.
+        """
+        return len(self._unconfirmed) + self._republish.qsize()
+
+    def stop(self):
+        """ Wait for all unconfirmed messages, then close the connection.
+        """
+        if self.outstanding:
+            _log.debug('waiting for %s unconfirmed message(s)',
+                       self.outstanding)
+            self._idle = Event()
+            self._idle.wait()
+        self._close()
+
+    def kill(self):
+        """ Close the connection immediately, failing unconfirmed messages.
+        """
+        unconfirmed = self._unconfirmed.values()
+        self._unconfirmed.clear()
+        while self._republish.qsize():
+            unconfirmed.append(self._republish.get())
+        if unconfirmed:
+            _log.warning('abandoning %s unconfirmed message(s)',
+                         len(unconfirmed))
+        for pending in unconfirmed:
+            pending._confirmed.send_exception(
+                PublishNotConfirmed('confirmer killed'))
+        self._close()
+
+    def _close(self):
+        if self._drainer is not None:
+            self._drainer.kill()
+            self._drainer = None
+        if self._republisher is not None:
+            self._republisher.kill()
+            self._republisher = None
+        if self._connection is not None:
+            self._connection.release()
+            self._connection = None
+
+    def publish(self, body, **kwargs):
+        """ Publish a message, returning a :class:`PendingConfirm`.
+
+        ``kwargs`` are passed on to :meth:`kombu.Producer.publish`.
+        """
+        self._window.acquire()
+        pending = PendingConfirm(body, kwargs)
+        try:
+            self._send(pending)
+        except:
+            self._release()
+            raise
+        return pending
+
+    def _send(self, pending):
+        # the broker numbers the messages published on the channel, so
+        # publishing and assigning the tag must not interleave
+        with self._lock:
+            if self._connection is None:
+                self._open()
+
+            self._delivery_tag += 1
+            delivery_tag = self._delivery_tag
+            pending.attempts += 1
+            pending.published_at = time.time()
+
+            # record before publishing; the acknowledgement may be handled
+            # as soon as publishing yields
+            self._unconfirmed[delivery_tag] = pending
+            try:
+                self._producer.publish(pending.body, **pending.kwargs)
+            except:
+                # the broker may or may not have numbered the message, so
+                # the delivery tags of the channel can't be trusted any more
+                self._unconfirmed.pop(delivery_tag, None)
+                self._discard('an earlier publish on the channel failed')
+                raise
+
+    def _resolve(self, delivery_tag, multiple):
+        if multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        return [self._unconfirmed.pop(tag) for tag in tags
+                if tag in self._unconfirmed]
+
+    def _release(self):
+        self._window.release()
+        idle = self._idle
+        if idle is not None and not idle.ready() and not self.outstanding:
+            idle.send()
+
+    def _fail(self, pending, reason):
+        if self.metrics is not None:
+            self.metrics.increment('publish.failed')
+        pending._confirmed.send_exception(PublishNotConfirmed(reason))
+        self._release()
+
+    def _handle_ack(self, delivery_tag, multiple):
+        now = time.time()
+        for pending in self._resolve(delivery_tag, multiple):
+            if self.metrics is not None:
+                self.metrics.increment('publish.confirmed')
+                self.metrics.histogram('publish.confirm_latency').observe(
+                    now - pending.published_at)
+            pending._confirmed.send()
+            self._release()
+
+    def _handle_nack(self, delivery_tag, multiple, requeue):
+        for pending in self._resolve(delivery_tag, multiple):
+            if pending.attempts > self.max_republish:
+                _log.error('message rejected %s times, giving up',
+                           pending.attempts)
+                self._fail(pending, 'rejected {} times'.format(
+                    pending.attempts))
+            else:
+                _log.warning('message rejected, publishing again')
+                if self.metrics is not None:
+                    self.metrics.increment('publish.republished')
+                # published by another thread, rather than on the connection
+                # while it's delivering this callback; the message keeps its
+                # slot in the window
+                self._republish.put(pending)
+        return True
+
+    def _republish_forever(self):
+        while True:
+            pending = self._republish.get()
+            try:
+                self._send(pending)
+            except Exception as exc:
+                _log.exception('failed to publish rejected message again')
+                self._fail(pending, 'failed to publish again: {}'.format(exc))
+
+    def _drain(self):
+        while True:
+            connection = self._connection
+            if connection is None:
+                self._reconnect()
+                continue
+
+            try:
+                connection.drain_events(timeout=DRAIN_TIMEOUT)
+            except socket.timeout:
+                pass
+            except self._errors as exc:
+                _log.warning('lost the confirm connection: %s', exc)
+                with self._lock:
+                    # unless a publish has already replaced it
+                    if self._connection is connection:
+                        self._discard('connection lost: {}'.format(exc))
+
+    def _reconnect(self):
+        with self._lock:
+            if self._connection is not None:
+                return
+            try:
+                self._open()
+                return
+            except self._errors:
+                _log.warning('failed to open the confirm connection',
+                             exc_info=True)
+        eventlet.sleep(RECONNECT_INTERVAL)
@@ -1,27 +1,36 @@
 from __future__ import absolute_import
 
 from abc import ABCMeta, abstractproperty
+from collections import OrderedDict
 from logging import getLogger
+import time
 import uuid
+from weakref import WeakKeyDictionary
 
 import eventlet
+from eventlet import Timeout
 from eventlet.event import Event
 from eventlet.greenpool import GreenPool
 import greenlet
 
 from nameko.dependencies import (
-    prepare_dependencies, DependencySet, is_entrypoint_provider,
-    is_injection_provider)
-from nameko.exceptions import RemoteError
+    prepare_dependencies, DependencySet, discard_pending_injections)
+from nameko.exceptions import RemoteError, DeadlineExceeded
 from nameko.logging import log_time
+from nameko.metrics import ContainerMetrics
+from nameko.monitoring import (
+    BlockingMonitor, BLOCKING_BUDGET_KEY, BLOCKING_LOG_INTERVAL_KEY)
+from nameko.utils import SpawningSet
 
 WORKER_CALL_ID_STACK_KEY = 'call_id_stack'
+DEADLINE_KEY = 'deadline'
 
 _log = getLogger(__name__)
 
 
 MAX_WORKERS_KEY = 'max_workers'
 PARENT_CALLS_KEY = 'parent_calls_tracked'
+CANCEL_EXPIRED_WORKERS_KEY = 'cancel_expired_workers'
 
 DEFAULT_MAX_WORKERS = 10
 DEFAULT_PARENT_CALLS_TRACKED = 10
@@ -31,6 +40,7 @@ NAMEKO_CONTEXT_KEYS = (
     'user_id',
     'auth_token',
     WORKER_CALL_ID_STACK_KEY,
+    DEADLINE_KEY,
 )
 
 
@@ -49,6 +59,18 @@ def new_call_id():
     return str(uuid.uuid4())
 
 
+def deadline_expired(context_data):
+    """ Return True if ``context_data`` carries a deadline that has passed.
+
+    Deadlines are absolute unix timestamps, set by the original caller and
+    propagated with the rest of the context data.
+    """
+    if not context_data:
+        return False
+    deadline = context_data.get(DEADLINE_KEY)
+    return deadline is not None and deadline <= time.time()
+
+
 class WorkerContextBase(object):
     """ Abstract base class for a WorkerContext
     """
@@ -83,6 +105,13 @@ class WorkerContextBase(object):
         except IndexError:
             self.immediate_parent_call_id = None
 
+    @property
+    def deadline(self):
+        """ The time by which the caller expects this worker to have
+        completed, or None.
+        """
+        return self.data.get(DEADLINE_KEY)
+
     @abstractproperty
     def context_keys(self):
         """ Return a tuple of keys describing data kept on this WorkerContext.
@@ -143,36 +172,129 @@ class ServiceContainer(object):
 
         self.config = config
         self.max_workers = config.get(MAX_WORKERS_KEY) or DEFAULT_MAX_WORKERS
+        self.cancel_expired_workers = config.get(
+            CANCEL_EXPIRED_WORKERS_KEY, False)
 
         self.dependencies = DependencySet()
         for dep in prepare_dependencies(self):
             self.dependencies.add(dep)
 
         self.started = False
+        self.metrics = ContainerMetrics()
+        self._startup_times = OrderedDict()
+        self._startup_duration = None
         self._worker_pool = GreenPool(size=self.max_workers)
 
         self._active_threads = set()
         self._protected_threads = set()
+        # worker context (or None) of every managed thread, kept until the
+        # thread is garbage collected so that it can still be identified
+        # while it exits
+        self._thread_contexts = WeakKeyDictionary()
         self._being_killed = False
         self._died = Event()
 
+        self._blocking_monitor = None
+        blocking_budget = config.get(BLOCKING_BUDGET_KEY)
+        if blocking_budget is not None:
+            self._blocking_monitor = BlockingMonitor(
+                self, blocking_budget, config.get(BLOCKING_LOG_INTERVAL_KEY))
+
     @property
     def entrypoints(self):
-        return filter(is_entrypoint_provider, self.dependencies)
+        return list(self.dependencies.entrypoints)
 
     @property
     def injections(self):
-        return filter(is_injection_provider, self.dependencies)
+        return list(self.dependencies.injections)
+
+    @property
+    def blocking_stats(self):
+        """ Per-entrypoint statistics of greenthreads that blocked the
+        eventlet hub for longer than the configured ``blocking_budget``.
+
+        Empty unless blocking detection is enabled. See
+        :mod:`nameko.monitoring`.
+        """
+        if self._blocking_monitor is None:
+            return {}
+        return self._blocking_monitor.stats
+
+    def metrics_snapshot(self):
+        """ Return a snapshot of this container's metrics.
+
+        See :mod:`nameko.metrics`.
+        """
+        snapshot = self.metrics.snapshot()
+        snapshot['max_workers'] = self.max_workers
+        snapshot['blocking'] = self.blocking_stats
+        return snapshot
+
+    @property
+    def startup_report(self):
+        """ How long the container took to start, and how long each
+        dependency provider took to prepare and to start, in seconds.
+
+        Providers are listed in the order of :attr:`dependencies`. Empty
+        until the container has been started.
+        """
+        if self._startup_duration is None:
+            return {}
+        providers = [dict(times, provider=str(provider))
+                     for provider, times in self._startup_times.items()]
+        return {'duration': self._startup_duration, 'providers': providers}
 
     def start(self):
-        """ Start a container by starting all the dependency providers.
+        """ Start a container by preparing and then starting all the
+        dependency providers.
+
+        Providers are prepared in two stages. Entrypoints and injections are
+        prepared first, concurrently; nested dependencies, which they
+        register with or declare entities through in their ``prepare``, are
+        prepared concurrently after them. All the providers are then started
+        concurrently.
+
+        Returns the :attr:`startup_report`, saying how long each took.
         """
         _log.debug('starting %s', self)
         self.started = True
 
+        if self._blocking_monitor is not None:
+            self._blocking_monitor.start()
+
+        dependencies = self.dependencies
+        self._startup_times = OrderedDict(
+            (provider, {}) for provider in dependencies)
+        started = time.time()
+
         with log_time(_log.debug, 'started %s in %0.3f sec', self):
-            self.dependencies.all.prepare()
-            self.dependencies.all.start()
+            self._call_timed(
+                list(dependencies.entrypoints) +
+                list(dependencies.injections), 'prepare')
+            self._call_timed(dependencies.nested, 'prepare')
+            self._call_timed(dependencies, 'start')
+
+        self._startup_duration = time.time() - started
+        return self.startup_report
+
+    def _call_timed(self, providers, method):
+        """ Call ``method`` on each of ``providers`` in its own greenthread,
+        recording how long each call took.
+        """
+        if not providers:
+            return
+
+        times = self._startup_times
+
+        def call(provider):
+            started = time.time()
+            try:
+                getattr(provider, method)()
+            finally:
+                times[provider][method] = time.time() - started
+
+        pool = GreenPool(len(providers))
+        list(pool.imap(call, providers))
 
     def stop(self):
         """ Stop the container gracefully.
@@ -216,6 +338,9 @@ class ServiceContainer(object):
             # finally, stop nested dependencies
             dependencies.nested.all.stop()
 
+            if self._blocking_monitor is not None:
+                self._blocking_monitor.stop()
+
             # just in case there was a provider not taking care of its workers,
             # or a dependency not taking care of its protected threads
             self._kill_active_threads()
@@ -252,6 +377,10 @@ class ServiceContainer(object):
         self.dependencies.entrypoints.all.kill(exc)
         self._kill_active_threads()
         self.dependencies.all.kill(exc)
+
+        if self._blocking_monitor is not None:
+            self._blocking_monitor.stop()
+
         self._kill_protected_threads()
 
         self.started = False
@@ -289,8 +418,9 @@ class ServiceContainer(object):
         _log.debug('spawning %s', worker_ctx,
                    extra=worker_ctx.extra_for_logging)
         gt = self._worker_pool.spawn(self._run_worker, worker_ctx,
-                                     handle_result)
+                                     handle_result, time.time())
         self._active_threads.add(gt)
+        self._thread_contexts[gt] = worker_ctx
         gt.link(self._handle_thread_exited)
         return worker_ctx
 
@@ -313,6 +443,7 @@ class ServiceContainer(object):
         to ensure they are life-cycle managed.
         """
         gt = eventlet.spawn(run_method)
+        self._thread_contexts[gt] = None
         if not protected:
             self._active_threads.add(gt)
         else:
@@ -320,7 +451,20 @@ class ServiceContainer(object):
         gt.link(self._handle_thread_exited)
         return gt
 
-    def _run_worker(self, worker_ctx, handle_result):
+    def _run_worker(self, worker_ctx, handle_result, spawned_at=None):
+        metrics = self.metrics.entrypoint(worker_ctx.method_name)
+        if spawned_at is not None:
+            metrics.queue_wait.observe(time.time() - spawned_at)
+
+        metrics.in_flight += 1
+        try:
+            self._run_worker_lifecycle(worker_ctx, handle_result, metrics)
+        finally:
+            metrics.in_flight -= 1
+            # in case the worker was killed before it was torn down
+            discard_pending_injections(worker_ctx.service)
+
+    def _run_worker_lifecycle(self, worker_ctx, handle_result, metrics):
         _log.debug('setting up %s', worker_ctx,
                    extra=worker_ctx.extra_for_logging)
 
@@ -333,10 +477,19 @@ class ServiceContainer(object):
 
         with log_time(_log.debug, 'ran worker %s in %0.3fsec', worker_ctx):
 
-            self.dependencies.injections.all.inject(worker_ctx)
+            injections = self.dependencies.injections
+            injections.all.inject_lazily(worker_ctx)
             self.dependencies.all.worker_setup(worker_ctx)
 
             result = exc = None
+            started_at = time.time()
+
+            deadline = worker_ctx.deadline
+            timeout = None
+            if deadline is not None and self.cancel_expired_workers:
+                timeout = Timeout(
+                    max(deadline - started_at, 0),
+                    DeadlineExceeded('{} cancelled'.format(worker_ctx)))
             try:
                 _log.debug('calling handler for %s', worker_ctx,
                            extra=worker_ctx.extra_for_logging)
@@ -349,19 +502,40 @@ class ServiceContainer(object):
             except Exception as e:
                 log_worker_exception(worker_ctx, e)
                 exc = e
+            finally:
+                if timeout is not None:
+                    timeout.cancel()
+
+            finished_at = time.time()
+            if deadline is not None and finished_at > deadline:
+                _log.debug('%s outlived its deadline', worker_ctx,
+                           extra=worker_ctx.extra_for_logging)
+                self.metrics.increment('deadline.exceeded')
+            metrics.run.observe(finished_at - started_at)
+            if exc is None:
+                metrics.successes += 1
+            else:
+                metrics.errors += 1
 
             with log_time(_log.debug, 'tore down worker %s in %0.3fsec',
                           worker_ctx):
 
+                # only injections the worker accessed were acquired
+                injected = SpawningSet(
+                    provider for provider in injections
+                    if provider.is_injected(worker_ctx))
+                discard_pending_injections(worker_ctx.service)
+
                 _log.debug('signalling result for %s', worker_ctx,
                            extra=worker_ctx.extra_for_logging)
-                self.dependencies.injections.all.worker_result(
-                    worker_ctx, result, exc)
+                injected.all.worker_result(worker_ctx, result, exc)
 
                 _log.debug('tearing down %s', worker_ctx,
                            extra=worker_ctx.extra_for_logging)
                 self.dependencies.all.worker_teardown(worker_ctx)
-                self.dependencies.injections.all.release(worker_ctx)
+                injected.all.release(worker_ctx)
+
+            metrics.teardown.observe(time.time() - finished_at)
 
             if handle_result is not None:
                 _log.debug('handling result for %s', worker_ctx,
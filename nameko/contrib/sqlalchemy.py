@@ -32,8 +32,10 @@ class OrmSession(InjectionProvider):
         return session
 
     def worker_teardown(self, worker_ctx):
-        session = self.sessions.pop(worker_ctx)
-        session.close()
+        # the session is only created if the worker used it
+        session = self.sessions.pop(worker_ctx, None)
+        if session is not None:
+            session.close()
 
 
 @injection
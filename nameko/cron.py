@@ -0,0 +1,305 @@
+"""
+Cron-style scheduling of entrypoints.
+
+A :func:`cron` entrypoint fires at the times matched by a cron expression,
+e.g. at 02:30 every night::
+
+    class Reports(object):
+
+        @cron('30 2 * * *', timezone='Europe/London')
+        def nightly(self):
+            ...
+
+Expressions have five fields: minute (0-59), hour (0-23), day of the month
+(1-31), month (1-12 or ``jan``-``dec``) and day of the week (0-7, where 0
+and 7 are Sunday, or ``sun``-``sat``). Each field is ``*`` or a
+comma-separated list of values and ranges (``1-5``), optionally with a step
+(``*/15``, ``0-30/10``). As in cron, if both the day of the month and the
+day of the week are restricted, a day matching either is matched. The
+aliases ``@yearly``, ``@monthly``, ``@weekly``, ``@daily`` and ``@hourly``
+are also accepted.
+
+Cron entrypoints are fired by the same scheduler as timers (see
+:mod:`nameko.timer`); the next fire time is computed in advance, so nothing
+wakes between fires.
+"""
+from __future__ import absolute_import
+import calendar
+from datetime import datetime, timedelta, tzinfo
+from logging import getLogger
+import time
+
+from nameko.dependencies import entrypoint, DependencyFactory
+from nameko.timer import TimerProvider
+
+_log = getLogger(__name__)
+
+
+ALIASES = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+          'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+DAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+# the range of each field, and the names of its values
+FIELDS = [
+    ('minute', 0, 59, None),
+    ('hour', 0, 23, None),
+    ('day', 1, 31, None),
+    ('month', 1, 12, MONTHS),
+    ('weekday', 0, 7, DAYS),
+]
+
+# how far ahead to look for a matching time, so that expressions that never
+# match (e.g. the 30th of February) fail rather than loop forever
+MAX_SEARCH_YEARS = 8
+
+
+class CronError(Exception):
+    pass
+
+
+class UTC(tzinfo):
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+utc = UTC()
+
+
+def get_timezone(timezone):
+    """ Return the tzinfo for ``timezone``, which is a tzinfo, None for UTC,
+    or the name of a timezone, which requires pytz.
+    """
+    if timezone is None:
+        return utc
+    if isinstance(timezone, basestring):
+        try:
+            import pytz
+        except ImportError:
+            raise CronError(
+                'pytz is required for the named timezone {}'.format(timezone))
+        return pytz.timezone(timezone)
+    return timezone
+
+
+def parse_field(value, name, low, high, names):
+    def parse_value(value):
+        if names is not None and value.lower() in names:
+            return names.index(value.lower()) + low
+        try:
+            number = int(value)
+        except ValueError:
+            raise CronError('invalid {} {!r}'.format(name, value))
+        if not low <= number <= high:
+            raise CronError('{} {} is out of range'.format(name, number))
+        return number
+
+    values = set()
+    for part in value.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            try:
+                step = int(step)
+            except ValueError:
+                step = 0
+            if step < 1:
+                raise CronError('invalid step in {} {!r}'.format(name, value))
+
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = map(parse_value, part.split('-', 1))
+        else:
+            start = parse_value(part)
+            end = high if step > 1 else start
+        if start > end:
+            raise CronError('invalid range in {} {!r}'.format(name, value))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronExpression(object):
+    """ A parsed cron expression.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        fields = ALIASES.get(expression, expression).split()
+        if len(fields) != len(FIELDS):
+            raise CronError(
+                'expected {} fields in cron expression {!r}'.format(
+                    len(FIELDS), expression))
+
+        (self.minutes, self.hours, self.days, self.months,
+         weekdays) = [parse_field(value, *field)
+                      for value, field in zip(fields, FIELDS)]
+        self.weekdays = set(day % 7 for day in weekdays)
+
+        day_field, weekday_field = fields[2], fields[4]
+        self.any_day = day_field.startswith('*')
+        self.any_weekday = weekday_field.startswith('*')
+
+    def __repr__(self):
+        return '<CronExpression {!r}>'.format(self.expression)
+
+    def match_day(self, dt):
+        day = dt.day in self.days
+        # cron numbers days of the week from Sunday
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_match(self, dt):
+        """ Return the first naive datetime matching the expression that is
+        at least a minute after ``dt``, truncated to the minute.
+        """
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt.year + MAX_SEARCH_YEARS
+
+        while dt.year < limit:
+            if dt.month not in self.months:
+                year, month = divmod(dt.month, 12)
+                dt = dt.replace(year=dt.year + year, month=month + 1, day=1,
+                                hour=0, minute=0)
+            elif not self.match_day(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+
+        raise CronError('{!r} never matches'.format(self.expression))
+
+
+def localize(tz, dt):
+    """ Attach the timezone ``tz`` to the naive local time ``dt``.
+
+    Returns None if ``dt`` doesn't exist in ``tz``, e.g. when the clocks go
+    forward. Local times that occur twice are taken the first time.
+    """
+    if hasattr(tz, 'localize'):
+        # a pytz timezone
+        from pytz.exceptions import AmbiguousTimeError, NonExistentTimeError
+        try:
+            return tz.localize(dt, is_dst=None)
+        except NonExistentTimeError:
+            return None
+        except AmbiguousTimeError:
+            return tz.localize(dt, is_dst=True)
+    return dt.replace(tzinfo=tz)
+
+
+class CronSchedule(object):
+    """ The times matching a :class:`CronExpression` in a timezone.
+    """
+    def __init__(self, expression, timezone=None):
+        self.expression = CronExpression(expression)
+        self.tz = get_timezone(timezone)
+
+    def next_fire(self, after):
+        """ Return the first fire time after the timestamp ``after``.
+        """
+        local = datetime.fromtimestamp(after, self.tz).replace(tzinfo=None)
+        while True:
+            local = self.expression.next_match(local)
+            aware = localize(self.tz, local)
+            if aware is None:
+                continue
+            # local times repeated when the clocks go back are only fired
+            # the first time
+            fire_at = calendar.timegm(aware.utctimetuple())
+            if fire_at > after:
+                return fire_at
+
+
+@entrypoint
+def cron(expression=None, config_key=None, timezone=None, misfire_grace=None,
+         overlap=True, singleton=False):
+    '''
+    Decorates a method to be called at the times matched by the cron
+    `expression`, in `timezone`.
+
+    Either the `expression` or the `config_key` have to be provided or both;
+    the value for `config_key` in the config takes precedence. `timezone`
+    is a tzinfo or, if pytz is installed, the name of a timezone; times are
+    in UTC by default.
+
+    Fires are late if the process was busy or the worker pool was full. If
+    `misfire_grace` is given, fires more than `misfire_grace` seconds late
+    are skipped; otherwise late fires run as soon as possible. Fire times
+    missed entirely are coalesced into one fire.
+
+    If `overlap` is False, a fire is skipped while the previous worker is
+    still running. If `singleton` is True, only one running container of
+    the service spawns workers, as for :func:`~nameko.timer.timer`.
+
+    Example::
+
+        class Foobar(object):
+
+            @cron('0 */6 * * *', misfire_grace=60)
+            def handle_cron(self):
+                self.shrub(body)
+    '''
+    if expression is not None:
+        # fail at import time for invalid expressions
+        CronExpression(expression)
+    return DependencyFactory(
+        CronProvider, expression, config_key, timezone, misfire_grace,
+        overlap, singleton)
+
+
+class CronProvider(TimerProvider):
+    def __init__(self, expression, config_key, timezone=None,
+                 misfire_grace=None, overlap=True, singleton=False):
+        super(CronProvider, self).__init__(
+            None, config_key, overlap=overlap, singleton=singleton)
+        self._default_expression = expression
+        self.timezone = timezone
+        self.misfire_grace = misfire_grace
+
+    def prepare(self):
+        expression = self._default_expression
+
+        if self.config_key:
+            config = self.container.config
+            expression = config.get(self.config_key, expression)
+
+        self.cron = CronSchedule(expression, self.timezone)
+
+    def start(self):
+        _log.debug('starting %s', self)
+        self.register()
+        self.schedule(self.cron.next_fire(time.time()))
+
+    def fire(self):
+        ''' Called by the scheduler when the timer is due.
+        '''
+        now = time.time()
+        late = now - self._next_fire
+
+        if self.misfire_grace is not None and late > self.misfire_grace:
+            _log.warning('skipping fire of %s; %.1fs late', self, late)
+            self.container.metrics.increment('cron.misfired')
+        else:
+            self.tick()
+
+        self.schedule(self.cron.next_fire(max(now, self._next_fire)))
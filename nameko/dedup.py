@@ -0,0 +1,130 @@
+"""
+Duplicate message detection.
+
+Brokers may deliver a message more than once, for example when it is
+requeued after an error or when a consumer's connection drops before it
+acknowledges. A :class:`SeenSet` remembers the ids of processed messages
+for a window of time, so that consumers can acknowledge duplicates without
+handling them again.
+
+Ids are kept in memory, and optionally in a local sqlite database so that
+they survive restarts. Writes to the database are committed in batches,
+since each commit waits for the disk and blocks the eventlet hub.
+"""
+from __future__ import absolute_import
+import sqlite3
+import time
+
+from nameko.cache import LruCache, MISSING
+
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_WINDOW = 3600
+
+# prune expired ids from the store every PRUNE_INTERVAL additions
+PRUNE_INTERVAL = 1000
+
+# commit additions to the store once COMMIT_BATCH_SIZE are uncommitted, or
+# the oldest has been uncommitted for COMMIT_INTERVAL seconds
+COMMIT_BATCH_SIZE = 100
+COMMIT_INTERVAL = 1
+
+
+class SeenSet(object):
+    """ The ids of the messages processed by a consumer in the last
+    ``window`` seconds.
+
+    At most ``max_size`` ids are kept in memory. If ``path`` is given, ids
+    are also stored in the sqlite database at ``path``, which may be shared
+    by several consumers as ids are stored per ``scope``.
+    """
+    def __init__(self, scope, max_size=DEFAULT_MAX_SIZE,
+                 window=DEFAULT_WINDOW, path=None):
+        self.scope = scope
+        self.window = window
+        self._recent = LruCache(max_size=max_size, ttl=window)
+        self._store = None
+        if path is not None:
+            self._store = SqliteStore(path)
+
+    def __contains__(self, message_id):
+        if self._recent.get(message_id) is not MISSING:
+            return True
+
+        if self._store is not None:
+            seen_at = self._store.get(self.scope, message_id)
+            if seen_at is not None and seen_at > time.time() - self.window:
+                self._recent.set(message_id, True)
+                return True
+        return False
+
+    def add(self, message_id):
+        self._recent.set(message_id, True)
+        if self._store is not None:
+            self._store.add(self.scope, message_id, time.time())
+            if self._store.additions % PRUNE_INTERVAL == 0:
+                self._store.prune(time.time() - self.window)
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+
+
+class SqliteStore(object):
+    """ Stores message ids and the time they were seen in a sqlite database.
+
+    Additions are committed in batches of up to ``batch_size``, at least
+    every ``interval`` seconds as ids are added, and when the store is
+    pruned or closed. Uncommitted ids are visible to this store, but not to
+    others sharing the database, and are lost if the process crashes.
+    """
+    def __init__(self, path, batch_size=COMMIT_BATCH_SIZE,
+                 interval=COMMIT_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.additions = 0
+        self._uncommitted = 0
+        self._first_uncommitted_at = None
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS seen ('
+            'scope TEXT, message_id TEXT, seen_at REAL, '
+            'PRIMARY KEY (scope, message_id))')
+        self._db.commit()
+
+    def get(self, scope, message_id):
+        """ Return the time ``message_id`` was seen, or None.
+        """
+        row = self._db.execute(
+            'SELECT seen_at FROM seen WHERE scope = ? AND message_id = ?',
+            (scope, message_id)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def add(self, scope, message_id, seen_at):
+        self._db.execute(
+            'INSERT OR REPLACE INTO seen (scope, message_id, seen_at) '
+            'VALUES (?, ?, ?)', (scope, message_id, seen_at))
+        self.additions += 1
+
+        now = time.time()
+        if self._uncommitted == 0:
+            self._first_uncommitted_at = now
+        self._uncommitted += 1
+        if (self._uncommitted >= self.batch_size or
+                now - self._first_uncommitted_at >= self.interval):
+            self.commit()
+
+    def commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+    def prune(self, before):
+        """ Forget ids seen before ``before``.
+        """
+        self._db.execute('DELETE FROM seen WHERE seen_at < ?', (before,))
+        self.commit()
+
+    def close(self):
+        self.commit()
+        self._db.close()
@@ -11,7 +11,7 @@ import types
 from weakref import WeakSet, WeakKeyDictionary
 
 from eventlet.event import Event
-from nameko.utils import SpawningSet
+from nameko.utils import OrderedSpawningSet
 
 from logging import getLogger
 _log = getLogger(__name__)
@@ -122,11 +122,10 @@ class DependencyProvider(object):
              <nameko.messaging.QueueConsumer object at 0x10d5b8f50>]
             >>>
         """
-        for _, attr in inspect.getmembers(self):
-            if isinstance(attr, DependencyProvider):
-                yield attr
-                for nested_dep in attr.nested_dependencies:
-                    yield nested_dep
+        for _, attr in get_members(self, DependencyProvider):
+            yield attr
+            for nested_dep in attr.nested_dependencies:
+                yield nested_dep
 
     def __str__(self):
         try:
@@ -173,6 +172,22 @@ class InjectionProvider(DependencyProvider):
         service = worker_ctx.service
         setattr(service, injection_name, injection)
 
+    def inject_lazily(self, worker_ctx):
+        """ Inject into the worker's service instance the first time the
+        injection is accessed, rather than now.
+
+        Until then the injection isn't acquired, and the container doesn't
+        call ``worker_result`` or ``release`` for the worker.
+        """
+        pending = pending_injections.setdefault(worker_ctx.service, {})
+        pending[self.name] = (self, worker_ctx)
+
+    def is_injected(self, worker_ctx):
+        """ Return whether the injection was acquired for ``worker_ctx``.
+        """
+        pending = pending_injections.get(worker_ctx.service, {})
+        return self.name not in pending
+
     def release(self, worker_ctx):
 
         service = worker_ctx.service
@@ -219,30 +234,60 @@ class ProviderCollector(object):
         self.wait_for_providers()
 
 
-class DependencySet(SpawningSet):
+class DependencySet(OrderedSpawningSet):
+    """ The dependencies of a container, in the order they were added.
+
+    The injections, entrypoints and nested dependencies in the set are kept
+    in separate views as items are added and removed, rather than filtered
+    from the set each time they're needed.
+    """
+    def __init__(self, items=()):
+        self._injections = OrderedSpawningSet()
+        self._entrypoints = OrderedSpawningSet()
+        self._nested = OrderedSpawningSet()
+        super(DependencySet, self).__init__(items)
+
+    def _view_for(self, item):
+        if is_injection_provider(item):
+            return self._injections
+        if is_entrypoint_provider(item):
+            return self._entrypoints
+        return self._nested
+
+    def add(self, item):
+        super(DependencySet, self).add(item)
+        self._view_for(item).add(item)
+
+    def discard(self, item):
+        super(DependencySet, self).discard(item)
+        self._view_for(item).discard(item)
 
     @property
     def injections(self):
-        """ A ``SpawningSet`` of just the ``InjectionProvider`` instances in
-        this set.
+        """ An ``OrderedSpawningSet`` of just the ``InjectionProvider``
+        instances in this set.
+
+        The view is updated as the set changes, and must not be modified.
         """
-        return SpawningSet(item for item in self
-                           if is_injection_provider(item))
+        return self._injections
 
     @property
     def entrypoints(self):
-        """ A ``SpawningSet`` of just the ``EntrypointProvider`` instances in
-        this set.
+        """ An ``OrderedSpawningSet`` of just the ``EntrypointProvider``
+        instances in this set.
+
+        The view is updated as the set changes, and must not be modified.
         """
-        return SpawningSet(item for item in self
-                           if is_entrypoint_provider(item))
+        return self._entrypoints
 
     @property
     def nested(self):
-        """ A ``SpawningSet`` of any nested dependency instances in this set.
+        """ An ``OrderedSpawningSet`` of any nested dependency instances in
+        this set.
+
+        The view is updated as the set changes, and must not be modified.
         """
-        all_deps = self
-        return all_deps - self.injections - self.entrypoints
+        return self._nested
 
 
 registered_dependencies = WeakSet()
@@ -269,6 +314,37 @@ def register_entrypoint(fn, provider):
 
 shared_dependencies = WeakKeyDictionary()
 
+# injections not yet acquired, by service instance and attribute name
+pending_injections = WeakKeyDictionary()
+
+
+def acquire_pending_injection(service, name):
+    """ Acquire the pending injection ``name`` of ``service``, waiting for
+    it if another thread is already acquiring it.
+    """
+    pending = pending_injections[service]
+    entry = pending[name]
+    if isinstance(entry, Event):
+        return entry.wait()
+
+    provider, worker_ctx = entry
+    pending[name] = acquiring = Event()
+    try:
+        provider.inject(worker_ctx)
+    except Exception as exc:
+        pending[name] = entry
+        acquiring.send_exception(exc)
+        raise
+
+    del pending[name]
+    injection = getattr(service, name)
+    acquiring.send(injection)
+    return injection
+
+
+def discard_pending_injections(service):
+    pending_injections.pop(service, None)
+
 
 class DependencyFactory(object):
 
@@ -286,6 +362,17 @@ class DependencyFactory(object):
     def key(self):
         return (self.dep_cls, str(self.args), str(self.kwargs))
 
+    def __get__(self, instance, owner):
+        """ Acquire a lazy injection the first time it's accessed on a
+        service instance; see :meth:`InjectionProvider.inject_lazily`.
+        """
+        if instance is not None:
+            pending = pending_injections.get(instance, {})
+            for name in pending:
+                if getattr(owner, name, None) is self:
+                    return acquire_pending_injection(instance, name)
+        return self
+
     def create_and_bind_instance(self, name, container):
         """ Instantiate ``dep_cls`` and bind it to ``container``.
 
@@ -305,10 +392,9 @@ class DependencyFactory(object):
             instance = self.dep_cls(*self.args, **self.kwargs)
         instance.bind(name, container)
 
-        for name, attr in inspect.getmembers(instance):
-            if isinstance(attr, DependencyFactory):
-                prov = attr.create_and_bind_instance(name, container)
-                setattr(instance, name, prov)
+        for name, attr in get_members(instance, DependencyFactory):
+            prov = attr.create_and_bind_instance(name, container)
+            setattr(instance, name, prov)
 
         self.instances.add(instance)
         return instance
@@ -432,28 +518,96 @@ def is_entrypoint_provider(obj):
     return isinstance(obj, EntrypointProvider)
 
 
+class ClassIntrospection(object):
+    """ The dependencies declared on a class, found with
+    `inspect.getmembers`.
+
+    See :func:`introspect`.
+    """
+    def __init__(self, cls):
+        self.injections = []
+        self.entrypoints = []
+        self.factories = []
+        self.providers = []
+
+        for name, attr in inspect.getmembers(cls):
+            if isinstance(attr, DependencyFactory):
+                self.factories.append((name, attr))
+                if attr in registered_injections:
+                    self.injections.append((name, attr))
+            elif isinstance(attr, DependencyProvider):
+                self.providers.append((name, attr))
+            elif inspect.ismethod(attr):
+                for factory in getattr(attr, ENTRYPOINT_PROVIDERS_ATTR, []):
+                    self.entrypoints.append((name, factory))
+
+
+introspected_classes = WeakKeyDictionary()
+
+
+def introspect(cls):
+    """ Return the :class:`ClassIntrospection` of ``cls``.
+
+    Introspection is cached for the lifetime of the class. Classes whose
+    dependencies are changed after they have been introspected must be
+    passed to :func:`invalidate_introspection`.
+    """
+    introspection = introspected_classes.get(cls)
+    if introspection is None:
+        introspection = ClassIntrospection(cls)
+        introspected_classes[cls] = introspection
+    return introspection
+
+
+def invalidate_introspection(cls=None):
+    """ Forget the cached introspection of ``cls`` and its subclasses, or
+    of every class if ``cls`` is None.
+    """
+    if cls is None:
+        introspected_classes.clear()
+        return
+    for klass in list(introspected_classes.keys()):
+        if issubclass(klass, cls):
+            del introspected_classes[klass]
+
+
+def get_members(instance, member_type):
+    """ Return the names and values of the attributes of ``instance`` that
+    are instances of ``member_type``, sorted by name, like
+    `inspect.getmembers` but using the cached introspection of its class.
+    """
+    introspection = introspect(type(instance))
+    if member_type is DependencyFactory:
+        class_members = introspection.factories
+    else:
+        class_members = introspection.providers
+
+    attrs = vars(instance)
+    members = [(name, attr) for name, attr in class_members
+               if name not in attrs]
+    members.extend((name, attr) for name, attr in attrs.items()
+                   if isinstance(attr, member_type))
+    return sorted(members, key=lambda member: member[0])
+
+
 def prepare_injection_providers(container, include_dependencies=False):
     service_cls = container.service_cls
-    for name, attr in inspect.getmembers(service_cls):
-        if attr in registered_injections:
-            factory = attr
-            provider = factory.create_and_bind_instance(name, container)
-            yield provider
-            if include_dependencies:
-                for dependency in provider.nested_dependencies:
-                    yield dependency
+    for name, factory in introspect(service_cls).injections:
+        provider = factory.create_and_bind_instance(name, container)
+        yield provider
+        if include_dependencies:
+            for dependency in provider.nested_dependencies:
+                yield dependency
 
 
 def prepare_entrypoint_providers(container, include_dependencies=False):
     service_cls = container.service_cls
-    for name, attr in inspect.getmembers(service_cls, inspect.ismethod):
-        factories = getattr(attr, ENTRYPOINT_PROVIDERS_ATTR, [])
-        for factory in factories:
-            provider = factory.create_and_bind_instance(name, container)
-            yield provider
-            if include_dependencies:
-                for dependency in provider.nested_dependencies:
-                    yield dependency
+    for name, factory in introspect(service_cls).entrypoints:
+        provider = factory.create_and_bind_instance(name, container)
+        yield provider
+        if include_dependencies:
+            for dependency in provider.nested_dependencies:
+                yield dependency
 
 
 def prepare_dependencies(container):
@@ -26,21 +26,49 @@ Example::
 
 """
 from __future__ import absolute_import
+from collections import deque
+from functools import partial
 from logging import getLogger
+import os
+import time
 import uuid
+from weakref import WeakKeyDictionary
 
+import eventlet
+from eventlet.event import Event as WaitEvent
+from eventlet.queue import Queue as BufferQueue, Empty
 from kombu import Exchange, Queue
 
-from nameko.messaging import PublishProvider, PERSISTENT, ConsumeProvider
+from nameko.messaging import (
+    PublishProvider, Publisher, PERSISTENT, ConsumeProvider, new_message_id)
 from nameko.dependencies import entrypoint, injection, DependencyFactory
+from nameko.journal import Journal
 
 
 SERVICE_POOL = "service_pool"
 SINGLETON = "singleton"
 BROADCAST = "broadcast"
+PARTITIONED = "partitioned"
+
+# carries an event's partition key; not prefixed, so that it isn't
+# mistaken for context data
+PARTITION_KEY_HEADER = "x-partition-key"
+
+DEFAULT_BUFFER_SIZE = 1000
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 0.005
+DEFAULT_COALESCE_WINDOW = 1
+
+# queued by `EventDispatcher.stop` to make the flusher exit once drained
+STOP_FLUSHING = object()
 
 _log = getLogger(__name__)
 
+# the broadcast handlers in this process sharing a queue, by source service
+# and event type
+_broadcast_handlers = {}
+_broadcast_queue_ids = {}
+
 
 def get_event_exchange(service_name):
     """ Get an exchange for ``service_name`` events.
@@ -53,6 +81,46 @@ def get_event_exchange(service_name):
     return exchange
 
 
+def get_broadcast_queue_id():
+    """ Return an id for the broadcast queues of this process.
+
+    Ids are per process id rather than per import, so that forked processes
+    don't share queues.
+    """
+    pid = os.getpid()
+    if pid not in _broadcast_queue_ids:
+        _broadcast_queue_ids[pid] = uuid.uuid4().hex
+    return _broadcast_queue_ids[pid]
+
+
+def reset_broadcast_handlers():
+    """ Forget the broadcast handlers registered in this process.
+    """
+    _broadcast_handlers.clear()
+
+
+def get_event_headers(headers, evt):
+    """ Add the partition key of ``evt``, if any, to message ``headers``.
+    """
+    if evt.partition_key is not None:
+        headers[PARTITION_KEY_HEADER] = evt.partition_key
+    return headers
+
+
+def get_event_type(event_type):
+    """ Return the type of ``event_type``, which may be an :class:`Event`
+    subclass or a string.
+    """
+    if isinstance(event_type, type) and issubclass(event_type, Event):
+        return event_type.type
+    elif not isinstance(event_type, basestring):
+        raise TypeError(
+            'event_type must be either a nameko.events.Event subclass or a '
+            'string a string matching the Event.type value. '
+            'Got {}'.format(type(event_type).__name__))
+    return event_type
+
+
 class EventTypeMissing(Exception):
     """ Raised when an Event subclasses are defined without and event-type.
     """
@@ -110,8 +178,15 @@ class Event(object):
     See amqp routing keys for `topic` exchanges for more info.
     """
 
-    def __init__(self, data):
+    partition_key = None
+    """ Events with the same partition key are handled one at a time, in
+    order, by ``PARTITIONED`` event handlers.
+    """
+
+    def __init__(self, data, partition_key=None):
         self.data = data
+        if partition_key is not None:
+            self.partition_key = partition_key
 
 
 class EventDispatcher(PublishProvider):
@@ -130,6 +205,9 @@ class EventDispatcher(PublishProvider):
     There is no guarantee that any service will receive the event, only
     that the event has been successfully dispatched.
 
+    Buffered dispatchers return as soon as the event has been buffered; see
+    :func:`event_dispatcher`.
+
     Example::
 
         class MyEvent(Event):
@@ -144,53 +222,222 @@ class EventDispatcher(PublishProvider):
                 self.dispatch_spam(evt)
 
     """
+    def __init__(self, buffered=False, buffer_size=DEFAULT_BUFFER_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_before_ack=False):
+        super(EventDispatcher, self).__init__()
+        self.buffered = buffered
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_before_ack = flush_before_ack
+        self._buffer = None
+        self._flusher = None
+        # keyed weakly, so that the events of workers killed before their
+        # teardown are forgotten
+        self._pending = WeakKeyDictionary()
+
     def prepare(self):
         service_name = self.container.service_name
         self.exchange = get_event_exchange(service_name)
         super(EventDispatcher, self).prepare()
 
+    def start(self):
+        if self.buffered:
+            self._buffer = BufferQueue(self.buffer_size)
+            self._flusher = self.container.spawn_managed_thread(
+                self._flush_forever, protected=True)
+        super(EventDispatcher, self).start()
+
+    def stop(self):
+        if self._flusher is not None:
+            _log.debug('draining buffered events %s', self)
+            self._buffer.put(STOP_FLUSHING)
+            self._flusher.wait()
+            self._flusher = None
+        super(EventDispatcher, self).stop()
+
+    def kill(self, exc=None):
+        if self._flusher is not None:
+            unflushed = self._buffer.qsize()
+            if unflushed:
+                _log.warning('discarding %s buffered event(s)', unflushed)
+            self._flusher.kill()
+            self._flusher = None
+        super(EventDispatcher, self).kill(exc)
+
     def acquire_injection(self, worker_ctx):
         """ Inject a dispatch method onto the service instance
         """
-        def dispatch(evt):
-            exchange = self.exchange
+        if self._flusher is not None:
+            return BufferedDispatcher(self, worker_ctx)
+        return Dispatcher(self, worker_ctx)
 
-            msg = evt.data
-            routing_key = evt.type
+    def worker_teardown(self, worker_ctx):
+        for flushed in self._pending.pop(worker_ctx, ()):
+            flushed.wait()
 
+    def enqueue(self, headers, evt, message_id, worker_ctx):
+        """ Add ``evt`` to the buffer, blocking while the buffer is full.
+        """
+        flushed = None
+        if self.flush_before_ack:
+            flushed = WaitEvent()
+            self._pending.setdefault(worker_ctx, []).append(flushed)
+
+        if self._buffer.full():
+            self.container.metrics.increment('events.buffer_full')
+        self._buffer.put((headers, evt, message_id, flushed))
+
+    def _flush_forever(self):
+        buffer = self._buffer
+
+        while True:
+            batch = [buffer.get()]
+            flush_at = time.time() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                if batch[-1] is STOP_FLUSHING:
+                    break
+                timeout = flush_at - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(buffer.get(timeout=timeout))
+                except Empty:
+                    break
+
+            stopping = batch[-1] is STOP_FLUSHING
+            if stopping:
+                batch.pop()
+            if batch:
+                self.flush(batch)
+            if stopping:
+                break
+
+    def flush(self, batch):
+        """ Publish a batch of buffered events with a single producer.
+
+        Failures are logged rather than raised, so that a broker outage
+        doesn't kill the container; the events of a failed batch are lost.
+        Workers waiting for the batch to be flushed before their message is
+        acknowledged get the exception instead.
+        """
+        exchange = self.exchange
+        try:
             with self.get_producer() as producer:
+                for headers, evt, message_id, _ in batch:
+                    producer.publish(evt.data, exchange=exchange,
+                                     headers=headers, routing_key=evt.type,
+                                     message_id=message_id)
+        except Exception as exc:
+            _log.exception('failed to dispatch %s buffered event(s)',
+                           len(batch))
+            self.container.metrics.increment('events.dropped', len(batch))
+            for _, _, _, flushed in batch:
+                if flushed is not None:
+                    flushed.send_exception(exc)
+        else:
+            for _, _, _, flushed in batch:
+                if flushed is not None:
+                    flushed.send()
+
+
+class Dispatcher(Publisher):
+    """ The dispatch callable injected by :class:`EventDispatcher`.
+
+    Calling it dispatches a single event. :meth:`dispatch_many` dispatches
+    a batch of events with a single producer.
+    """
+    def __call__(self, evt):
+        self.dispatch_many([evt])
+
+    def dispatch_many(self, events):
+        """ Dispatch each event in ``events``.
+        """
+        exchange = self.provider.get_exchange()
 
-                headers = self.get_message_headers(worker_ctx)
-                producer.publish(msg, exchange=exchange, headers=headers,
-                                 routing_key=routing_key)
+        with self.provider.get_producer() as producer:
+            for evt in events:
+                producer.publish(evt.data, exchange=exchange,
+                                 headers=self.get_event_headers(evt),
+                                 routing_key=evt.type,
+                                 message_id=new_message_id())
 
-        return dispatch
+    def get_event_headers(self, evt):
+        return get_event_headers(self.get_headers(), evt)
+
+
+class BufferedDispatcher(Dispatcher):
+    """ The dispatch callable injected by a buffered :class:`EventDispatcher`.
+
+    Events are added to the dispatcher's buffer and published by its flusher
+    thread, so dispatching only blocks while the buffer is full.
+    """
+    def dispatch_many(self, events):
+        for evt in events:
+            self.provider.enqueue(
+                self.get_event_headers(evt), evt, new_message_id(),
+                self.worker_ctx)
 
 
 @injection
-def event_dispatcher():
-    return DependencyFactory(EventDispatcher)
+def event_dispatcher(buffered=False, buffer_size=DEFAULT_BUFFER_SIZE,
+                     batch_size=DEFAULT_BATCH_SIZE,
+                     flush_interval=DEFAULT_FLUSH_INTERVAL,
+                     flush_before_ack=False):
+    """ Inject an event dispatcher.
+
+    By default, dispatching publishes the event before returning. If
+    ``buffered`` is True, events are instead added to a buffer of up to
+    ``buffer_size`` events and published in the background, in batches of
+    up to ``batch_size`` events collected over ``flush_interval`` seconds.
+    Dispatching blocks while the buffer is full, and the buffer is drained
+    when the container stops.
+
+    If ``flush_before_ack`` is also True, workers wait during teardown until
+    the events they dispatched have been published, so that the message
+    that triggered the worker is only acknowledged afterwards.
+    """
+    return DependencyFactory(
+        EventDispatcher, buffered, buffer_size, batch_size, flush_interval,
+        flush_before_ack)
 
 
 class EventHandler(ConsumeProvider):
 
+    # whether broadcast handlers of this class may share a queue with the
+    # process's other broadcast handlers for the same events
+    local_fanout = True
+
     def __init__(self, service_name, event_type, handler_type,
-                 reliable_delivery, requeue_on_error):
+                 reliable_delivery, requeue_on_error, dedup=None,
+                 coalesce_key=None, window=DEFAULT_COALESCE_WINDOW,
+                 coalesce_all=False, journal=None):
 
         self.service_name = service_name
         self.event_type = event_type
         self.handler_type = handler_type
         self.reliable_delivery = reliable_delivery
+        self.coalesce_key = coalesce_key
+        self.window = window
+        self.coalesce_all = coalesce_all
+        self.journal_options = journal
+        self.journal = None
+        self._coalescing = {}
+        self._lanes = {}
+        self._lanes_drained = None
 
         super(EventHandler, self).__init__(
-            queue=None, requeue_on_error=requeue_on_error)
+            queue=None, requeue_on_error=requeue_on_error, dedup=dedup)
 
     def prepare(self):
         _log.debug('starting handler for %s', self.container)
 
         # handler_type determines queue name
         service_name = self.container.service_name
-        if self.handler_type is SERVICE_POOL:
+        if self.handler_type in (SERVICE_POOL, PARTITIONED):
             queue_name = "evt-{}-{}--{}.{}".format(self.service_name,
                                                    self.event_type,
                                                    service_name,
@@ -198,6 +445,12 @@ class EventHandler(ConsumeProvider):
         elif self.handler_type is SINGLETON:
             queue_name = "evt-{}-{}".format(self.service_name,
                                             self.event_type)
+        elif self.shares_broadcast_queue:
+            queue_name = "evt-{}-{}--broadcast-{}".format(
+                self.service_name, self.event_type, get_broadcast_queue_id())
+            handlers = _broadcast_handlers.setdefault(
+                (self.service_name, self.event_type), [])
+            handlers.append(self)
         elif self.handler_type is BROADCAST:
             queue_name = "evt-{}-{}--{}.{}-{}".format(self.service_name,
                                                       self.event_type,
@@ -213,13 +466,235 @@ class EventHandler(ConsumeProvider):
             queue_name, exchange=exchange, routing_key=self.event_type,
             durable=True, auto_delete=auto_delete)
 
+        if self.journal_options:
+            options = self.journal_options
+            if isinstance(options, basestring):
+                options = {'path': options}
+            options = dict(options)
+            options['path'] = os.path.join(
+                options['path'], '{}.{}'.format(service_name, self.name))
+            self.journal = Journal(**options)
+
         super(EventHandler, self).prepare()
 
+    def stop(self):
+        self.leave_broadcast_queue()
+        super(EventHandler, self).stop()
+
+        # don't wait for open windows to close
+        for timer, closing, _ in self._coalescing.values():
+            closing.send()
+            timer.wait()
+
+        # events waiting in a lane have been received, so are handled
+        # before the entrypoint is stopped
+        if self._lanes:
+            _log.debug('waiting for %s partition lane(s) %s',
+                       len(self._lanes), self)
+            self._lanes_drained = WaitEvent()
+            self._lanes_drained.wait()
+
+        self.close_journal()
+
+    def kill(self, exc=None):
+        self.leave_broadcast_queue()
+        windows, self._coalescing = self._coalescing.values(), {}
+        for _, closing, _ in windows:
+            closing.send()
+        self._lanes.clear()
+        self.close_journal()
+        super(EventHandler, self).kill(exc)
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def record(self, message, args):
+        """ Append the event in ``message`` to the journal, if kept.
+
+        The event is handled even if it can't be journaled, e.g. because it
+        is too large for a segment or the disk is full; such failures are
+        logged and counted in the ``journal.errors`` container metric.
+        """
+        if self.journal is None:
+            return
+        try:
+            self.journal.append(self.event_type, args[0], message.headers)
+        except (ValueError, EnvironmentError):
+            _log.exception('failed to journal event for %s', self)
+            self.container.metrics.increment('journal.errors')
+
+    def replay_entry(self, entry):
+        """ Spawn a worker for a journal ``entry``. See
+        :func:`nameko.journal.replay`.
+        """
+        context_data = self.unpack_headers(
+            self.container.worker_ctx_cls, entry.headers)
+        self.container.spawn_worker(
+            self, (entry.body,), {}, context_data=context_data)
+
+    @property
+    def shares_broadcast_queue(self):
+        """ Broadcast handlers in a process share one queue per source
+        service and event type, so that each event is only sent to the
+        process once. The handler receiving an event fans it out to the
+        others.
+
+        Handlers that requeue on error or coalesce events keep a queue of
+        their own.
+        """
+        return (
+            self.handler_type is BROADCAST and self.local_fanout and
+            not self.requeue_on_error and self.coalesce_key is None)
+
+    def leave_broadcast_queue(self):
+        handlers = _broadcast_handlers.get(
+            (self.service_name, self.event_type), [])
+        if self in handlers:
+            handlers.remove(self)
+
+    def fan_out(self, message, args, kwargs, context_data):
+        """ Spawn a worker for every broadcast handler sharing this handler's
+        queue, in their own containers.
+
+        The message is acknowledged once all the workers have completed.
+        """
+        handlers = list(_broadcast_handlers.get(
+            (self.service_name, self.event_type), []))
+        if not handlers:
+            self.handle_message_processed(message)
+            return
+
+        remaining = [len(handlers)]
+        handle_result = partial(self.handle_fanout_result, message, remaining)
+        for handler in handlers:
+            handler.record(message, args)
+            handler.container.spawn_worker(
+                handler, args, kwargs,
+                context_data=context_data,
+                handle_result=handle_result)
+
+    def handle_fanout_result(self, message, remaining, worker_ctx,
+                             result=None, exc=None):
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            self.handle_message_processed(message)
+
+    def get_partition_key(self, message):
+        if self.handler_type is PARTITIONED:
+            return message.headers.get(PARTITION_KEY_HEADER)
+
+    def spawn_worker(self, message, args, kwargs, context_data):
+        if self.shares_broadcast_queue:
+            self.fan_out(message, args, kwargs, context_data)
+            return
+
+        self.record(message, args)
+
+        if self.coalesce_key is not None:
+            self.coalesce(message, args[0], context_data)
+            return
+
+        key = self.get_partition_key(message)
+        if key is not None:
+            # the key's lane exists while one of its events is handled;
+            # later events for the key wait in it
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append((message, args, kwargs, context_data))
+                return
+            self._lanes[key] = deque()
+
+        super(EventHandler, self).spawn_worker(
+            message, args, kwargs, context_data)
+
+    def handle_result(self, message, worker_ctx, result=None, exc=None):
+        super(EventHandler, self).handle_result(
+            message, worker_ctx, result, exc)
+
+        key = self.get_partition_key(message)
+        if key is not None:
+            self.next_in_lane(key)
+
+    def next_in_lane(self, key):
+        lane = self._lanes.get(key)
+        if lane is None:
+            return
+
+        if lane:
+            # spawn from a separate thread; this worker still holds its
+            # slot in the pool, which may be full
+            spawn = super(EventHandler, self).spawn_worker
+            self.container.spawn_managed_thread(
+                partial(spawn, *lane.popleft()))
+        else:
+            del self._lanes[key]
+            drained = self._lanes_drained
+            if not self._lanes and drained is not None and not drained.ready():
+                drained.send()
+
+    def coalesce(self, message, body, context_data):
+        """ Hold ``message`` until the window for its coalesce key closes.
+
+        The first event for a key opens a window of ``self.window`` seconds,
+        which closes early once its ``closing`` event is sent.
+        """
+        key = self.coalesce_key(body)
+        if key not in self._coalescing:
+            closing = WaitEvent()
+            timer = self.container.spawn_managed_thread(
+                partial(self._flush_after_window, key, closing))
+            self._coalescing[key] = (timer, closing, [])
+        _, _, pending = self._coalescing[key]
+        pending.append((message, body, context_data))
+
+    def _flush_after_window(self, key, closing):
+        with eventlet.Timeout(self.window, False):
+            closing.wait()
+
+        # the held messages are discarded if the entrypoint was killed
+        if key in self._coalescing:
+            self.flush_coalesced(key)
+
+    def flush_coalesced(self, key):
+        """ Spawn a single worker for the events held for ``key``.
+
+        The worker is called with the latest payload, or with a list of all
+        payloads if ``self.coalesce_all``, and runs with the context data of
+        the latest event. All the held messages are acknowledged (or
+        requeued) with its result.
+        """
+        _, _, pending = self._coalescing.pop(key)
+        messages, bodies, contexts = zip(*pending)
+        context_data = contexts[-1]
+
+        if len(pending) > 1:
+            self.container.metrics.increment(
+                'events.coalesced', len(pending) - 1)
+
+        if self.coalesce_all:
+            args = (list(bodies),)
+        else:
+            args = (bodies[-1],)
+
+        self.container.spawn_worker(
+            self, args, {},
+            context_data=context_data,
+            handle_result=partial(self.handle_coalesced_result, messages))
+
+    def handle_coalesced_result(self, messages, worker_ctx, result=None,
+                                exc=None):
+        for message in messages:
+            self.handle_message_processed(message, result, exc)
+
 
 @entrypoint
 def event_handler(service_name, event_type, handler_type=SERVICE_POOL,
                   reliable_delivery=True, requeue_on_error=False,
-                  event_handler_cls=EventHandler):
+                  event_handler_cls=EventHandler, dedup=None,
+                  coalesce_key=None, window=DEFAULT_COALESCE_WINDOW,
+                  coalesce_all=False, journal=None):
     r"""
     Decorate a method as a handler of ``event_type`` events on the service
     called ``service_name``. ``event_type`` must be either a subclass of
@@ -266,17 +741,67 @@ def event_handler(service_name, event_type, handler_type=SERVICE_POOL,
                           \
                             [queue]- (service Y handler-method)
 
+            Broadcast handlers running in the same process share a queue,
+            so each event is only sent to the process once and then handed
+            to every local handler. Handlers with ``requeue_on_error`` or
+            a ``coalesce_key`` keep a queue of their own.
+
+        - ``events.PARTITIONED``:
+
+            Like ``SERVICE_POOL``, but events dispatched with the same
+            ``partition_key`` are handled one at a time, in the order they
+            are received, while events for different keys are handled
+            concurrently. Events without a partition key are handled as
+            by ``SERVICE_POOL``.
+
+            Order is kept among the events each service instance receives;
+            to keep it across a cluster, run a single instance. Events
+            requeued on error are received again after later events for
+            their key. ::
+
+                                          .- [key a] - (worker) (worker)
+                                         /
+                exchange o -- [queue] - (service X handler-method)
+                                         \
+                                          '- [key b] - (worker)
+
     If ``requeue_on_error``, handlers will return the event to the queue if an
     error occurs while handling it. Defaults to False.
 
     If ``reliable_delivery``, events will be kept in the queue until there is
     a handler to consume them. Defaults to ``True``.
 
+    If ``dedup`` is given, events redelivered after they were handled are
+    acknowledged without being handled again. See
+    :func:`~nameko.messaging.consume` for the accepted values.
+
+    If ``coalesce_key`` is given, it is called with the payload of each event
+    to get a key. The first event for a key opens a window of ``window``
+    seconds, during which further events for the key are held; when the
+    window closes the handler is called once, with the latest payload, or
+    with a list of all the payloads if ``coalesce_all`` is True. The held
+    events are acknowledged once that call has completed. Held events count
+    towards the container's prefetch limit of ``max_workers`` messages, and
+    superseded events are counted in the ``events.coalesced`` metric. ::
+
+        @event_handler('catalogue', 'product_changed',
+                       coalesce_key=lambda data: data['product_id'],
+                       window=5)
+        def reindex_product(self, data):
+            ...
+
     ``event_handler_cls`` may be specified to use a different EventHandler
         (sub)class for custom behaviour.
 
+    If ``journal`` is given, every event received is appended to a
+    :class:`~nameko.journal.Journal` in a subdirectory of ``journal`` named
+    after the service and method, before it is handled. ``journal`` may
+    also be a dict of options for the journal, including its ``path``.
+    Journaled events can be replayed with :func:`nameko.journal.replay`.
+
     Raises an ``EventHandlerConfigurationError`` if the ``handler_type``
-    is set to ``BROADCAST`` and ``reliable_delivery`` is set to ``True``.
+    is set to ``BROADCAST`` and ``reliable_delivery`` is set to ``True``, or
+    if it is set to ``PARTITIONED`` and a ``coalesce_key`` is given.
     """
 
     if reliable_delivery and handler_type is BROADCAST:
@@ -284,13 +809,13 @@ def event_handler(service_name, event_type, handler_type=SERVICE_POOL,
             "Broadcast event handlers cannot be configured with reliable "
             "delivery.")
 
-    if isinstance(event_type, type) and issubclass(event_type, Event):
-        event_type = event_type.type
-    elif not isinstance(event_type, basestring):
-        raise TypeError(
-            'event_type must be either a nameko.events.Event subclass or a '
-            'string a string matching the Event.type value. '
-            'Got {}'.format(type(event_type).__name__))
+    if coalesce_key is not None and handler_type is PARTITIONED:
+        raise EventHandlerConfigurationError(
+            "Partitioned event handlers cannot coalesce events.")
+
+    event_type = get_event_type(event_type)
 
     return DependencyFactory(event_handler_cls, service_name, event_type,
-                             handler_type, reliable_delivery, requeue_on_error)
+                             handler_type, reliable_delivery, requeue_on_error,
+                             dedup, coalesce_key, window, coalesce_all,
+                             journal)
@@ -6,6 +6,16 @@ class WaiterTimeout(Exception):
     pass
 
 
+class DeadlineExceeded(Exception):
+    """ Raised when a call's deadline has passed before it completed.
+    """
+
+
+class PublishNotConfirmed(Exception):
+    """ Raised when the broker did not confirm a published message.
+    """
+
+
 class RemoteError(Exception):
     def __init__(self, exc_type=None, value=None):
         self.exc_type = exc_type
@@ -0,0 +1,192 @@
+"""
+Futures for greenthreads.
+
+:class:`GreenFuture` has the interface of `concurrent.futures.Future`, but
+waits on an `eventlet.event.Event` rather than a `threading.Condition`,
+which is needlessly expensive when greenthreads are the only concurrency.
+It raises the `concurrent.futures` exceptions, so callers can handle either
+kind of future the same way, and it keeps the state and waiters that
+`concurrent.futures.wait` and `concurrent.futures.as_completed` inspect.
+"""
+from __future__ import absolute_import
+from logging import getLogger
+
+from concurrent.futures import CancelledError, TimeoutError
+import eventlet
+from eventlet import Timeout
+from eventlet.event import Event
+import greenlet
+
+_log = getLogger(__name__)
+
+
+# the states of a `concurrent.futures.Future`; a cancelled future is
+# completed, and its waiters notified, straight away
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+CANCELLED = 'CANCELLED_AND_NOTIFIED'
+FINISHED = 'FINISHED'
+
+
+class _Unlocked(object):
+    """ Stands in for the condition of a `concurrent.futures.Future`, which
+    `concurrent.futures.wait` and `as_completed` hold while they inspect
+    and add waiters to futures. Greenthreads only switch when they block,
+    and they don't block while holding it, so there is nothing to lock.
+    """
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class GreenFuture(object):
+    """ The result of a call that may not have completed yet.
+    """
+    _condition = _Unlocked()
+
+    def __init__(self):
+        self._state = PENDING
+        self._result = None
+        self._exception = None
+        self._done = Event()
+        self._callbacks = []
+        self._waiters = []
+
+    def __repr__(self):
+        state = 'cancelled' if self._state == CANCELLED else self._state
+        return '<GreenFuture at {:#x} state={}>'.format(
+            id(self), state.lower())
+
+    def cancel(self):
+        """ Cancel the call if it hasn't started, returning whether it is
+        cancelled.
+        """
+        if self._state in (RUNNING, FINISHED):
+            return False
+        if self._state == PENDING:
+            self._state = CANCELLED
+            self._complete()
+        return True
+
+    def cancelled(self):
+        return self._state == CANCELLED
+
+    def running(self):
+        return self._state == RUNNING
+
+    def done(self):
+        return self._state in (CANCELLED, FINISHED)
+
+    def _wait(self, timeout):
+        if not self._done.ready():
+            with Timeout(timeout, TimeoutError):
+                self._done.wait()
+        if self._state == CANCELLED:
+            raise CancelledError()
+
+    def result(self, timeout=None):
+        """ Return the result of the call, waiting up to ``timeout``
+        seconds for it to complete, and raising its exception if it failed.
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Return the exception raised by the call, or None, waiting up to
+        ``timeout`` seconds for it to complete.
+        """
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """ Call ``fn`` with the future when it completes or is cancelled,
+        or now if it already has.
+        """
+        if self.done():
+            self._call_back(fn)
+        else:
+            self._callbacks.append(fn)
+
+    def set_running_or_notify_cancel(self):
+        """ Mark the future as running, returning False if it was cancelled
+        instead.
+        """
+        if self._state == CANCELLED:
+            return False
+        if self._state != PENDING:
+            raise RuntimeError('future in unexpected state: {}'.format(
+                self._state))
+        self._state = RUNNING
+        return True
+
+    def set_result(self, result):
+        self._result = result
+        self._state = FINISHED
+        self._complete()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._state = FINISHED
+        self._complete()
+
+    def _complete(self):
+        if not self._done.ready():
+            self._done.send()
+        for waiter in self._waiters:
+            if self._state == CANCELLED:
+                waiter.add_cancelled(self)
+            elif self._exception is not None:
+                waiter.add_exception(self)
+            else:
+                waiter.add_result(self)
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._call_back(fn)
+
+    def _call_back(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            _log.exception('exception calling callback for %s', self)
+
+
+def spawn_future(container, func, *args, **kwargs):
+    """ Call ``func`` in a thread managed by ``container``, returning a
+    :class:`GreenFuture` of its result.
+
+    If the container is killed before the call completes, the future's
+    exception is the `GreenletExit` that killed the thread. Containers that
+    don't manage threads, like the stub of a standalone
+    :class:`~nameko.standalone.rpc.RpcProxy`, get a plain greenthread.
+    """
+    future = GreenFuture()
+    future.set_running_or_notify_cancel()
+
+    def call():
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    def handle_thread_exited(gt):
+        try:
+            gt.wait()
+        except greenlet.GreenletExit as green_exit:
+            future.set_exception(green_exit)
+
+    spawn = getattr(container, 'spawn_managed_thread', eventlet.spawn)
+    gt = spawn(call)
+    gt.link(handle_thread_exited)
+    return future
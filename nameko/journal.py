@@ -0,0 +1,330 @@
+"""
+An append-only, on-disk journal of received events.
+
+Event handlers given a ``journal`` directory append every event they receive,
+with its headers, to a :class:`Journal` before handling it. The journal can
+later be replayed into the handler with :func:`replay`, to rebuild state
+without asking upstream services to dispatch their events again.
+
+A journal is a directory of segments. Each segment is a preallocated,
+memory-mapped log file named after the offset of its first entry, with an
+index file mapping offsets to positions in the log. The index is written
+through a buffer, flushed when the segment is rolled or closed; entries it
+is missing after a crash are recovered from the log when the segment is
+opened again. Entries are numbered
+with increasing offsets; retention deletes whole segments, and compaction
+rewrites segments keeping only the latest entry for each key, so offsets
+may have gaps.
+"""
+from __future__ import absolute_import
+from bisect import bisect_left
+from collections import namedtuple
+from logging import getLogger
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+
+import eventlet
+
+_log = getLogger(__name__)
+
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# offset, timestamp, length of data
+RECORD_HEADER = struct.Struct('>QdI')
+
+# offset, position of record
+INDEX_ENTRY = struct.Struct('>QQ')
+
+LOG_SUFFIX = '.log'
+INDEX_SUFFIX = '.index'
+COMPACTING_DIR = 'compacting'
+
+
+Entry = namedtuple('Entry', 'offset timestamp event_type body headers')
+
+
+class SegmentFull(Exception):
+    pass
+
+
+class Segment(object):
+    """ One log file of a :class:`Journal` and its index.
+    """
+    def __init__(self, directory, base_offset, size):
+        self.base_offset = base_offset
+        name = os.path.join(directory, '{:020d}'.format(base_offset))
+        self.log_path = name + LOG_SUFFIX
+        self.index_path = name + INDEX_SUFFIX
+
+        if not os.path.exists(self.log_path):
+            with open(self.log_path, 'wb') as log:
+                log.truncate(size)
+        self._log = open(self.log_path, 'r+b')
+        self._map = mmap.mmap(self._log.fileno(), 0)
+
+        self.offsets = []
+        self.positions = []
+        indexed = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as index:
+                data = index.read()
+            # ignoring an entry left half written by a crash
+            indexed = len(data) - len(data) % INDEX_ENTRY.size
+            for start in xrange(0, indexed, INDEX_ENTRY.size):
+                offset, position = INDEX_ENTRY.unpack_from(data, start)
+                self.offsets.append(offset)
+                self.positions.append(position)
+        self._index_file = open(self.index_path, 'ab')
+        self._index_file.truncate(indexed)
+
+        self.position = 0
+        self.last_timestamp = None
+        if self.positions:
+            _, self.last_timestamp, _, self.position = self.read(
+                self.positions[-1])
+        self._recover()
+
+    def _recover(self):
+        # records are appended to the log before they're indexed; the rest
+        # of a preallocated log is zeroed, and no record is empty
+        while self.position + RECORD_HEADER.size <= len(self._map):
+            offset, timestamp, length = RECORD_HEADER.unpack_from(
+                self._map, self.position)
+            end = self.position + RECORD_HEADER.size + length
+            if not length or end > len(self._map) or (
+                    self.offsets and offset <= self.offsets[-1]):
+                break
+            self._index(offset, timestamp, end)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def last_offset(self):
+        if self.offsets:
+            return self.offsets[-1]
+
+    def append(self, offset, timestamp, data):
+        end = self.position + RECORD_HEADER.size + len(data)
+        if end > len(self._map):
+            raise SegmentFull()
+
+        RECORD_HEADER.pack_into(
+            self._map, self.position, offset, timestamp, len(data))
+        self._map[self.position + RECORD_HEADER.size:end] = data
+        self._index(offset, timestamp, end)
+
+    def _index(self, offset, timestamp, end):
+        self._index_file.write(INDEX_ENTRY.pack(offset, self.position))
+        self.offsets.append(offset)
+        self.positions.append(self.position)
+
+        self.position = end
+        self.last_timestamp = timestamp
+
+    def flush(self):
+        self._map.flush()
+        self._index_file.flush()
+
+    def read(self, position):
+        """ Return the offset, timestamp and data of the record at
+        ``position``, and the position of the next record.
+        """
+        offset, timestamp, length = RECORD_HEADER.unpack_from(
+            self._map, position)
+        start = position + RECORD_HEADER.size
+        return offset, timestamp, self._map[start:start + length], (
+            start + length)
+
+    def records(self, from_offset=0):
+        """ Yield the offset, timestamp and data of the records at or after
+        ``from_offset``.
+        """
+        for i in xrange(bisect_left(self.offsets, from_offset), len(self)):
+            offset, timestamp, data, _ = self.read(self.positions[i])
+            yield offset, timestamp, data
+
+    def close(self):
+        self.flush()
+        self._map.close()
+        self._log.close()
+        self._index_file.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.index_path)
+
+
+class Journal(object):
+    """ A segmented log of events in the directory ``path``.
+
+    Segments are preallocated with ``segment_size`` bytes. If ``retention``
+    is given, segments whose entries are all older than ``retention``
+    seconds are deleted when a new segment is started.
+    """
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE,
+                 retention=None):
+        self.path = path
+        self.segment_size = segment_size
+        self.retention = retention
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        base_offsets = sorted(
+            int(name[:-len(LOG_SUFFIX)]) for name in os.listdir(path)
+            if name.endswith(LOG_SUFFIX))
+        self.segments = [
+            Segment(path, base_offset, segment_size)
+            for base_offset in base_offsets]
+
+        self.next_offset = 0
+        for segment in reversed(self.segments):
+            if len(segment):
+                self.next_offset = segment.last_offset + 1
+                break
+
+        if not self.segments:
+            self.segments.append(Segment(path, 0, segment_size))
+
+    def append(self, event_type, body, headers=None):
+        """ Append an event to the journal, returning its offset.
+        """
+        data = json.dumps({
+            'type': event_type, 'body': body, 'headers': headers or {}})
+        if RECORD_HEADER.size + len(data) > self.segment_size:
+            raise ValueError(
+                'entry of {} bytes is too large for a segment'.format(
+                    len(data)))
+
+        offset = self.next_offset
+        timestamp = time.time()
+
+        try:
+            self.segments[-1].append(offset, timestamp, data)
+        except SegmentFull:
+            self.roll()
+            self.segments[-1].append(offset, timestamp, data)
+
+        self.next_offset += 1
+        return offset
+
+    def roll(self):
+        """ Start a new segment, applying the retention policy.
+        """
+        self.segments[-1].flush()
+        self.segments.append(
+            Segment(self.path, self.next_offset, self.segment_size))
+        if self.retention is not None:
+            self.apply_retention(time.time() - self.retention)
+
+    def apply_retention(self, before):
+        """ Delete the segments, other than the current one, whose entries
+        were all appended before the timestamp ``before``.
+        """
+        for segment in self.segments[:-1]:
+            if segment.last_timestamp is None or \
+                    segment.last_timestamp < before:
+                _log.debug('deleting journal segment %s', segment.log_path)
+                segment.delete()
+                self.segments.remove(segment)
+
+    def compact(self, key):
+        """ Rewrite the segments, other than the current one, keeping only
+        the latest entry for each value of ``key(entry)``.
+
+        Entries for which ``key`` returns None are kept. Offsets are kept,
+        so compacted segments have gaps.
+        """
+        latest = {}
+        for entry in self.read():
+            entry_key = key(entry)
+            if entry_key is not None:
+                latest[entry_key] = entry.offset
+        keep = set(latest.values())
+
+        # compacted segments are written aside, then moved over the
+        # originals; anything left there by an interrupted compaction is
+        # discarded, since the originals are still in place
+        compacting_path = os.path.join(self.path, COMPACTING_DIR)
+        if os.path.isdir(compacting_path):
+            shutil.rmtree(compacting_path)
+        os.makedirs(compacting_path)
+
+        for segment in self.segments[:-1]:
+            records = [
+                (offset, timestamp, data) for offset, timestamp, data
+                in segment.records() if offset in keep or
+                key(self._entry(offset, timestamp, data)) is None]
+            if len(records) == len(segment):
+                continue
+
+            _log.debug('compacting journal segment %s', segment.log_path)
+            index = self.segments.index(segment)
+            if not records:
+                segment.delete()
+                del self.segments[index]
+                continue
+
+            compacted = Segment(
+                compacting_path, segment.base_offset, self.segment_size)
+            for record in records:
+                compacted.append(*record)
+            compacted.close()
+            segment.close()
+            os.rename(compacted.log_path, segment.log_path)
+            os.rename(compacted.index_path, segment.index_path)
+            self.segments[index] = Segment(
+                self.path, segment.base_offset, self.segment_size)
+
+    def _entry(self, offset, timestamp, data):
+        record = json.loads(data)
+        return Entry(offset, timestamp, record['type'], record['body'],
+                     record['headers'])
+
+    def read(self, from_offset=0):
+        """ Yield the entries at or after ``from_offset``, in order.
+        """
+        for segment in self.segments:
+            last_offset = segment.last_offset
+            if last_offset is None or last_offset < from_offset:
+                continue
+            for record in segment.records(from_offset):
+                yield self._entry(*record)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+def replay(container, entrypoint, from_offset=0, rate=None):
+    """ Re-drive the journaled event handler called ``entrypoint`` in
+    ``container`` with the events in its journal at or after
+    ``from_offset``, bypassing the broker.
+
+    If ``rate`` is given, at most ``rate`` events are replayed per second.
+    Returns the offset following the last event replayed.
+    """
+    for provider in container.entrypoints:
+        if provider.name == entrypoint:
+            break
+    else:
+        raise ValueError('{} has no entrypoint called {}'.format(
+            container, entrypoint))
+
+    if getattr(provider, 'journal', None) is None:
+        raise ValueError('{} does not keep a journal'.format(entrypoint))
+
+    next_offset = from_offset
+    for entry in provider.journal.read(from_offset):
+        provider.replay_entry(entry)
+        next_offset = entry.offset + 1
+        if rate is not None:
+            eventlet.sleep(1.0 / rate)
+    return next_offset
@@ -6,8 +6,10 @@ from itertools import count
 from functools import partial
 from logging import getLogger
 import socket
+import uuid
 
 import eventlet
+from eventlet import Timeout
 from eventlet.event import Event
 
 from kombu.common import maybe_declare
@@ -15,6 +17,9 @@ from kombu.pools import producers, connections
 from kombu import Connection
 from kombu.mixins import ConsumerMixin
 
+from nameko.confirms import Confirmer, DEFAULT_CONFIRM_WINDOW
+from nameko.containers import DEADLINE_KEY
+from nameko.dedup import SeenSet
 from nameko.dependencies import (
     InjectionProvider, EntrypointProvider, entrypoint, injection,
     DependencyProvider, ProviderCollector, DependencyFactory, dependency,
@@ -28,6 +33,10 @@ HEADER_PREFIX = "nameko"
 AMQP_URI_CONFIG_KEY = 'AMQP_URI'
 
 
+def new_message_id():
+    return str(uuid.uuid4())
+
+
 class HeaderEncoder(object):
 
     header_prefix = HEADER_PREFIX
@@ -36,7 +45,13 @@ class HeaderEncoder(object):
         return "{}.{}".format(self.header_prefix, key)
 
     def get_message_headers(self, worker_ctx):
-        data = worker_ctx.context_data
+        """ Return the headers carrying the context data of ``worker_ctx``.
+
+        Deadlines only apply to RPC calls, which add them to the request
+        themselves, so the worker's deadline is never included.
+        """
+        data = dict(worker_ctx.context_data)
+        data.pop(DEADLINE_KEY, None)
 
         if None in data.values():
             _log.warn(
@@ -61,14 +76,75 @@ class HeaderDecoder(object):
         return key
 
     def unpack_message_headers(self, worker_ctx_cls, message):
+        return self.unpack_headers(worker_ctx_cls, message.headers)
+
+    def unpack_headers(self, worker_ctx_cls, headers):
         stripped = {self._strip_header_name(k): v
-                    for k, v in message.headers.iteritems()}
+                    for k, v in headers.iteritems()}
         return worker_ctx_cls.get_context_data(stripped)
 
 
+@dependency
+def declarer():
+    return DependencyFactory(Declarer)
+
+
+class Declarer(DependencyProvider):
+    """ Declares the exchanges and queues used by a container's providers
+    together, on one channel.
+
+    Providers pass their entities to :meth:`declare` in their ``prepare``.
+    The container prepares nested dependencies such as this one after the
+    providers that use them, so most entities have been collected by the
+    time :meth:`prepare` is called here. Providers that are nested
+    dependencies themselves are prepared alongside it, and may declare
+    theirs later; those are declared straight away.
+    """
+    def __init__(self):
+        self._entities = []
+        self._prepared = False
+
+    def declare(self, entity):
+        """ Declare ``entity`` when this provider is prepared, or now if it
+        already has been.
+        """
+        if self._prepared:
+            self._declare([entity])
+        elif entity not in self._entities:
+            self._entities.append(entity)
+
+    def prepare(self):
+        self._prepared = True
+        entities, self._entities = self._entities, []
+        self._declare(entities)
+
+    def _declare(self, entities):
+        if not entities:
+            return
+
+        conn = Connection(self.container.config[AMQP_URI_CONFIG_KEY])
+        with connections[conn].acquire(block=True) as conn:
+            channel = conn.default_channel
+            for entity in entities:
+                maybe_declare(entity, channel)
+
+        _log.debug('declared %s entities for %s', len(entities), self)
+
+
 @injection
-def publisher(exchange=None, queue=None):
-    return DependencyFactory(PublishProvider, exchange, queue)
+def publisher(exchange=None, queue=None, confirms=False,
+              confirm_window=DEFAULT_CONFIRM_WINDOW):
+    """ Inject a publisher for ``exchange``, or for the exchange ``queue``
+    is bound to.
+
+    If ``confirms`` is True, messages are published with publisher confirms
+    on a dedicated connection, with up to ``confirm_window`` messages
+    awaiting confirmation. Publishing doesn't wait for confirmation;
+    workers that need it call ``wait_confirmed()`` on the injected
+    publisher.
+    """
+    return DependencyFactory(
+        PublishProvider, exchange, queue, confirms, confirm_window)
 
 
 class PublishProvider(InjectionProvider, HeaderEncoder):
@@ -91,9 +167,15 @@ class PublishProvider(InjectionProvider, HeaderEncoder):
                 self.publish('spam:' + data)
 
     """
-    def __init__(self, exchange=None, queue=None):
+    declarer = declarer(shared=CONTAINER_SHARED)
+
+    def __init__(self, exchange=None, queue=None, confirms=False,
+                 confirm_window=DEFAULT_CONFIRM_WINDOW):
         self.exchange = exchange
         self.queue = queue
+        self.confirms = confirms
+        self.confirm_window = confirm_window
+        self.confirmer = None
 
     def get_connection(self):
         # TODO: should this live outside of the class or be a class method?
@@ -105,31 +187,111 @@ class PublishProvider(InjectionProvider, HeaderEncoder):
         return producers[conn].acquire(block=True)
 
     def prepare(self):
+        # declaring a queue also declares the exchange it's bound to
+        if self.queue is not None:
+            self.declarer.declare(self.queue)
+        elif self.exchange is not None:
+            self.declarer.declare(self.exchange)
+
+    def start(self):
+        if self.confirms:
+            container = self.container
+            self.confirmer = Confirmer(
+                container.config[AMQP_URI_CONFIG_KEY],
+                window=self.confirm_window, metrics=container.metrics)
+            self.confirmer.start(partial(
+                container.spawn_managed_thread, protected=True))
+
+    def stop(self):
+        if self.confirmer is not None:
+            self.confirmer.stop()
+            self.confirmer = None
+
+    def kill(self, exc=None):
+        if self.confirmer is not None:
+            self.confirmer.kill()
+            self.confirmer = None
+
+    def get_exchange(self):
         exchange = self.exchange
         queue = self.queue
 
-        with self.get_connection() as conn:
-            if queue is not None:
-                maybe_declare(queue, conn)
-            elif exchange is not None:
-                maybe_declare(exchange, conn)
+        if exchange is None and queue is not None:
+            exchange = queue.exchange
+        return exchange
 
     def acquire_injection(self, worker_ctx):
-        def publish(msg, **kwargs):
-            exchange = self.exchange
-            queue = self.queue
+        return Publisher(self, worker_ctx)
 
-            if exchange is None and queue is not None:
-                exchange = queue.exchange
 
-            with self.get_producer() as producer:
-                # TODO: should we enable auto-retry,
-                #      should that be an option in __init__?
-                headers = self.get_message_headers(worker_ctx)
-                producer.publish(msg, exchange=exchange, headers=headers,
-                                 **kwargs)
+class Publisher(object):
+    """ The publish callable injected by :class:`PublishProvider`.
 
-        return publish
+    Calling it publishes a single message. :meth:`publish_many` publishes
+    a batch of messages with a single producer. Message headers are
+    computed once per worker.
+
+    If the provider publishes with confirms, :meth:`wait_confirmed` waits
+    for the broker to confirm the messages published so far.
+    """
+    def __init__(self, provider, worker_ctx):
+        self.provider = provider
+        self.worker_ctx = worker_ctx
+        self._headers = None
+        self._unconfirmed = []
+
+    def get_headers(self):
+        if self._headers is None:
+            self._headers = self.provider.get_message_headers(
+                self.worker_ctx)
+        # producers may add to the headers of each message
+        return dict(self._headers)
+
+    def __call__(self, msg, **kwargs):
+        self.publish_many([msg], **kwargs)
+
+    def publish_many(self, msgs, **kwargs):
+        """ Publish each message in ``msgs``, passing ``kwargs`` on to
+        :meth:`kombu.Producer.publish`.
+
+        Each message is given a unique ``message_id`` unless one is passed.
+        """
+        exchange = self.provider.get_exchange()
+
+        confirmer = self.provider.confirmer
+        if confirmer is not None:
+            for msg in msgs:
+                self._unconfirmed.append(confirmer.publish(
+                    msg, exchange=exchange, headers=self.get_headers(),
+                    **self.get_options(kwargs)))
+            return
+
+        with self.provider.get_producer() as producer:
+            # TODO: should we enable auto-retry,
+            #      should that be an option in __init__?
+            for msg in msgs:
+                producer.publish(msg, exchange=exchange,
+                                 headers=self.get_headers(),
+                                 **self.get_options(kwargs))
+
+    def get_options(self, kwargs):
+        options = dict(kwargs)
+        options.setdefault('message_id', new_message_id())
+        return options
+
+    def wait_confirmed(self, timeout=None):
+        """ Wait until the broker has confirmed every message published
+        through this publisher.
+
+        Raises :class:`~nameko.exceptions.PublishNotConfirmed` if a message
+        could not be published, and ``eventlet.Timeout`` if they aren't
+        all confirmed within ``timeout`` seconds. Returns immediately if the
+        provider doesn't publish with confirms.
+        """
+        unconfirmed, self._unconfirmed = self._unconfirmed, []
+        with Timeout(timeout):
+            for pending in unconfirmed:
+                pending.wait()
 
 
 @dependency
@@ -160,7 +322,16 @@ class QueueConsumer(DependencyProvider, ProviderCollector, ConsumerMixin):
 
     @property
     def _prefetch_count(self):
-        return self.container.max_workers
+        # providers that hold messages while waiting to handle them may ask
+        # for a higher limit; it applies to every consumer on the channel,
+        # so providers asking for a much higher limit should have a queue
+        # consumer of their own
+        prefetch_counts = [self.container.max_workers]
+        for provider in self._providers:
+            prefetch_count = getattr(provider, 'prefetch_count', None)
+            if prefetch_count is not None:
+                prefetch_counts.append(prefetch_count)
+        return max(prefetch_counts)
 
     def _handle_thread_exited(self, gt):
         exc = None
@@ -380,7 +551,7 @@ class QueueConsumer(DependencyProvider, ProviderCollector, ConsumerMixin):
 
 
 @entrypoint
-def consume(queue, requeue_on_error=False):
+def consume(queue, requeue_on_error=False, dedup=None):
     """
     Decorates a method as a message consumer.
 
@@ -401,10 +572,17 @@ def consume(queue, requeue_on_error=False):
 
             self.shrub(body)
 
+    If ``dedup`` is given, the ids of processed messages are remembered and
+    redelivered duplicates are acknowledged without being handled again.
+    ``dedup`` may be True or a dict of options for the
+    :class:`~nameko.dedup.SeenSet`, e.g. ``{'window': 600, 'path':
+    '/var/lib/myservice/seen.db'}``. Messages without an id are always
+    handled. Duplicates are counted in the ``dedup.hits`` container metric.
+
     Args:
         queue: The queue to consume from.
     """
-    return DependencyFactory(ConsumeProvider, queue, requeue_on_error)
+    return DependencyFactory(ConsumeProvider, queue, requeue_on_error, dedup)
 
 
 # pylint: disable=E1101,E1123
@@ -412,16 +590,52 @@ class ConsumeProvider(EntrypointProvider, HeaderDecoder):
 
     queue_consumer = queue_consumer(shared=CONTAINER_SHARED)
 
-    def __init__(self, queue, requeue_on_error):
+    # overrides the container's prefetch limit of ``max_workers`` if higher
+    prefetch_count = None
+
+    def __init__(self, queue, requeue_on_error, dedup=None):
         self.queue = queue
         self.requeue_on_error = requeue_on_error
+        self.dedup = dedup
+        self.seen = None
+        self._unprocessed = 0
+        self._stopped = False
 
     def prepare(self):
+        if self.dedup:
+            options = {} if self.dedup is True else dict(self.dedup)
+            scope = '{}.{}'.format(self.container.service_name, self.name)
+            self.seen = SeenSet(scope, **options)
+
         self.queue_consumer.register_provider(self)
 
+    def unpack_headers(self, worker_ctx_cls, headers):
+        # deadlines only apply to rpc calls; a message carrying one is
+        # handled, however late, by a worker without a deadline
+        context_data = super(ConsumeProvider, self).unpack_headers(
+            worker_ctx_cls, headers)
+        context_data.pop(DEADLINE_KEY, None)
+        return context_data
+
     def stop(self):
         self.queue_consumer.unregister_provider(self)
 
+        # workers still running after the entrypoint has stopped record
+        # their messages in the seen-set when they finish, so it's closed
+        # once the last message has been processed
+        self._stopped = True
+        if not self._unprocessed:
+            self.close_seen()
+
+    def kill(self, exc=None):
+        self.close_seen()
+        super(ConsumeProvider, self).kill(exc)
+
+    def close_seen(self):
+        seen, self.seen = self.seen, None
+        if seen is not None:
+            seen.close()
+
     def handle_message(self, body, message):
         args = (body,)
         kwargs = {}
@@ -429,6 +643,16 @@ class ConsumeProvider(EntrypointProvider, HeaderDecoder):
         worker_ctx_cls = self.container.worker_ctx_cls
         context_data = self.unpack_message_headers(worker_ctx_cls, message)
 
+        if self.is_duplicate(message):
+            _log.debug('discarding duplicate message %s', message)
+            self.container.metrics.increment('dedup.hits')
+            self.queue_consumer.ack_message(message)
+            return
+
+        self._unprocessed += 1
+        self.spawn_worker(message, args, kwargs, context_data)
+
+    def spawn_worker(self, message, args, kwargs, context_data):
         self.container.spawn_worker(
             self, args, kwargs,
             context_data=context_data,
@@ -442,8 +666,22 @@ class ConsumeProvider(EntrypointProvider, HeaderDecoder):
         if exc is not None and self.requeue_on_error:
             self.queue_consumer.requeue_message(message)
         else:
+            if self.seen is not None:
+                message_id = message.properties.get('message_id')
+                if message_id is not None:
+                    self.seen.add(message_id)
             self.queue_consumer.ack_message(message)
 
+        self._unprocessed -= 1
+        if self._stopped and not self._unprocessed:
+            self.close_seen()
+
+    def is_duplicate(self, message):
+        if self.seen is None:
+            return False
+        message_id = message.properties.get('message_id')
+        return message_id is not None and message_id in self.seen
+
 
 class QueueConsumerStopped(Exception):
     pass
@@ -0,0 +1,278 @@
+"""
+Lightweight metrics for service containers.
+
+Every :class:`~nameko.containers.ServiceContainer` records, per entrypoint:
+
+    - ``queue_wait``: the time between an entrypoint asking for a worker and
+      the worker starting, i.e. time spent waiting for a free slot in the
+      worker pool,
+    - ``run``: the time spent in the service method,
+    - ``teardown``: the time spent processing the result and tearing down the
+      worker's dependencies,
+
+as fixed-size histograms, along with the number of workers in flight and the
+number of workers that succeeded or raised. Other components may keep named
+counters and histograms on the container's metrics.
+
+A snapshot is available from
+:meth:`~nameko.containers.ServiceContainer.metrics_snapshot` and, for all
+hosted services, from :meth:`~nameko.runners.ServiceRunner.metrics_snapshot`.
+Exporters turn runner snapshots into something a monitoring system
+understands::
+
+    exporter = StatsdExporter(prefix='myapp')
+
+    class Reporter(object):
+
+        @timer(interval=10)
+        def report(self):
+            exporter.export(runner.metrics_snapshot())
+"""
+from __future__ import absolute_import
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_left
+from logging import getLogger
+import socket
+
+_log = getLogger(__name__)
+
+
+# upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """ A histogram of observations in fixed buckets.
+
+    Memory use is constant regardless of the number of observations.
+    Observations larger than the last bucket bound are counted in an
+    overflow bucket.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """ Return cumulative bucket counts, in the style of Prometheus.
+
+        The last bucket has an upper bound of ``float('inf')``.
+        """
+        bounds = self.buckets + (float('inf'),)
+        cumulative = []
+        total = 0
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+
+        return {
+            'buckets': cumulative,
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class EntrypointMetrics(object):
+    """ Metrics for the workers of a single entrypoint.
+    """
+    def __init__(self):
+        self.queue_wait = Histogram()
+        self.run = Histogram()
+        self.teardown = Histogram()
+        self.in_flight = 0
+        self.successes = 0
+        self.errors = 0
+
+    def snapshot(self):
+        return {
+            'queue_wait': self.queue_wait.snapshot(),
+            'run': self.run.snapshot(),
+            'teardown': self.teardown.snapshot(),
+            'in_flight': self.in_flight,
+            'successes': self.successes,
+            'errors': self.errors,
+        }
+
+
+class ContainerMetrics(object):
+    """ Metrics of a single service container.
+    """
+    def __init__(self):
+        self.entrypoints = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def entrypoint(self, name):
+        """ Return the :class:`EntrypointMetrics` for entrypoint ``name``.
+        """
+        metrics = self.entrypoints.get(name)
+        if metrics is None:
+            metrics = self.entrypoints[name] = EntrypointMetrics()
+        return metrics
+
+    def increment(self, name, value=1):
+        """ Increment the named counter ``name`` by ``value``.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def histogram(self, name):
+        """ Return the :class:`Histogram` called ``name``.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def snapshot(self):
+        return {
+            'entrypoints': {name: metrics.snapshot()
+                            for name, metrics in self.entrypoints.items()},
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.snapshot()
+                           for name, histogram in self.histograms.items()},
+        }
+
+
+class MetricsExporter(object):
+    """ Base class for metrics exporters.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def export(self, snapshot):
+        """ Export a runner snapshot, as returned by
+        :meth:`~nameko.runners.ServiceRunner.metrics_snapshot`.
+        """
+
+
+def _metric_name(name):
+    return name.replace('.', '_').replace('-', '_')
+
+
+class PrometheusExporter(MetricsExporter):
+    """ Renders snapshots in the Prometheus text exposition format.
+    """
+    def __init__(self, prefix='nameko'):
+        self.prefix = prefix
+
+    def export(self, snapshot):
+        """ Return ``snapshot`` as Prometheus text.
+        """
+        lines = []
+        prefix = self.prefix
+
+        def add(name, labels, value):
+            label_str = ','.join(
+                '{}="{}"'.format(key, val) for key, val in labels)
+            lines.append('{}_{}{{{}}} {}'.format(
+                prefix, name, label_str, _format_value(value)))
+
+        def add_histogram(kind, labels, histogram):
+            name = '{}_seconds'.format(kind)
+            for bound, count in histogram['buckets']:
+                bucket_labels = labels + (('le', _format_value(bound)),)
+                add(name + '_bucket', bucket_labels, count)
+            add(name + '_sum', labels, histogram['sum'])
+            add(name + '_count', labels, histogram['count'])
+
+        for service_name, container in sorted(snapshot.items()):
+            entrypoints = container['entrypoints']
+            for entrypoint, metrics in sorted(entrypoints.items()):
+                labels = (('service', service_name),
+                          ('entrypoint', entrypoint))
+
+                add('in_flight', labels, metrics['in_flight'])
+                add('successes_total', labels, metrics['successes'])
+                add('errors_total', labels, metrics['errors'])
+
+                for kind in ('queue_wait', 'run', 'teardown'):
+                    add_histogram(kind, labels, metrics[kind])
+
+            labels = (('service', service_name),)
+            for counter, value in sorted(container['counters'].items()):
+                add('{}_total'.format(_metric_name(counter)), labels, value)
+
+            histograms = container.get('histograms', {})
+            for name, histogram in sorted(histograms.items()):
+                add_histogram(_metric_name(name), labels, histogram)
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+class StatsdExporter(MetricsExporter):
+    """ Sends snapshots to a statsd daemon over UDP.
+
+    In-flight workers are sent as gauges. Counters are sent as the
+    difference to the previous export. Histograms are sent as the mean
+    duration of the workers completed since the previous export.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='nameko'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._last = {}
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _delta(self, key, value):
+        last = self._last.get(key, 0)
+        self._last[key] = value
+        return value - last
+
+    def format(self, snapshot):
+        """ Return the statsd lines for ``snapshot``.
+        """
+        lines = []
+
+        def add_histogram(key, histogram):
+            count = self._delta(key + '.count', histogram['count'])
+            total = self._delta(key + '.sum', histogram['sum'])
+            if count:
+                lines.append('{}:{:.3f}|ms'.format(key, total / count * 1000))
+
+        for service_name, container in sorted(snapshot.items()):
+            base = '{}.{}'.format(self.prefix, service_name)
+
+            entrypoints = container['entrypoints']
+            for entrypoint, metrics in sorted(entrypoints.items()):
+                name = '{}.{}'.format(base, entrypoint)
+
+                lines.append('{}.in_flight:{}|g'.format(
+                    name, metrics['in_flight']))
+
+                for kind in ('successes', 'errors'):
+                    key = '{}.{}'.format(name, kind)
+                    lines.append('{}:{}|c'.format(
+                        key, self._delta(key, metrics[kind])))
+
+                for kind in ('queue_wait', 'run', 'teardown'):
+                    add_histogram('{}.{}'.format(name, kind), metrics[kind])
+
+            for counter, value in sorted(container['counters'].items()):
+                key = '{}.{}'.format(base, counter)
+                lines.append('{}:{}|c'.format(key, self._delta(key, value)))
+
+            histograms = container.get('histograms', {})
+            for histogram_name, histogram in sorted(histograms.items()):
+                add_histogram(
+                    '{}.{}'.format(base, histogram_name), histogram)
+
+        return lines
+
+    def export(self, snapshot):
+        for line in self.format(snapshot):
+            try:
+                self._sock.sendto(line, self.address)
+            except socket.error as exc:
+                _log.debug('failed to send metric %s: %s', line, exc)
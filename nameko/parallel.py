@@ -1,11 +1,17 @@
 from __future__ import absolute_import
+from collections import deque
 from contextlib import contextmanager
 from functools import partial
+from itertools import islice, izip
+import time
 
 from logging import getLogger
 
 from concurrent import futures
+from eventlet.queue import LightQueue, Empty
+from eventlet.semaphore import Semaphore
 import greenlet
+from nameko.futures import GreenFuture
 from nameko.utils import try_wraps
 from nameko.dependencies import InjectionProvider, injection, DependencyFactory
 
@@ -14,29 +20,79 @@ _log = getLogger(__name__)
 
 
 class ParallelProxyFactory(object):
-    def __init__(self, thread_provider):
+    def __init__(self, thread_provider, max_parallelism=None):
         self.container = thread_provider
+        self.max_parallelism = max_parallelism
 
     @contextmanager
-    def __call__(self, to_wrap):
-        executor = ParallelExecutor(self.container)
-        proxy = ParallelProxy(executor, to_wrap)
+    def __call__(self, to_wrap=None):
+        """ Yield a `ParallelProxy` around ``to_wrap``, or the
+        `ParallelExecutor` itself if there is nothing to wrap.
+        """
+        executor = ParallelExecutor(self.container, self.max_parallelism)
         with executor:
-            yield proxy
+            if to_wrap is None:
+                yield executor
+            else:
+                yield ParallelProxy(executor, to_wrap)
+
+
+def _call_chunk(func, chunk):
+    return [func(*args) for args in chunk]
+
+
+def as_completed(fs, timeout=None):
+    """
+    Yield the futures in ``fs`` as they complete, like
+    `concurrent.futures.as_completed` but waiting on an eventlet queue
+    rather than thread locks.
+
+    Raises `concurrent.futures.TimeoutError` if they haven't all completed
+    within ``timeout`` seconds.
+    """
+    fs = set(fs)
+    done = LightQueue()
+    for future in fs:
+        future.add_done_callback(done.put)
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    for _ in range(len(fs)):
+        wait = None
+        if timeout is not None:
+            wait = max(0, deadline - time.time())
+        try:
+            yield done.get(timeout=wait)
+        except Empty:
+            raise futures.TimeoutError()
 
 
 class ParallelExecutor(futures.Executor):
-    def __init__(self, container):
+    """
+    Runs calls in threads managed by ``container``.
+
+    If ``max_parallelism`` is given, at most that many calls run at once,
+    and `submit` blocks until one completes.
+    """
+    def __init__(self, container, max_parallelism=None):
         self.container = container
+        self.max_parallelism = max_parallelism
         self._spawned_threads = set()
         self._shutdown = False
+        self._slots = None
+        if max_parallelism is not None:
+            self._slots = Semaphore(max_parallelism)
 
     def submit(self, func, *args, **kwargs):
         if self._shutdown:
             raise RuntimeError('cannot schedule new futures after '
                                'shutdown')
 
-        f = futures.Future()
+        if self._slots is not None:
+            self._slots.acquire()
+
+        f = GreenFuture()
 
         @try_wraps(func)
         def do_function_call():
@@ -77,6 +133,8 @@ class ParallelExecutor(futures.Executor):
         Handle the completion of a thread spawned for a future.
         """
         self._spawned_threads.remove(gt)
+        if self._slots is not None:
+            self._slots.release()
         try:
             gt.wait()
         except greenlet.GreenletExit as green_exit:
@@ -85,6 +143,51 @@ class ParallelExecutor(futures.Executor):
             # container is killed before the future's thread exits.
             future.set_exception(green_exit)
 
+    def map(self, func, *iterables, **kwargs):
+        """
+        Return an iterator of ``func`` applied to the items of
+        ``iterables``, in order.
+
+        Unlike `concurrent.futures.Executor.map`, the iterables are consumed
+        lazily, as the results are: calls are submitted in chunks of
+        ``chunksize`` items, with at most ``max_parallelism`` chunks (or
+        the container's ``max_workers``, if unbounded) in flight ahead of
+        the result being waited for.
+        """
+        chunksize = kwargs.pop('chunksize', 1)
+        timeout = kwargs.pop('timeout', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments {}'.format(
+                ', '.join(kwargs)))
+        if chunksize < 1:
+            raise ValueError('chunksize must be at least 1')
+
+        items = izip(*iterables)
+        chunks = iter(lambda: list(islice(items, chunksize)), [])
+        submit_chunk = partial(self.submit, _call_chunk, func)
+        read_ahead = self.max_parallelism or self.container.max_workers
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        def results():
+            pending = deque(
+                submit_chunk(chunk)
+                for chunk in islice(chunks, read_ahead))
+            while pending:
+                future = pending.popleft()
+                wait = None
+                if timeout is not None:
+                    wait = max(0, deadline - time.time())
+                chunk_results = future.result(wait)
+
+                # keep the pipeline full while the results are consumed
+                pending.extend(submit_chunk(chunk)
+                               for chunk in islice(chunks, 1))
+                for result in chunk_results:
+                    yield result
+        return results()
+
     def shutdown(self, wait=True):
         """
         Call to ensure all spawned threads have finished.
@@ -141,8 +244,11 @@ class ProxySettingUnsupportedException(Exception):
 
 
 class ParallelProvider(InjectionProvider):
+    def __init__(self, max_parallelism=None):
+        self.max_parallelism = max_parallelism
+
     def acquire_injection(self, worker_ctx):
-        return ParallelProxyFactory(self.container)
+        return ParallelProxyFactory(self.container, self.max_parallelism)
 
 
 @injection
@@ -1,19 +1,29 @@
 from __future__ import absolute_import
+import copy
 from functools import partial
+import json
 from logging import getLogger
+import time
 import uuid
 
+from eventlet import Timeout
 from eventlet.event import Event
 from kombu import Connection, Exchange, Queue
 from kombu.pools import producers
 
-from nameko.exceptions import MethodNotFound, RemoteErrorWrapper
+from nameko.cache import (
+    LruCache, shared_cache, get_shared_cache, json_size, MISSING)
+from nameko.containers import DEADLINE_KEY, deadline_expired
+from nameko.exceptions import (
+    MethodNotFound, RemoteErrorWrapper, DeadlineExceeded)
+from nameko.futures import spawn_future
 from nameko.messaging import (
     queue_consumer, HeaderEncoder, HeaderDecoder, AMQP_URI_CONFIG_KEY)
 from nameko.dependencies import (
     entrypoint, injection, InjectionProvider, EntrypointProvider,
     DependencyFactory, dependency, ProviderCollector, DependencyProvider,
     CONTAINER_SHARED)
+from nameko.utils import SingleFlight
 
 _log = getLogger(__name__)
 
@@ -131,7 +141,17 @@ class RpcProvider(EntrypointProvider, HeaderDecoder):
 
     rpc_consumer = rpc_consumer(shared=CONTAINER_SHARED)
 
+    def __init__(self, memoize=None):
+        super(RpcProvider, self).__init__()
+        self.memoize = memoize
+        self.cache = None
+
     def prepare(self):
+        if self.memoize:
+            options = {} if self.memoize is True else dict(self.memoize)
+            options.setdefault('sizeof', json_size)
+            self.cache = LruCache(**options)
+
         self.rpc_consumer.register_provider(self)
 
     def stop(self):
@@ -145,18 +165,73 @@ class RpcProvider(EntrypointProvider, HeaderDecoder):
         worker_ctx_cls = self.container.worker_ctx_cls
         context_data = self.unpack_message_headers(worker_ctx_cls, message)
 
+        if deadline_expired(context_data):
+            _log.debug('discarding expired call %s', message)
+            self.container.metrics.increment('deadline.discarded')
+            exc = DeadlineExceeded('{} expired before it was handled'.format(
+                self.name))
+            self.rpc_consumer.handle_result(
+                message, self.container, None, exc)
+            return
+
+        if self.cache is not None:
+            result = self.get_memoized(args, kwargs)
+            if result is not MISSING:
+                self.rpc_consumer.handle_result(
+                    message, self.container, result, None)
+                return
+
         handle_result = partial(self.handle_result, message)
         self.container.spawn_worker(self, args, kwargs,
                                     context_data=context_data,
                                     handle_result=handle_result)
 
     def handle_result(self, message, worker_ctx, result, exc):
+        if self.cache is not None and exc is None:
+            self.memoize_result(worker_ctx.args, worker_ctx.kwargs, result)
         self.rpc_consumer.handle_result(message, self.container, result, exc)
 
+    def get_memoized(self, args, kwargs):
+        key = call_key(self.container.service_name, self.name, args, kwargs)
+        if key is None:
+            return MISSING
+
+        metrics = self.container.metrics
+        result = self.cache.get(key)
+        if result is MISSING:
+            metrics.increment('memoize.misses')
+        else:
+            metrics.increment('memoize.hits')
+        return result
+
+    def memoize_result(self, args, kwargs, result):
+        key = call_key(self.container.service_name, self.name, args, kwargs)
+        if key is not None:
+            evicted = self.cache.set(key, result)
+            if evicted:
+                self.container.metrics.increment('memoize.evictions', evicted)
+
 
 @entrypoint
-def rpc():
-    return DependencyFactory(RpcProvider)
+def rpc(memoize=None):
+    """ Decorate a method as an RPC entrypoint.
+
+    If ``memoize`` is given, successful results are cached by arguments and
+    replies to repeated calls are sent straight from the cache, without
+    spawning a worker. ``memoize`` may be True or a dict of options for the
+    :class:`~nameko.cache.LruCache` shared by the container's workers, e.g.::
+
+        @rpc(memoize={'ttl': 300, 'max_bytes': 10 * 1024 * 1024})
+        def price(self, product_id):
+            ...
+
+    Sizes are measured as the length of the JSON-serialized result. Only
+    memoize methods whose result depends on nothing but their arguments;
+    memoized calls skip injections, context data and worker lifecycle hooks.
+    Lookups and evictions are counted in the ``memoize.hits``,
+    ``memoize.misses`` and ``memoize.evictions`` container metrics.
+    """
+    return DependencyFactory(RpcProvider, memoize)
 
 
 class Responder(object):
@@ -233,6 +308,22 @@ class ReplyListener(DependencyProvider):
         self._reply_events[correlation_id] = reply_event
         return reply_event
 
+    def wait_for_reply(self, correlation_id, reply_event, timeout):
+        """ Wait up to ``timeout`` seconds for ``reply_event``, raising
+        :class:`~nameko.exceptions.DeadlineExceeded` if it doesn't arrive.
+        """
+        timer = Timeout(timeout)
+        try:
+            return reply_event.wait()
+        except Timeout as exc:
+            if exc is not timer:
+                raise
+            self._reply_events.pop(correlation_id, None)
+            raise DeadlineExceeded(
+                'no reply within {:0.3f} sec'.format(timeout))
+        finally:
+            timer.cancel()
+
     def handle_message(self, body, message):
         self.queue_consumer.ack_message(message)
 
@@ -253,45 +344,195 @@ class RpcProxyProvider(InjectionProvider):
 
     rpc_reply_listener = reply_listener(shared=CONTAINER_SHARED)
 
-    def __init__(self, service_name):
+    def __init__(self, service_name, timeout=None, coalesce=False,
+                 cache=None):
         self.service_name = service_name
+        self.timeout = timeout
+        self.single_flight = SingleFlight() if coalesce else None
+        self.cache_options = cache or {}
+        self.caches = {}
+
+    def prepare(self):
+        for method_name, options in self.cache_options.items():
+            options = dict(options)
+            options.setdefault('sizeof', json_size)
+            name = cache_name(self.service_name, method_name)
+            self.caches[method_name] = shared_cache(name, **options)
 
     def acquire_injection(self, worker_ctx):
         return ServiceProxy(worker_ctx, self.service_name,
-                            self.rpc_reply_listener)
+                            self.rpc_reply_listener, timeout=self.timeout,
+                            single_flight=self.single_flight,
+                            caches=self.caches)
 
 
 @injection
-def rpc_proxy(service_name):
-    return DependencyFactory(RpcProxyProvider, service_name)
+def rpc_proxy(service_name, timeout=None, coalesce=False, cache=None):
+    """ Inject a proxy for making RPC calls to ``service_name``.
+
+    If ``timeout`` is given, calls raise
+    :class:`~nameko.exceptions.DeadlineExceeded` if no reply arrives within
+    ``timeout`` seconds. The deadline is propagated to the callee, which
+    discards the call if it expires before a worker is spawned, and to any
+    calls the callee makes in turn.
+
+    Calls made by a worker that has a deadline itself inherit the remaining
+    time, whether or not ``timeout`` is given.
+
+    If ``coalesce`` is True, concurrent calls from this container to the same
+    method with the same arguments share a single request; every caller
+    receives its own copy of the reply. The request carries the context data
+    of the worker that made it, so only coalesce calls whose result does not
+    depend on the caller. Coalesced and other calls are counted in the
+    ``coalesce.hits`` and ``coalesce.misses`` container metrics.
+
+    ``cache`` maps the names of idempotent methods to the options of a
+    process-wide :class:`~nameko.cache.LruCache` for their results, e.g.::
+
+        config = rpc_proxy('config', cache={'get': {'ttl': 60}})
+
+    Results are cached by method and arguments, and measured against any
+    ``max_bytes`` by their size as JSON; errors are never cached. Every
+    proxy sharing a cache must give it the same options. Concurrent misses
+    for the same call share a single request. Lookups and evictions are
+    counted in the ``cache.hits``, ``cache.misses`` and ``cache.evictions``
+    container metrics. See :func:`invalidate_cache`.
+    """
+    return DependencyFactory(
+        RpcProxyProvider, service_name, timeout, coalesce, cache)
+
+
+def call_key(service_name, method_name, args, kwargs):
+    """ Return a canonical, hashable key for a call to
+    ``service_name.method_name`` with ``args`` and ``kwargs``, or None if the
+    arguments cannot be serialized.
+    """
+    try:
+        arguments = json.dumps([args, kwargs], sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    return '{}.{}:{}'.format(service_name, method_name, arguments)
+
+
+def cache_name(service_name, method_name):
+    return 'rpc:{}.{}'.format(service_name, method_name)
+
+
+def invalidate_cache(service_name, method_name, args=None, kwargs=None):
+    """ Invalidate cached results of ``service_name.method_name``.
+
+    If ``args`` or ``kwargs`` are given, only the result of the call with
+    those arguments is invalidated. Otherwise all results of the method are.
+    """
+    cache = get_shared_cache(cache_name(service_name, method_name))
+    if cache is None:
+        return
+
+    if args is None and kwargs is None:
+        cache.clear()
+    else:
+        key = call_key(service_name, method_name, args or (), kwargs or {})
+        cache.invalidate(key)
 
 
 class ServiceProxy(object):
-    def __init__(self, worker_ctx, service_name, reply_listener):
+    def __init__(self, worker_ctx, service_name, reply_listener,
+                 timeout=None, single_flight=None, caches=None):
         self.worker_ctx = worker_ctx
         self.service_name = service_name
         self.reply_listener = reply_listener
+        self.timeout = timeout
+        self.single_flight = single_flight
+        self.caches = caches or {}
 
     def __getattr__(self, name):
         return MethodProxy(
-            self.worker_ctx, self.service_name, name, self.reply_listener)
+            self.worker_ctx, self.service_name, name, self.reply_listener,
+            timeout=self.timeout, single_flight=self.single_flight,
+            cache=self.caches.get(name))
 
 
 class MethodProxy(HeaderEncoder):
 
-    def __init__(self, worker_ctx, service_name, method_name, reply_listener):
+    def __init__(self, worker_ctx, service_name, method_name, reply_listener,
+                 timeout=None, single_flight=None, cache=None):
         self.worker_ctx = worker_ctx
         self.service_name = service_name
         self.method_name = method_name
         self.reply_listener = reply_listener
+        self.timeout = timeout
+        self.single_flight = single_flight
+        self.cache = cache
+
+    def get_deadline(self):
+        """ Return the deadline for a call made now: the earlier of the
+        deadline inherited from the calling worker and this proxy's timeout.
+        """
+        deadline = self.worker_ctx.data.get(DEADLINE_KEY)
+        if self.timeout is not None:
+            own_deadline = time.time() + self.timeout
+            if deadline is None or own_deadline < deadline:
+                deadline = own_deadline
+        return deadline
 
     def __call__(self, *args, **kwargs):
+        cache = self.cache
+        single_flight = self.single_flight
+        if cache is None and single_flight is None:
+            return self._call(*args, **kwargs)
+
+        key = call_key(self.service_name, self.method_name, args, kwargs)
+        if key is None:
+            return self._call(*args, **kwargs)
+
+        metrics = self.worker_ctx.container.metrics
+        if cache is not None:
+            result = cache.get(key)
+            if result is not MISSING:
+                metrics.increment('cache.hits')
+                return copy.deepcopy(result)
+
+            metrics.increment('cache.misses')
+            return cache.single_flight.do(
+                key, self._call_and_cache, key, *args, **kwargs)
+
+        if key in single_flight:
+            metrics.increment('coalesce.hits')
+        else:
+            metrics.increment('coalesce.misses')
+        return single_flight.do(key, self._call, *args, **kwargs)
+
+    def call_async(self, *args, **kwargs):
+        """ Make the call in a new thread managed by the calling worker's
+        container, returning a :class:`~nameko.futures.GreenFuture` of its
+        result.
+
+        A standalone :class:`~nameko.standalone.rpc.RpcProxy` makes the call
+        in a plain greenthread; as it polls for replies in the calling
+        thread, wait for each result before making the next call.
+        """
+        return spawn_future(self.worker_ctx.container, self, *args, **kwargs)
+
+    def _call_and_cache(self, key, *args, **kwargs):
+        result = self._call(*args, **kwargs)
+        evicted = self.cache.set(key, copy.deepcopy(result))
+        if evicted:
+            self.worker_ctx.container.metrics.increment(
+                'cache.evictions', evicted)
+        return result
+
+    def _call(self, *args, **kwargs):
         _log.debug('invoking %s', self,
                    extra=self.worker_ctx.extra_for_logging)
 
         worker_ctx = self.worker_ctx
         container = worker_ctx.container
 
+        deadline = self.get_deadline()
+        if deadline is not None and deadline <= time.time():
+            raise DeadlineExceeded(
+                'deadline passed before calling {}'.format(self))
+
         msg = {'args': args, 'kwargs': kwargs}
 
         conn = Connection(container.config[AMQP_URI_CONFIG_KEY])
@@ -304,6 +545,8 @@ class MethodProxy(HeaderEncoder):
             #      should that be an option in __init__?
 
             headers = self.get_message_headers(worker_ctx)
+            if deadline is not None:
+                headers[self._get_header_name(DEADLINE_KEY)] = deadline
             correlation_id = str(uuid.uuid4())
 
             reply_listener = self.reply_listener
@@ -321,7 +564,11 @@ class MethodProxy(HeaderEncoder):
 
         _log.debug('Waiting for RPC reply event %s', self,
                    extra=worker_ctx.extra_for_logging)
-        resp_body = reply_event.wait()
+        if deadline is None:
+            resp_body = reply_event.wait()
+        else:
+            resp_body = reply_listener.wait_for_reply(
+                correlation_id, reply_event, max(deadline - time.time(), 0))
         _log.debug('RPC reply event complete %s %s', self, resp_body,
                    extra=worker_ctx.extra_for_logging)
 
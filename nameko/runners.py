@@ -60,13 +60,18 @@ class ServiceRunner(object):
 
         All containers are started concurently and the method will block
         until all have completed their startup routine.
+
+        Returns what each container's ``start`` returned, keyed by service
+        name; for a :class:`ServiceContainer` that is its startup report.
         """
         _log.info('starting services: %s', self.service_names)
 
-        SpawningProxy(self.containers).start()
+        reports = SpawningProxy(self.containers).start() or []
 
         _log.info('services started: %s', self.service_names)
 
+        return dict(zip(self.service_names, reports))
+
     def stop(self):
         """ Stop all running containers concurrently.
         The method blocks until all containers have stopped.
@@ -87,6 +92,15 @@ class ServiceRunner(object):
 
         _log.info('services killed: %s ', self.service_names)
 
+    def metrics_snapshot(self):
+        """ Return a snapshot of the metrics of every hosted service, keyed
+        by service name.
+
+        See :mod:`nameko.metrics`.
+        """
+        return {service_name: container.metrics_snapshot()
+                for service_name, container in self.service_map.items()}
+
     def wait(self):
         """ Wait for all running containers to stop.
         """
@@ -4,8 +4,8 @@ from kombu.common import maybe_declare
 from kombu.pools import producers, connections
 from kombu import Connection
 
-from nameko.events import get_event_exchange
-from nameko.messaging import AMQP_URI_CONFIG_KEY
+from nameko.events import get_event_exchange, get_event_headers
+from nameko.messaging import AMQP_URI_CONFIG_KEY, new_message_id
 
 
 @contextmanager
@@ -28,6 +28,8 @@ def event_dispatcher(container_service_name, nameko_config):
                 msg = evt.data
                 routing_key = evt.type
                 producer.publish(msg, exchange=exchange,
-                                 routing_key=routing_key)
+                                 headers=get_event_headers({}, evt),
+                                 routing_key=routing_key,
+                                 message_id=new_message_id())
 
             yield dispatch
@@ -1,9 +1,12 @@
 from __future__ import absolute_import
+import socket
+import time
 
 from kombu import Connection
 from kombu.common import itermessages, maybe_declare
 
 from nameko.containers import WorkerContext
+from nameko.exceptions import DeadlineExceeded
 from nameko.rpc import ServiceProxy, ReplyListener
 
 
@@ -17,7 +20,7 @@ class ConsumeEvent(object):
     def send(self, body):
         self.body = body
 
-    def wait(self):
+    def wait(self, timeout=None):
         """ Makes a blocking call to its queue_consumer until the message
         with the given correlation_id has been processed.
 
@@ -25,9 +28,10 @@ class ConsumeEvent(object):
         with the body of the received message
         (see :class:nameko.rpc.ReplyListener.handle_message).
 
-        Exceptions are raised directly.
+        Exceptions are raised directly, including ``socket.timeout`` if
+        ``timeout`` is given and no message arrives in time.
         """
-        self.queue_consumer.poll_messages(self.correlation_id)
+        self.queue_consumer.poll_messages(self.correlation_id, timeout)
         return self.body
 
 
@@ -50,15 +54,42 @@ class PollingQueueConsumer(object):
     def ack_message(self, msg):
         msg.ack()
 
-    def poll_messages(self, correlation_id):
+    def poll_messages(self, correlation_id, timeout=None):
         channel = self.channel
-        conn = channel.connection
 
+        if timeout is not None:
+            return self._poll_messages_until(
+                correlation_id, time.time() + timeout)
+
+        conn = channel.connection
         for body, msg in itermessages(conn, channel, self.queue, limit=None):
             if correlation_id == msg.properties.get('correlation_id'):
                 self.provider.handle_message(body, msg)
                 break
 
+    def _poll_messages_until(self, correlation_id, deadline):
+        # ``itermessages`` swallows timeouts, so drain events ourselves
+        received = []
+
+        def on_message(body, msg):
+            received.append((body, msg))
+
+        consumer = self.connection.Consumer(
+            queues=[self.queue], channel=self.channel, callbacks=[on_message])
+
+        with consumer:
+            while True:
+                while received:
+                    body, msg = received.pop(0)
+                    if correlation_id == msg.properties.get('correlation_id'):
+                        self.provider.handle_message(body, msg)
+                        return
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout()
+                self.connection.drain_events(timeout=remaining)
+
 
 class SingleThreadedReplyListener(ReplyListener):
     """ A ReplyListener which uses a custom queue consumer and ConsumeEvent.
@@ -74,6 +105,14 @@ class SingleThreadedReplyListener(ReplyListener):
         self._reply_events[correlation_id] = reply_event
         return reply_event
 
+    def wait_for_reply(self, correlation_id, reply_event, timeout):
+        try:
+            return reply_event.wait(timeout)
+        except socket.timeout:
+            self._reply_events.pop(correlation_id, None)
+            raise DeadlineExceeded(
+                'no reply within {:0.3f} sec'.format(timeout))
+
 
 class RpcProxy(object):
     """
@@ -101,6 +140,11 @@ class RpcProxy(object):
 
     If you call ``start()`` you must eventually call ``stop()`` to close the
     connection to the broker.
+
+    If ``timeout`` is given, calls raise
+    :class:`~nameko.exceptions.DeadlineExceeded` when no reply arrives within
+    ``timeout`` seconds. The deadline is propagated to the target service,
+    which discards calls that expire before they are handled.
     """
     class ServiceContainer(object):
         """ Implements a minimum interface of the
@@ -113,7 +157,7 @@ class RpcProxy(object):
             self.config = config
 
     def __init__(self, container_service_name, config, context_data=None,
-                 worker_ctx_cls=WorkerContext):
+                 worker_ctx_cls=WorkerContext, timeout=None):
 
         container = RpcProxy.ServiceContainer(config)
 
@@ -123,7 +167,7 @@ class RpcProxy(object):
         worker_ctx = worker_ctx_cls(
             container, service=None, method_name="call", data=context_data)
         service_proxy = ServiceProxy(worker_ctx, container_service_name,
-                                     reply_listener)
+                                     reply_listener, timeout=timeout)
 
         self._reply_listener = reply_listener
         self._service_proxy = service_proxy
@@ -0,0 +1,141 @@
+"""
+Provides an injection for running blocking calls in native threads.
+
+Eventlet's monkey patching makes the standard library cooperative, but it
+can't do anything about C extensions (database drivers, compression or image
+processing libraries, etc) or about blocking file I/O. Calling these from a
+worker freezes the eventlet hub, and with it every other greenthread in the
+process.
+
+The :func:`thread_pool` injection hands such calls to a pool of native
+threads using :mod:`eventlet.tpool`, so that only the calling greenthread
+waits for the result::
+
+    class ThumbnailService(object):
+
+        blocking = thread_pool(size=4)
+
+        @rpc
+        def thumbnail(self, path):
+            return self.blocking(make_thumbnail, path, (128, 128))
+
+The native threads are shared by the whole process and sized by eventlet
+using the ``EVENTLET_THREADPOOL_SIZE`` environment variable. The ``size`` of
+each injection bounds how many of them its service may occupy at once; any
+further calls are queued until a thread becomes available.
+"""
+from __future__ import absolute_import
+from logging import getLogger
+
+from eventlet import tpool
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
+
+from nameko.dependencies import InjectionProvider, injection, DependencyFactory
+
+_log = getLogger(__name__)
+
+# matches the default size of eventlet's native thread pool
+DEFAULT_THREADPOOL_SIZE = 20
+
+
+class ThreadPoolStopped(Exception):
+    """ Raised when a call is submitted to a stopped thread pool.
+    """
+
+
+class ThreadPoolProvider(InjectionProvider):
+    """ Injects a callable that runs ``fn(*args, **kwargs)`` in a native
+    thread and returns its result, re-raising any exception it raised.
+
+    At most ``size`` calls run concurrently. The number of running and queued
+    calls is available through :attr:`stats`.
+    """
+    def __init__(self, size=None, config_key=None):
+        self._default_size = size
+        self.config_key = config_key
+        self.size = None
+
+        self.active = 0
+        self.queued = 0
+        self.completed = 0
+
+        self._semaphore = None
+        self._stopping = False
+        self._idle = Event()
+
+    def prepare(self):
+        size = self._default_size
+
+        if self.config_key:
+            config = self.container.config
+            size = config.get(self.config_key, size)
+
+        if size is None:
+            size = DEFAULT_THREADPOOL_SIZE
+
+        self.size = size
+        self._semaphore = Semaphore(size)
+
+    def stop(self):
+        """ Refuse any new calls and wait for pending ones to complete.
+
+        Native threads can't be interrupted, so there's no equivalent
+        ``kill()``; their results are simply discarded.
+        """
+        _log.debug('stopping %s', self)
+        self._stopping = True
+
+        if self.active + self.queued:
+            _log.debug('waiting for %d blocking call(s) %s',
+                       self.active + self.queued, self)
+            self._idle.wait()
+
+    @property
+    def stats(self):
+        """ A snapshot of the pool's utilisation.
+        """
+        return {
+            'size': self.size,
+            'active': self.active,
+            'queued': self.queued,
+            'completed': self.completed,
+        }
+
+    def execute(self, fn, *args, **kwargs):
+        """ Run ``fn(*args, **kwargs)`` in a native thread, blocking only the
+        calling greenthread until it returns.
+        """
+        if self._stopping:
+            raise ThreadPoolStopped('cannot execute calls after stop')
+
+        self.queued += 1
+        try:
+            self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        self.active += 1
+        try:
+            return tpool.execute(fn, *args, **kwargs)
+        finally:
+            self.active -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+            if self._stopping and not self.active + self.queued:
+                if not self._idle.ready():
+                    self._idle.send(None)
+
+    def acquire_injection(self, worker_ctx):
+        return self.execute
+
+
+@injection
+def thread_pool(size=None, config_key=None):
+    """ Inject a callable for running blocking calls in native threads.
+
+    ``size`` limits the number of concurrent calls. If ``config_key`` is
+    given, the value for that key in the config is used instead.
+    """
+    return DependencyFactory(ThreadPoolProvider, size, config_key)
@@ -1,18 +1,41 @@
 from __future__ import absolute_import
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count
 from logging import getLogger
+import math
+import random
 import time
 
+import eventlet
 from eventlet import Timeout
 from eventlet.event import Event
+from kombu import Connection, Exchange, Queue
 
 from nameko.dependencies import (
-    entrypoint, EntrypointProvider, DependencyFactory)
+    entrypoint, dependency, EntrypointProvider, DependencyProvider,
+    DependencyFactory, ProviderCollector, CONTAINER_SHARED)
+from nameko.messaging import AMQP_URI_CONFIG_KEY
 
 _log = getLogger(__name__)
 
 
+FIXED_RATE = 'fixed_rate'
+FIXED_DELAY = 'fixed_delay'
+
+LEASE_EXCHANGE = 'nameko-leases'
+
+NOT_FOUND = 404
+
+LEASE_RENEW_INTERVAL_CONFIG_KEY = 'TIMER_LEASE_RENEW_INTERVAL'
+DEFAULT_LEASE_RENEW_INTERVAL = 5
+
+_scheduler = None
+
+
 @entrypoint
-def timer(interval=None, config_key=None):
+def timer(interval=None, config_key=None, mode=FIXED_RATE, overlap=True,
+          jitter=0, singleton=False):
     '''
     Decorates a method as a timer, which will be called every `interval` sec.
 
@@ -20,6 +43,24 @@ def timer(interval=None, config_key=None):
     If the `config_key` is given the value for that key in the config will be
     used as the interval otherwise the `interval` provided will be used.
 
+    With the default `mode` of ``FIXED_RATE``, the timer fires every
+    `interval` seconds from when the container starts, regardless of how
+    long each worker runs; fires missed while the process was busy, or
+    while the container's worker pool was full, are skipped rather than
+    run late. With ``FIXED_DELAY``, the timer fires
+    `interval` seconds after the previous worker has completed.
+
+    All the timers in a process are fired from a single greenthread; see
+    :class:`TimerScheduler`. Each fire is handled in a managed thread of the
+    timer's container, so a busy container only holds up its own timers.
+
+    If `overlap` is False, a fire is skipped while the previous worker is
+    still running. Each fire is delayed by up to `jitter` seconds, at random,
+    to spread the load of timers with the same interval.
+
+    If `singleton` is True, only one running container of the service
+    spawns workers when the timer fires; see :class:`LeaderElection`.
+
     Example::
 
         class Foobar(object):
@@ -28,15 +69,249 @@ def timer(interval=None, config_key=None):
             def handle_timer(self):
                 self.shrub(body)
     '''
-    return DependencyFactory(TimerProvider, interval, config_key)
+    return DependencyFactory(
+        TimerProvider, interval, config_key, mode, overlap, jitter,
+        singleton)
+
+
+def get_scheduler():
+    """ Return the process-wide :class:`TimerScheduler`.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = TimerScheduler()
+    return _scheduler
+
+
+class TimerScheduler(object):
+    """ Fires timers from a single greenthread, in order of when they are
+    next due.
+
+    Timers are kept in a heap. The greenthread sleeps until the earliest is
+    due, or until a timer is scheduled earlier, and exits when no timers are
+    scheduled. ``timer.fire()`` must not block, or it holds up every timer
+    in the process.
+    """
+    def __init__(self):
+        self._heap = []
+        self._counter = count()
+        # the sequence number of each timer's current heap entry; other
+        # entries for the timer are stale
+        self._entries = {}
+        self._wakeup = Event()
+        self._gt = None
+
+    def __contains__(self, timer):
+        return timer in self._entries
+
+    def schedule(self, timer, due):
+        """ Schedule ``timer`` to fire at ``due``, replacing any previous
+        schedule. The scheduler calls ``timer.fire()``.
+        """
+        seq = next(self._counter)
+        self._entries[timer] = seq
+        heappush(self._heap, (due, seq, timer))
+
+        if self._gt is None or self._gt.dead:
+            self._gt = eventlet.spawn(self._run)
+        elif self._heap[0][1] == seq:
+            self._wake()
+
+    def cancel(self, timer):
+        if self._entries.pop(timer, None) is not None:
+            self._wake()
+
+    def _wake(self):
+        if not self._wakeup.ready():
+            self._wakeup.send()
+
+    def _wait(self, delay):
+        with Timeout(delay, False):
+            self._wakeup.wait()
+        if self._wakeup.ready():
+            self._wakeup = Event()
+
+    def _run(self):
+        heap = self._heap
+        while self._entries:
+            due, seq, timer = heap[0]
+            if self._entries.get(timer) != seq:
+                heappop(heap)
+                continue
+
+            delay = due - time.time()
+            if delay > 0:
+                self._wait(delay)
+                continue
+
+            heappop(heap)
+            del self._entries[timer]
+            try:
+                timer.fire()
+            except Exception:
+                _log.exception('error firing %s', timer)
+
+            # let other greenthreads run between fires
+            eventlet.sleep()
+
+        del heap[:]
+        self._gt = None
+
+
+@dependency
+def leader_election():
+    return DependencyFactory(LeaderElection)
+
+
+class LeaderElection(DependencyProvider, ProviderCollector):
+    """ Elects one running container of a service as its leader.
+
+    The leader holds a lease: an exclusive, auto-delete queue named after
+    the service, declared on a connection that stays open while the
+    container runs. The broker deletes the queue as soon as the leader's
+    connection closes, and the leader deletes it when it stops, so another
+    container takes over the next time it calls :meth:`claim`.
+
+    While singleton timers are registered, the lease is claimed and renewed
+    every ``TIMER_LEASE_RENEW_INTERVAL`` seconds in a managed thread, and
+    timers check the result with :meth:`leading`, without a round trip to
+    the broker on every fire.
+    """
+    def __init__(self):
+        super(LeaderElection, self).__init__()
+        self._connection = None
+        self._channel = None
+        self._renewer = None
+        self._claimed = Event()
+
+    @property
+    def lease_queue(self):
+        name = 'timer-leader-{}'.format(self.container.service_name)
+        exchange = Exchange(LEASE_EXCHANGE, type='direct', durable=True)
+        return Queue(name, exchange=exchange, routing_key=name,
+                     exclusive=True, auto_delete=True)
+
+    @property
+    def is_leader(self):
+        return self._connection is not None
+
+    @property
+    def renew_interval(self):
+        return self.container.config.get(
+            LEASE_RENEW_INTERVAL_CONFIG_KEY, DEFAULT_LEASE_RENEW_INTERVAL)
+
+    def register_provider(self, provider):
+        super(LeaderElection, self).register_provider(provider)
+        if self._renewer is None:
+            self._claimed = Event()
+            self._renewer = self.container.spawn_managed_thread(
+                self._renew_forever)
+
+    def leading(self):
+        """ Return whether this container held the lease when it was last
+        claimed, waiting for the first claim.
+        """
+        self._claimed.wait()
+        return self.is_leader
+
+    def _renew_forever(self):
+        while True:
+            self.claim()
+            if not self._claimed.ready():
+                self._claimed.send()
+            eventlet.sleep(self.renew_interval)
+
+    def claim(self):
+        """ Return whether this container is the leader, taking the lease
+        if it's free.
+        """
+        if self._connection is not None:
+            errors = (self._connection.connection_errors +
+                      self._connection.channel_errors)
+            try:
+                self._channel.queue_declare(
+                    self.lease_queue.name, passive=True)
+                return True
+            except errors:
+                _log.warning('%s lost the lease', self)
+                self.release()
+
+        connection = Connection(self.container.config[AMQP_URI_CONFIG_KEY])
+        try:
+            if self._take_lease(connection):
+                _log.info('%s is the leader', self)
+                return True
+        except connection.connection_errors + connection.channel_errors:
+            _log.warning('%s failed to claim the lease', self, exc_info=True)
+
+        connection.release()
+        return False
+
+    def _take_lease(self, connection):
+        queue = self.lease_queue
+        channel = connection.channel()
+        try:
+            channel.queue_declare(queue.name, passive=True)
+            # held by another container
+            return False
+        except connection.channel_errors as exc:
+            # the broker refuses access to another connection's exclusive
+            # queue; any error other than not found means it's held
+            if int(exc.reply_code) != NOT_FOUND:
+                return False
+
+        # the failed declaration closed the channel
+        channel = connection.channel()
+        queue(channel).declare()
+        self._connection = connection
+        self._channel = channel
+        return True
+
+    def release(self):
+        """ Give up the lease, if held.
+        """
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+
+        try:
+            self._channel.queue_delete(self.lease_queue.name)
+        except connection.connection_errors + connection.channel_errors:
+            pass
+        finally:
+            connection.release()
+
+    def _stop_renewing(self):
+        renewer, self._renewer = self._renewer, None
+        if renewer is not None:
+            renewer.kill()
+
+    def stop(self):
+        self.wait_for_providers()
+        self._stop_renewing()
+        self.release()
+
+    def kill(self, exc=None):
+        self._stop_renewing()
+        self.release()
 
 
 class TimerProvider(EntrypointProvider):
-    def __init__(self, interval, config_key):
+
+    leader_election = leader_election(shared=CONTAINER_SHARED)
+
+    def __init__(self, interval, config_key, mode=FIXED_RATE, overlap=True,
+                 jitter=0, singleton=False):
         self._default_interval = interval
         self.config_key = config_key
-        self.should_stop = Event()
-        self.gt = None
+        self.mode = mode
+        self.overlap = overlap
+        self.jitter = jitter
+        self.singleton = singleton
+        self.running = 0
+        self.stopped = False
+        self._next_fire = None
+        self._pending_tick = False
 
     def prepare(self):
         interval = self._default_interval
@@ -49,44 +324,109 @@ class TimerProvider(EntrypointProvider):
 
     def start(self):
         _log.debug('starting %s', self)
-        self.gt = self.container.spawn_managed_thread(self._run)
+        self.register()
+        self.schedule(time.time())
 
     def stop(self):
         _log.debug('stopping %s', self)
-        self.should_stop.send(True)
-        self.gt.wait()
+        self.cancel()
+        if self.singleton:
+            self.leader_election.unregister_provider(self)
 
     def kill(self, exc):
         _log.debug('killing %s', self)
-        self.gt.kill()
+        self.cancel()
 
-    def _run(self):
-        ''' Runs the interval loop.
+    def register(self):
+        self.stopped = False
+        if self.singleton:
+            self.leader_election.register_provider(self)
 
-        This should not be called directly, rather the `start()` method
-        should be used.
+    def cancel(self):
+        self.stopped = True
+        get_scheduler().cancel(self)
+
+    def schedule(self, fire_at):
+        ''' Schedule the next fire at `fire_at`, plus jitter.
         '''
-        while not self.should_stop.ready():
-            start = time.time()
+        if self.stopped:
+            return
 
-            self.handle_timer_tick()
+        self._next_fire = fire_at
+        due = fire_at
+        if self.jitter:
+            due += random.uniform(0, self.jitter)
+        get_scheduler().schedule(self, due)
 
-            elapsed_time = (time.time() - start)
-            sleep_time = max(self.interval - elapsed_time, 0)
-            self._sleep_or_stop(sleep_time)
+    def fire(self):
+        ''' Called by the scheduler when the timer is due.
+        '''
+        self.tick()
 
-    def _sleep_or_stop(self, sleep_time):
-        ''' Sleeps for `sleep_time` seconds or until a `should_stop` event
-        has been fired, whichever comes first.
+        if self.mode == FIXED_RATE:
+            # fire relative to when the timer was due rather than when it
+            # fired, so that delays don't accumulate
+            next_fire = self._next_fire + self.interval
+            now = time.time()
+            if next_fire < now and self.interval > 0:
+                missed = int(math.ceil(
+                    float(now - next_fire) / self.interval))
+                self.container.metrics.increment('timer.missed', missed)
+                next_fire += missed * self.interval
+            self.schedule(next_fire)
+
+    def tick(self):
+        ''' Handle a tick in a managed thread of the container, so that a
+        full worker pool doesn't hold up the scheduler.
+
+        At most one tick per timer waits for a worker to be spawned; fires
+        while it waits are counted as missed, as if the scheduler had been
+        held up.
         '''
-        try:
-            with Timeout(sleep_time):
-                self.should_stop.wait()
-        except Timeout:
-            # we use the timeout as a cancellable sleep
-            pass
+        if self._pending_tick:
+            _log.debug('skipping fire of %s; previous fire pending', self)
+            self.container.metrics.increment('timer.missed')
+            return
+
+        self._pending_tick = True
+        self.container.spawn_managed_thread(self.handle_timer_tick)
 
     def handle_timer_tick(self):
+        try:
+            self.run_worker()
+        finally:
+            self._pending_tick = False
+            # also when no worker ran, or the worker was killed
+            if self.mode == FIXED_DELAY:
+                self.schedule(time.time() + self.interval)
+
+    def run_worker(self):
+        ''' Spawn a worker for the tick, and wait for it to complete.
+        '''
+        if self.stopped:
+            return
+
+        if self.singleton and not self.leader_election.leading():
+            _log.debug('skipping fire of %s; not the leader', self)
+            return
+
+        if self.running and not self.overlap:
+            _log.debug('skipping fire of %s; previous worker running', self)
+            self.container.metrics.increment('timer.skipped')
+            return
+
         args = tuple()
         kwargs = {}
-        self.container.spawn_worker(self, args, kwargs)
+        finished = Event()
+        self.running += 1
+        try:
+            self.container.spawn_worker(
+                self, args, kwargs,
+                handle_result=partial(self.handle_result, finished))
+            self._pending_tick = False
+            finished.wait()
+        finally:
+            self.running -= 1
+
+    def handle_result(self, finished, worker_ctx, result=None, exc=None):
+        finished.send()
@@ -1,5 +1,10 @@
+from collections import MutableSet
+import copy
 import functools
+import sys
+
 import eventlet
+from eventlet.event import Event
 from eventlet.queue import LightQueue
 
 
@@ -87,6 +92,93 @@ class SpawningSet(set):
         return SpawningProxy(self)
 
 
+class OrderedSpawningSet(MutableSet):
+    """ A :class:`SpawningSet` that iterates in the order items were added,
+    and can be indexed by position.
+    """
+    def __init__(self, items=()):
+        self._items = []
+        self._members = set()
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return item in self._members
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self._items)
+
+    def add(self, item):
+        if item not in self._members:
+            self._members.add(item)
+            self._items.append(item)
+
+    def discard(self, item):
+        if item in self._members:
+            self._members.remove(item)
+            self._items.remove(item)
+
+    @property
+    def all(self):
+        return SpawningProxy(self)
+
+
+class SingleFlight(object):
+    """ Coalesces concurrent calls that share a key.
+
+    The first caller for a key makes the call; callers arriving with the
+    same key while it is in flight wait for it to complete and receive a
+    copy of its result, or of the exception it raised. Once the call
+    completes the key is forgotten, so results are never cached.
+    """
+    def __init__(self):
+        self._calls = {}
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def do(self, key, fn, *args, **kwargs):
+        """ Call ``fn(*args, **kwargs)`` unless a call for ``key`` is
+        already in flight, in which case wait for and share its outcome.
+        """
+        event = self._calls.get(key)
+        if event is not None:
+            result, exc = event.wait()
+            if exc is not None:
+                raise _copy_exception(exc)
+            return copy.deepcopy(result)
+
+        event = self._calls[key] = Event()
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            event.send((None, sys.exc_info()[1]))
+            raise
+        else:
+            event.send((result, None))
+            return result
+        finally:
+            del self._calls[key]
+
+
+def _copy_exception(exc):
+    """ Return a copy of ``exc``, or ``exc`` itself if it can't be copied.
+    """
+    try:
+        return copy.copy(exc)
+    except Exception:
+        return exc
+
+
 def try_wraps(func):
     """Marks a function as wrapping another one using `functools.wraps`, but
     fails unobtrusively when this isn't possible"""
@@ -1,6 +1,6 @@
 import eventlet
 import itertools
-from mock import patch
+from mock import Mock, patch
 
 eventlet.monkey_patch()
 
@@ -12,6 +12,7 @@ from pyrabbit.api import Client
 import pytest
 
 from nameko.containers import ServiceContainer, WorkerContext
+from nameko.metrics import ContainerMetrics
 from nameko.runners import ServiceRunner
 
 
@@ -62,11 +63,40 @@ def reset_kombu_pools(request):
     reset()
 
 
+@pytest.fixture(autouse=True)
+def reset_shared_caches(request):
+    from nameko.cache import reset
+    reset()
+
+
+@pytest.fixture(autouse=True)
+def reset_broadcast_handlers(request):
+    from nameko.events import reset_broadcast_handlers
+    reset_broadcast_handlers()
+
+
 @pytest.fixture
 def empty_config(request):
     return {}
 
 
+@pytest.fixture
+def mock_container(request):
+    """ Return a function making a mock container for a provider to bind
+    to, with real metrics and managed threads spawned as greenthreads.
+    """
+    def make_container(service_name="destservice", config=None):
+        container = Mock(spec=ServiceContainer)
+        container.service_name = service_name
+        container.config = config if config is not None else {}
+        container.metrics = ContainerMetrics()
+        container.worker_ctx_cls = WorkerContext
+        container.spawn_managed_thread.side_effect = (
+            lambda run, protected=False: eventlet.spawn(run))
+        return container
+    return make_container
+
+
 @pytest.fixture(scope='session')
 def rabbit_manager(request):
     config = request.config
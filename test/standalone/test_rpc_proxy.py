@@ -62,6 +62,17 @@ def test_proxy(container_factory, rabbit_config):
         assert foo.spam(ham='eggs') == 'eggs'  # test re-use
 
 
+def test_proxy_call_async(container_factory, rabbit_config):
+
+    container = container_factory(FooService, rabbit_config)
+    container.start()
+
+    with RpcProxy('foobar', rabbit_config) as foo:
+        assert foo.spam.call_async(ham='eggs').result() == 'eggs'
+        with pytest.raises(RemoteError):
+            foo.broken.call_async().result()
+
+
 def test_proxy_manual_start_stop(container_factory, rabbit_config):
 
     container = container_factory(FooService, rabbit_config)
@@ -0,0 +1,189 @@
+import eventlet
+from mock import Mock, patch, call
+import pytest
+
+from nameko.aggregation import (
+    window_handler, WindowedEventHandler, Window, append, DEFAULT_MAX_PENDING)
+from nameko.containers import WorkerContext, ServiceContainer
+from nameko.dependencies import ENTRYPOINT_PROVIDERS_ATTR
+from nameko.events import (
+    EventHandlerConfigurationError, BROADCAST, PARTITIONED, SERVICE_POOL,
+    event_handler)
+from nameko.messaging import QueueConsumer
+
+
+@pytest.fixture
+def handler_factory(mock_container):
+
+    def make_handler(size=60, slide=None, aggregate=append, initial=list,
+                     requeue_on_error=False):
+        handler = WindowedEventHandler(
+            "srcservice", "eventtype", SERVICE_POOL, True, requeue_on_error,
+            size, slide, aggregate, initial, 1000)
+        handler.queue_consumer = Mock()
+        handler.bind("foobar", mock_container())
+        handler.prepare()
+        return handler
+    return make_handler
+
+
+@pytest.yield_fixture
+def clock():
+    with patch('nameko.aggregation.time') as time:
+        time.time.return_value = 1000
+        yield time
+
+
+def windows_handled(handler):
+    return [args[1][0]
+            for args, _ in handler.container.spawn_worker.call_args_list]
+
+
+def handle_window(handler, window, exc=None):
+    for args, kwargs in handler.container.spawn_worker.call_args_list:
+        if args[1][0] is window:
+            kwargs['handle_result'](Mock(), None, exc)
+
+
+def test_window_handler_decorator():
+    decorator = window_handler("srcservice", "eventtype", size=60)
+    handler = decorator(lambda: None)
+    descr = list(getattr(handler, ENTRYPOINT_PROVIDERS_ATTR))[0]
+    assert descr.dep_cls is WindowedEventHandler
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'handler_type': BROADCAST},
+    {'handler_type': PARTITIONED},
+    {'slide': 0},
+    {'slide': 120},
+])
+def test_window_handler_config_error(kwargs):
+    with pytest.raises(EventHandlerConfigurationError):
+        @window_handler("srcservice", "eventtype", size=60, **kwargs)
+        def handle(self, window):
+            pass
+
+
+def test_window_starts(handler_factory):
+    tumbling = handler_factory(size=60)
+    assert tumbling.window_starts(1000) == [960]
+    assert tumbling.window_starts(1020) == [1020]
+
+    sliding = handler_factory(size=60, slide=20)
+    assert sliding.window_starts(1000) == [1000, 980, 960]
+    assert sliding.window_starts(1019) == [1000, 980, 960]
+
+
+def test_tumbling_window(handler_factory, clock):
+    handler = handler_factory(size=0.01, aggregate=lambda n, data: n + data,
+                              initial=int)
+    clock.time.return_value = 1000
+
+    messages = [Mock(headers={}) for _ in range(3)]
+    for message in messages:
+        handler.handle_message(2, message)
+    assert not handler.container.spawn_worker.called
+
+    clock.time.return_value = 1000.01
+    eventlet.sleep(0.01)
+    window, = windows_handled(handler)
+    assert (window.start, window.end) == (1000, 1000.01)
+    assert (window.value, window.count) == (6, 3)
+
+    # messages are acked once their window has been handled
+    assert not handler.queue_consumer.ack_message.called
+    handle_window(handler, window)
+    assert handler.queue_consumer.ack_message.call_args_list == [
+        call(message) for message in messages]
+
+
+def test_sliding_window(handler_factory, clock):
+    handler = handler_factory(size=60, slide=30, requeue_on_error=True)
+
+    first, second = Mock(headers={}), Mock(headers={})
+    clock.time.return_value = 1000
+    handler.handle_message("first", first)
+    clock.time.return_value = 1030
+    handler.handle_message("second", second)
+
+    handler.close_window(960)
+    handler.close_window(990)
+    handler.close_window(1020)
+    early, middle, late = windows_handled(handler)
+    assert early.value == ["first"]
+    assert middle.value == ["first", "second"]
+    assert late.value == ["second"]
+
+    # each message waits for all its windows
+    handle_window(handler, early)
+    handle_window(handler, middle, exc=Exception('Error'))
+    consumer = handler.queue_consumer
+    consumer.requeue_message.assert_called_once_with(first)
+
+    handle_window(handler, late)
+    consumer.requeue_message.assert_called_with(second)
+    assert not consumer.ack_message.called
+
+
+def test_stop_closes_windows(handler_factory):
+    handler = handler_factory(size=60)
+    handler.handle_message("data", Mock(headers={}))
+    (timer, _), = handler._timers.values()
+
+    # the window's timer closes it and exits, rather than being killed
+    handler.stop()
+    window, = windows_handled(handler)
+    assert isinstance(window, Window)
+    assert window.value == ["data"]
+    assert timer.dead
+    timer.wait()
+
+
+def test_kill_discards_windows(handler_factory):
+    handler = handler_factory(size=60)
+    handler.handle_message("data", Mock(headers={}))
+    (timer, _), = handler._timers.values()
+
+    handler.kill()
+    timer.wait()
+    assert windows_handled(handler) == []
+
+
+def test_prefetch_count(handler_factory):
+    handler = handler_factory()
+
+    queue_consumer = QueueConsumer()
+    queue_consumer.container = Mock(max_workers=10)
+    assert queue_consumer._prefetch_count == 10
+
+    queue_consumer._providers.add(handler)
+    assert queue_consumer._prefetch_count == 1000
+
+
+def test_own_queue_consumer():
+
+    class Service(object):
+
+        @window_handler("srcservice", "eventtype", size=60)
+        def aggregate(self, window):
+            pass
+
+        @event_handler("srcservice", "eventtype")
+        def handle(self, data):
+            pass
+
+    config = {'AMQP_URI': 'memory://'}
+    container = ServiceContainer(Service, WorkerContext, config)
+    windowed, = [provider for provider in container.entrypoints
+                 if isinstance(provider, WindowedEventHandler)]
+    handler, = [provider for provider in container.entrypoints
+                if provider is not windowed]
+    assert windowed.queue_consumer is not handler.queue_consumer
+
+    for provider in container.entrypoints:
+        provider.queue_consumer.register_provider(provider)
+
+    # the windowed handler's prefetch limit doesn't apply to other consumers
+    assert windowed.queue_consumer._prefetch_count == DEFAULT_MAX_PENDING
+    assert handler.queue_consumer._prefetch_count == 10
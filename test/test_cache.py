@@ -0,0 +1,124 @@
+import time
+
+from mock import patch
+import pytest
+
+from nameko.cache import (
+    LruCache, shared_cache, get_shared_cache, json_size, reset, MISSING)
+
+
+def test_get_and_set():
+    cache = LruCache()
+    assert cache.get('key') is MISSING
+    assert cache.get('key', None) is None
+
+    assert cache.set('key', 'value') == 0
+    assert cache.get('key') == 'value'
+    assert len(cache) == 1
+
+    cache.invalidate('key')
+    cache.invalidate('unknown')
+    assert cache.get('key') is MISSING
+
+    assert cache.stats == {
+        'size': 0, 'bytes': 0, 'hits': 1, 'misses': 3, 'evictions': 0}
+
+
+def test_eviction():
+    cache = LruCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    # looking up 'a' makes 'b' the least recently used
+    assert cache.get('a') == 1
+    assert cache.set('c', 3) == 1
+
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.evictions == 1
+
+
+def test_byte_limit():
+    cache = LruCache(max_bytes=10)
+    cache.set('a', 'x' * 4)
+    cache.set('b', 'x' * 4)
+    assert cache.bytes == 8
+
+    assert cache.set('c', 'x' * 4) == 1
+    assert cache.get('a') is MISSING
+    assert cache.bytes == 8
+
+    # replacing a value accounts for the size of the old one
+    assert cache.set('b', 'x' * 6) == 0
+    assert cache.bytes == 10
+
+    # values that can never fit are not cached
+    assert cache.set('d', 'x' * 11) == 0
+    assert cache.get('d') is MISSING
+    assert cache.bytes == 10
+
+    cache.invalidate('b')
+    assert cache.bytes == 4
+    cache.clear()
+    assert cache.bytes == 0
+
+
+def test_custom_sizeof():
+    cache = LruCache(max_bytes=10, sizeof=lambda value: value)
+    cache.set('a', 6)
+    cache.set('b', 6)
+    assert cache.get('a') is MISSING
+    assert cache.bytes == 6
+
+
+def test_json_size():
+    cache = LruCache(max_bytes=10, sizeof=json_size)
+    cache.set('a', {'n': 1})
+    assert cache.bytes == 8
+    assert cache.set('b', None) == 1
+    assert cache.bytes == 4
+
+    # values that can't be serialized take no space
+    assert json_size(object()) == 0
+
+
+def test_expiry():
+    cache = LruCache(ttl=10)
+    now = time.time()
+
+    with patch('nameko.cache.time') as mock_time:
+        mock_time.time.return_value = now
+        cache.set('key', 'value')
+
+        mock_time.time.return_value = now + 9
+        assert cache.get('key') == 'value'
+
+        mock_time.time.return_value = now + 10
+        assert cache.get('key') is MISSING
+        assert len(cache) == 0
+
+
+def test_clear():
+    cache = LruCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_shared_cache():
+    assert get_shared_cache('spam') is None
+
+    cache = shared_cache('spam', max_size=5)
+    assert cache.max_size == 5
+    assert get_shared_cache('spam') is cache
+
+    # the cache is shared only by users that agree on its options
+    assert shared_cache('spam', max_size=5) is cache
+    with pytest.raises(ValueError):
+        shared_cache('spam', max_size=10)
+    assert cache.max_size == 5
+
+    reset()
+    assert get_shared_cache('spam') is None
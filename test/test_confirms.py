@@ -0,0 +1,240 @@
+from collections import defaultdict
+import socket
+
+import eventlet
+from mock import patch, Mock, call, ANY
+import pytest
+
+from nameko.confirms import Confirmer
+from nameko.containers import ServiceContainer, WorkerContext
+from nameko.exceptions import PublishNotConfirmed
+from nameko.messaging import PublishProvider
+from nameko.metrics import ContainerMetrics
+
+
+@pytest.yield_fixture
+def channel():
+    with patch('nameko.confirms.Connection') as connection_cls:
+        connection = connection_cls.return_value
+        connection.connection_errors = (socket.error,)
+        connection.channel_errors = ()
+
+        def drain_events(timeout):
+            eventlet.sleep(0.01)
+            raise socket.timeout()
+        connection.drain_events.side_effect = drain_events
+
+        channel = connection.channel.return_value
+        channel.events = defaultdict(set)
+        yield channel
+
+
+@pytest.yield_fixture
+def producer():
+    with patch('nameko.confirms.Producer') as producer_cls:
+        yield producer_cls.return_value
+
+
+def ack(channel, delivery_tag, multiple=False):
+    for callback in channel.events['basic_ack']:
+        callback(delivery_tag, multiple)
+
+
+def nack(channel, delivery_tag, multiple=False):
+    for callback in channel.events['basic_nack']:
+        callback(delivery_tag, multiple, False)
+
+
+@pytest.yield_fixture
+def confirmer(channel, producer):
+    confirmer = Confirmer('memory://', metrics=ContainerMetrics())
+    confirmer.start(eventlet.spawn)
+    yield confirmer
+    confirmer.kill()
+
+
+def test_confirm(confirmer, channel, producer):
+    channel.confirm_select.assert_called_once_with()
+
+    pending = confirmer.publish('msg', routing_key='spam')
+    producer.publish.assert_called_once_with('msg', routing_key='spam')
+    assert not pending.confirmed
+
+    ack(channel, 1)
+    assert pending.confirmed
+    pending.wait()
+
+    metrics = confirmer.metrics
+    assert metrics.counters == {'publish.confirmed': 1}
+    assert metrics.histogram('publish.confirm_latency').count == 1
+
+
+def test_confirm_multiple(confirmer, channel):
+    pendings = [confirmer.publish(msg) for msg in ('a', 'b', 'c')]
+
+    ack(channel, 2, multiple=True)
+    assert [pending.confirmed for pending in pendings] == [True, True, False]
+
+    ack(channel, 3)
+    assert all(pending.confirmed for pending in pendings)
+
+
+def test_republish_on_nack(confirmer, channel, producer):
+    confirmer.max_republish = 1
+
+    pending = confirmer.publish('msg')
+    nack(channel, 1)
+    # published again by another thread, not by the nack callback
+    assert producer.publish.call_args_list == [call('msg')]
+    eventlet.sleep()
+    assert producer.publish.call_args_list == [call('msg'), call('msg')]
+    assert not pending.confirmed
+
+    # the republished message has a new delivery tag
+    nack(channel, 2)
+    with pytest.raises(PublishNotConfirmed):
+        pending.wait()
+
+    assert confirmer.metrics.counters == {
+        'publish.republished': 1, 'publish.failed': 1}
+
+
+def test_publish_failure(confirmer, channel, producer):
+    producer.publish.side_effect = [
+        None, TypeError('not serializable'), None]
+    unconfirmed = confirmer.publish('msg')
+
+    with pytest.raises(TypeError):
+        confirmer.publish(object())
+    assert confirmer.outstanding == 0
+
+    # the channel is reopened, since the broker may have numbered the
+    # failed message; messages published on the old one can't be confirmed
+    with pytest.raises(PublishNotConfirmed):
+        unconfirmed.wait()
+
+    # delivery tags start again on the new channel
+    pending = confirmer.publish('msg')
+    assert channel.confirm_select.call_count == 2
+    ack(channel, 1)
+    assert pending.confirmed
+    pending.wait(timeout=1)
+
+    with eventlet.Timeout(1):
+        confirmer.stop()
+
+
+def test_connection_lost(confirmer, channel):
+    pending = confirmer.publish('msg')
+    connection = confirmer._connection
+    drain_events = connection.drain_events.side_effect
+    errors = [socket.error('reset')]
+
+    def drop_connection(timeout):
+        if errors:
+            raise errors.pop()
+        return drain_events(timeout)
+    connection.drain_events.side_effect = drop_connection
+
+    with pytest.raises(PublishNotConfirmed):
+        pending.wait(timeout=1)
+
+    # the drainer survives, and opens a new connection
+    eventlet.sleep(0.01)
+    assert not confirmer._drainer.dead
+    assert channel.confirm_select.call_count == 2
+    assert confirmer.metrics.counters == {'publish.failed': 1}
+
+    pending = confirmer.publish('msg')
+    ack(channel, 1)
+    pending.wait(timeout=1)
+
+
+def test_stop_waits_for_republish(confirmer, channel, producer):
+    pending = confirmer.publish('msg')
+    nack(channel, 1)
+
+    gt = eventlet.spawn(confirmer.stop)
+    eventlet.sleep(0.01)
+    assert not gt.dead
+
+    ack(channel, 2)
+    gt.wait()
+    assert pending.confirmed
+
+
+def test_window(channel, producer):
+    confirmer = Confirmer('memory://', window=1)
+    confirmer.start(eventlet.spawn)
+
+    confirmer.publish('a')
+    gt = eventlet.spawn(confirmer.publish, 'b')
+    eventlet.sleep(0.01)
+    assert producer.publish.call_count == 1
+
+    ack(channel, 1)
+    gt.wait()
+    assert producer.publish.call_count == 2
+    confirmer.kill()
+
+
+def test_stop_waits_for_confirms(confirmer, channel):
+    pending = confirmer.publish('msg')
+
+    gt = eventlet.spawn(confirmer.stop)
+    eventlet.sleep(0.01)
+    assert not gt.dead
+
+    ack(channel, 1)
+    gt.wait()
+    assert pending.confirmed
+
+
+def test_kill_fails_unconfirmed(confirmer):
+    pending = confirmer.publish('msg')
+    confirmer.kill()
+
+    with pytest.raises(PublishNotConfirmed):
+        pending.wait()
+
+
+def test_wait_timeout(confirmer):
+    pending = confirmer.publish('msg')
+    with pytest.raises(eventlet.Timeout):
+        pending.wait(timeout=0.01)
+
+
+def test_publisher_wait_confirmed(channel, producer):
+    container = Mock(spec=ServiceContainer)
+    container.service_name = "srcservice"
+    container.config = {'AMQP_URI': 'memory://'}
+    container.metrics = ContainerMetrics()
+    container.spawn_managed_thread.side_effect = (
+        lambda run, protected: eventlet.spawn(run))
+
+    exchange = Mock()
+    provider = PublishProvider(exchange=exchange, confirms=True)
+    provider.bind("publish", container)
+    provider.start()
+
+    service = Mock()
+    worker_ctx = WorkerContext(container, service, "publish")
+    provider.inject(worker_ctx)
+
+    service.publish.publish_many(['a', 'b'])
+    gt = eventlet.spawn(service.publish.wait_confirmed)
+    eventlet.sleep(0.01)
+    assert not gt.dead
+
+    # confirmed messages are published on the confirm channel
+    headers = provider.get_message_headers(worker_ctx)
+    assert producer.publish.call_args_list == [
+        call(msg, exchange=exchange, headers=headers, message_id=ANY)
+        for msg in ('a', 'b')]
+
+    ack(channel, 2, multiple=True)
+    gt.wait()
+
+    # nothing left to wait for
+    service.publish.wait_confirmed()
+    provider.stop()
@@ -6,8 +6,8 @@ import pytest
 
 from nameko.containers import ServiceContainer, MAX_WORKERS_KEY, WorkerContext
 from nameko.dependencies import(
-    InjectionProvider, EntrypointProvider, entrypoint, injection,
-    DependencyFactory)
+    InjectionProvider, EntrypointProvider, DependencyProvider, entrypoint,
+    injection, dependency, DependencyFactory, CONTAINER_SHARED)
 from nameko.testing.utils import AnyInstanceOf
 
 
@@ -70,6 +70,22 @@ class CallCollectingInjectionProvider(
         return 'spam-attr'
 
 
+class CallCollectingNestedProvider(
+        CallCollectorMixin, DependencyProvider):
+    instances = set()
+
+
+@dependency
+def nested_collector():
+    return DependencyFactory(CallCollectingNestedProvider)
+
+
+class NestingInjectionProvider(CallCollectingInjectionProvider):
+    instances = set()
+
+    nested = nested_collector(shared=CONTAINER_SHARED)
+
+
 @entrypoint
 def foobar():
     return DependencyFactory(CallCollectingEntrypointProvider)
@@ -80,6 +96,11 @@ def call_collector():
     return DependencyFactory(CallCollectingInjectionProvider)
 
 
+@injection
+def nesting_collector():
+    return DependencyFactory(NestingInjectionProvider)
+
+
 egg_error = Exception('broken')
 
 
@@ -90,6 +111,7 @@ class Service(object):
 
     @foobar
     def ham(self):
+        assert self.spam == 'spam-attr'
         return 'ham'
 
     @foobar
@@ -141,6 +163,48 @@ def test_starts_dependencies(container):
         ]
 
 
+def test_prepares_nested_dependencies_last():
+
+    class NestingService(object):
+        name = 'nesting-service'
+
+        spam = nesting_collector()
+
+        @foobar
+        def ham(self):
+            pass
+
+    container = ServiceContainer(service_cls=NestingService,
+                                 worker_ctx_cls=WorkerContext,
+                                 config={})
+    container.start()
+
+    dependencies = container.dependencies
+    nested, = dependencies.nested
+    for dep in dependencies:
+        assert dep.calls == ['prepare', 'start']
+
+    providers = list(dependencies.entrypoints) + list(dependencies.injections)
+    assert len(providers) == 2
+    for dep in providers:
+        assert dep.call_ids[0] < nested.call_ids[0]
+
+
+def test_startup_report(container):
+    assert container.startup_report == {}
+
+    report = container.start()
+    assert report == container.startup_report
+    assert report['duration'] >= 0
+
+    providers = report['providers']
+    assert [times['provider'] for times in providers] == [
+        str(dep) for dep in container.dependencies]
+    for times in providers:
+        assert set(times) == {'provider', 'prepare', 'start'}
+        assert times['prepare'] >= 0 and times['start'] >= 0
+
+
 def test_stops_dependencies(container):
 
     container.stop()
@@ -174,14 +238,14 @@ def test_worker_life_cycle(container):
 
     # TODO: test handle_result callback for spawn
 
+    # injections are only acquired when first accessed, and only acquired
+    # injections are given the result
     assert spam_dep.calls == [
-        ('acquire', ham_worker_ctx),
         ('setup', ham_worker_ctx),
+        ('acquire', ham_worker_ctx),
         ('result', ham_worker_ctx, ('ham', None)),
         ('teardown', ham_worker_ctx),
-        ('acquire', egg_worker_ctx),
         ('setup', egg_worker_ctx),
-        ('result', egg_worker_ctx, (None, egg_error)),
         ('teardown', egg_worker_ctx),
     ]
 
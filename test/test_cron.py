@@ -0,0 +1,170 @@
+import calendar
+from datetime import datetime, timedelta, tzinfo
+
+import eventlet
+from mock import Mock, patch
+import pytest
+
+from nameko.containers import ServiceContainer
+from nameko.cron import (
+    cron, CronExpression, CronSchedule, CronProvider, CronError)
+from nameko.dependencies import ENTRYPOINT_PROVIDERS_ATTR
+from nameko.metrics import ContainerMetrics
+from nameko.timer import get_scheduler
+
+
+class FixedOffset(tzinfo):
+    def __init__(self, hours):
+        self.offset = timedelta(hours=hours)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+def timestamp(*args):
+    return calendar.timegm(datetime(*args).utctimetuple())
+
+
+def test_parse():
+    expr = CronExpression('*/15 9-17 1,15 jan-mar mon-fri')
+    assert expr.minutes == set([0, 15, 30, 45])
+    assert expr.hours == set(range(9, 18))
+    assert expr.days == set([1, 15])
+    assert expr.months == set([1, 2, 3])
+    assert expr.weekdays == set([1, 2, 3, 4, 5])
+
+    assert CronExpression('0 0 * * 7').weekdays == set([0])
+    assert CronExpression('5/20 * * * *').minutes == set([5, 25, 45])
+    assert CronExpression('@hourly').minutes == set([0])
+
+
+@pytest.mark.parametrize('expression', [
+    '* * * *', '60 * * * *', '* * 0 * *', '*/0 * * * *', '5-1 * * * *',
+    '* * * foo *', '@often',
+])
+def test_parse_errors(expression):
+    with pytest.raises(CronError):
+        CronExpression(expression)
+
+
+@pytest.mark.parametrize('expression, after, expected', [
+    ('30 2 * * *', (2014, 5, 1, 2, 30), (2014, 5, 2, 2, 30)),
+    ('30 2 * * *', (2014, 5, 1, 2, 29, 59), (2014, 5, 1, 2, 30)),
+    ('0 0 1 * *', (2014, 12, 15), (2015, 1, 1)),
+    ('0 12 * * sat', (2014, 5, 1), (2014, 5, 3, 12)),
+    # either the day of the month or the day of the week
+    ('0 0 13 * fri', (2014, 5, 1), (2014, 5, 2)),
+    ('0 0 13 * fri', (2014, 5, 12), (2014, 5, 13)),
+    ('0 0 29 feb *', (2014, 1, 1), (2016, 2, 29)),
+])
+def test_next_match(expression, after, expected):
+    expr = CronExpression(expression)
+    assert expr.next_match(datetime(*after)) == datetime(*expected)
+
+
+def test_never_matches():
+    with pytest.raises(CronError):
+        CronExpression('0 0 30 feb *').next_match(datetime(2014, 1, 1))
+
+
+def test_timezone():
+    schedule = CronSchedule('0 9 * * *')
+    assert schedule.next_fire(timestamp(2014, 5, 1, 12)) == timestamp(
+        2014, 5, 2, 9)
+
+    schedule = CronSchedule('0 9 * * *', FixedOffset(-5))
+    assert schedule.next_fire(timestamp(2014, 5, 1, 12)) == timestamp(
+        2014, 5, 1, 14)
+
+
+def test_daylight_saving():
+    pytz = pytest.importorskip('pytz')
+    london = pytz.timezone('Europe/London')
+
+    # 01:30 doesn't exist when the clocks go forward
+    schedule = CronSchedule('30 1 * * *', london)
+    assert schedule.next_fire(timestamp(2014, 3, 29, 12)) == timestamp(
+        2014, 3, 31, 0, 30)
+
+    # and is only fired once when they go back
+    first = schedule.next_fire(timestamp(2014, 10, 25, 12))
+    assert first == timestamp(2014, 10, 26, 0, 30)
+    assert schedule.next_fire(first) == timestamp(2014, 10, 27, 1, 30)
+
+
+def test_named_timezone_requires_pytz():
+    try:
+        import pytz  # noqa
+    except ImportError:
+        with pytest.raises(CronError):
+            CronSchedule('* * * * *', 'Europe/London')
+    else:
+        CronSchedule('* * * * *', 'Europe/London')
+
+
+def test_cron_decorator():
+    decorator = cron('0 * * * *')
+    handler = decorator(lambda: None)
+    descr = list(getattr(handler, ENTRYPOINT_PROVIDERS_ATTR))[0]
+    assert descr.dep_cls is CronProvider
+
+    with pytest.raises(CronError):
+        @cron('0 * * *')
+        def handle(self):
+            pass
+
+
+@pytest.yield_fixture
+def provider():
+    container = Mock(spec=ServiceContainer)
+    container.service_name = "service"
+    container.config = {'nightly': '30 2 * * *'}
+    container.metrics = ContainerMetrics()
+    container.spawn_managed_thread = eventlet.spawn
+
+    provider = CronProvider(
+        '0 * * * *', config_key='nightly', misfire_grace=60)
+    provider.bind('foobar', container)
+    provider.prepare()
+    yield provider
+    provider.stop()
+
+
+def test_provider(provider):
+    with patch('nameko.cron.time') as time:
+        time.time.return_value = timestamp(2014, 5, 1, 12)
+        provider.start()
+
+    # the config takes precedence, and nothing fires until it's due
+    assert provider._next_fire == timestamp(2014, 5, 2, 2, 30)
+    assert provider in get_scheduler()
+    assert not provider.container.spawn_worker.called
+
+    with patch('nameko.cron.time') as time:
+        time.time.return_value = timestamp(2014, 5, 2, 2, 30, 5)
+        provider.fire()
+
+        # the worker is spawned from a thread of the container
+        with patch('nameko.timer.time', time):
+            eventlet.sleep()
+
+    assert provider.container.spawn_worker.call_count == 1
+    assert provider._next_fire == timestamp(2014, 5, 3, 2, 30)
+
+
+def test_misfire(provider):
+    with patch('nameko.cron.time') as time:
+        time.time.return_value = timestamp(2014, 5, 1, 12)
+        provider.start()
+
+        # fires more than the grace late are skipped, and fires missed
+        # entirely are coalesced
+        time.time.return_value = timestamp(2014, 5, 4, 2, 32)
+        provider.fire()
+
+    assert not provider.container.spawn_worker.called
+    assert provider.container.metrics.counters == {'cron.misfired': 1}
+    assert provider._next_fire == timestamp(2014, 5, 5, 2, 30)
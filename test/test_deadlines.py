@@ -0,0 +1,300 @@
+import time
+
+import eventlet
+from mock import patch, Mock, ANY
+import pytest
+
+from nameko.containers import (
+    ServiceContainer, WorkerContext, deadline_expired, DEADLINE_KEY,
+    CANCEL_EXPIRED_WORKERS_KEY)
+from nameko.exceptions import DeadlineExceeded, RemoteError
+from nameko.events import Event, event_dispatcher, event_handler
+from nameko.messaging import ConsumeProvider, HeaderEncoder
+from nameko.metrics import ContainerMetrics
+from nameko.rpc import (
+    rpc, rpc_proxy, RpcProvider, ReplyListener, MethodProxy)
+from nameko.standalone.rpc import RpcProxy
+from nameko.testing.services import dummy, entrypoint_hook
+from nameko.testing.utils import as_context_manager
+
+
+@pytest.fixture
+def mock_container(empty_config):
+    container = Mock(spec=ServiceContainer)
+    container.worker_ctx_cls = WorkerContext
+    container.service_name = "service"
+    container.config = empty_config
+    container.metrics = ContainerMetrics()
+    return container
+
+
+def test_deadline_expired():
+    assert not deadline_expired(None)
+    assert not deadline_expired({})
+    assert not deadline_expired({DEADLINE_KEY: time.time() + 10})
+    assert deadline_expired({DEADLINE_KEY: time.time() - 1})
+
+
+def test_worker_context_propagates_deadline(mock_container):
+    deadline = time.time() + 10
+
+    worker_ctx = WorkerContext(mock_container, None, 'method',
+                               data={DEADLINE_KEY: deadline})
+    assert worker_ctx.deadline == deadline
+    assert worker_ctx.context_data[DEADLINE_KEY] == deadline
+
+    # no deadline unless the caller set one
+    worker_ctx = WorkerContext(mock_container, None, 'method')
+    assert worker_ctx.deadline is None
+    assert DEADLINE_KEY not in worker_ctx.context_data
+
+    incoming = {DEADLINE_KEY: deadline, 'unknown': 'value'}
+    assert WorkerContext.get_context_data(incoming) == {DEADLINE_KEY: deadline}
+
+
+class SlowService(object):
+
+    @dummy
+    def slow(self):
+        eventlet.sleep(0.2)
+        return 'done'
+
+
+def test_worker_outliving_deadline_is_counted():
+    container = ServiceContainer(SlowService, WorkerContext, {})
+    container.start()
+
+    context_data = {DEADLINE_KEY: time.time() + 0.1}
+    with entrypoint_hook(container, 'slow', context_data) as slow:
+        assert slow() == 'done'
+
+    assert container.metrics.counters == {'deadline.exceeded': 1}
+    container.stop()
+
+
+def test_worker_outliving_deadline_is_cancelled():
+    config = {CANCEL_EXPIRED_WORKERS_KEY: True}
+    container = ServiceContainer(SlowService, WorkerContext, config)
+    container.start()
+
+    context_data = {DEADLINE_KEY: time.time() + 0.1}
+    with entrypoint_hook(container, 'slow', context_data) as slow:
+        with eventlet.Timeout(0.15):
+            with pytest.raises(DeadlineExceeded):
+                slow()
+
+    # workers without a deadline are unaffected
+    with entrypoint_hook(container, 'slow') as slow:
+        assert slow() == 'done'
+
+    container.stop()
+
+
+def test_rpc_provider_discards_expired_calls(mock_container):
+    provider = RpcProvider()
+    provider.rpc_consumer = Mock()
+    provider.bind('method', mock_container)
+
+    message = Mock(headers={'nameko.deadline': time.time() - 1})
+    provider.handle_message({'args': (), 'kwargs': {}}, message)
+
+    assert not mock_container.spawn_worker.called
+    provider.rpc_consumer.handle_result.assert_called_once_with(
+        message, mock_container, None, ANY)
+    (_, _, _, exc), _ = provider.rpc_consumer.handle_result.call_args
+    assert isinstance(exc, DeadlineExceeded)
+    assert mock_container.metrics.counters == {'deadline.discarded': 1}
+
+
+def test_consume_provider_ignores_deadlines(mock_container):
+    provider = ConsumeProvider(queue=None, requeue_on_error=True)
+    provider.queue_consumer = Mock()
+    provider.bind('method', mock_container)
+
+    message = Mock(headers={'nameko.deadline': time.time() - 1,
+                            'nameko.language': 'en'})
+    provider.handle_message('body', message)
+
+    assert not provider.queue_consumer.ack_message.called
+    (_, _, _), kwargs = mock_container.spawn_worker.call_args
+    assert kwargs['context_data'] == {'language': 'en'}
+    assert mock_container.metrics.counters == {}
+
+
+@pytest.mark.usefixtures('predictable_call_ids')
+def test_published_headers_exclude_deadline(mock_container):
+    worker_ctx = WorkerContext(
+        mock_container, None, 'method',
+        data={DEADLINE_KEY: time.time() + 10, 'language': 'en'})
+    headers = HeaderEncoder().get_message_headers(worker_ctx)
+    assert headers == {
+        'nameko.language': 'en',
+        'nameko.call_id_stack': ['service.method.0'],
+    }
+
+
+class ExampleEvent(Event):
+    type = 'example'
+
+
+class DispatchingService(object):
+    name = 'dispatching'
+
+    dispatch = event_dispatcher()
+
+    @dummy
+    def method(self):
+        self.dispatch(ExampleEvent('msg'))
+
+
+handled = []
+
+
+class HandlingService(object):
+    name = 'handling'
+
+    @event_handler('dispatching', 'example')
+    def handle(self, msg):
+        handled.append(msg)
+
+
+def test_event_handled_after_dispatching_worker_deadline():
+    del handled[:]
+    config = {'AMQP_URI': 'memory://'}
+
+    # declare the handler's queue, then stop consuming from it
+    handler = ServiceContainer(HandlingService, WorkerContext, config)
+    handler.start()
+    handler.stop()
+
+    dispatcher = ServiceContainer(DispatchingService, WorkerContext, config)
+    dispatcher.start()
+    context_data = {DEADLINE_KEY: time.time() + 0.05}
+    with entrypoint_hook(dispatcher, 'method', context_data) as method:
+        method()
+    dispatcher.stop()
+
+    eventlet.sleep(0.1)
+    assert handled == []
+
+    handler = ServiceContainer(HandlingService, WorkerContext, config)
+    handler.start()
+    with eventlet.Timeout(1):
+        while not handled:
+            eventlet.sleep(0.01)
+    handler.stop()
+
+    assert handled == ['msg']
+    assert handler.metrics.counters.get('deadline.discarded') is None
+
+
+def test_method_proxy_deadline(mock_container):
+    worker_ctx = WorkerContext(mock_container, None, 'method')
+
+    proxy = MethodProxy(worker_ctx, 'service', 'method', Mock())
+    assert proxy.get_deadline() is None
+
+    proxy = MethodProxy(worker_ctx, 'service', 'method', Mock(), timeout=10)
+    assert abs(proxy.get_deadline() - (time.time() + 10)) < 1
+
+    # nested calls inherit the remaining budget of the calling worker
+    inherited = time.time() + 5
+    worker_ctx = WorkerContext(mock_container, None, 'method',
+                               data={DEADLINE_KEY: inherited})
+
+    proxy = MethodProxy(worker_ctx, 'service', 'method', Mock())
+    assert proxy.get_deadline() == inherited
+
+    proxy = MethodProxy(worker_ctx, 'service', 'method', Mock(), timeout=10)
+    assert proxy.get_deadline() == inherited
+
+    proxy = MethodProxy(worker_ctx, 'service', 'method', Mock(), timeout=1)
+    assert proxy.get_deadline() < inherited
+
+
+def test_method_proxy_times_out(mock_container):
+    mock_container.config = {'AMQP_URI': 'memory://'}
+    worker_ctx = WorkerContext(mock_container, None, 'method')
+
+    reply_listener = ReplyListener()
+    reply_listener.routing_key = 'reply'
+
+    producer = Mock()
+    with patch('nameko.rpc.producers') as producers:
+        producers[ANY].acquire.return_value = as_context_manager(producer)
+
+        proxy = MethodProxy(worker_ctx, 'service', 'method', reply_listener,
+                            timeout=0.05)
+        with pytest.raises(DeadlineExceeded):
+            proxy()
+
+    _, kwargs = producer.publish.call_args
+    assert kwargs['headers']['nameko.deadline'] > time.time() - 1
+    assert reply_listener._reply_events == {}
+
+
+def test_method_proxy_refuses_expired_calls(mock_container):
+    worker_ctx = WorkerContext(mock_container, None, 'method',
+                               data={DEADLINE_KEY: time.time() - 1})
+
+    with patch('nameko.rpc.producers') as producers:
+        proxy = MethodProxy(worker_ctx, 'service', 'method', Mock())
+        with pytest.raises(DeadlineExceeded):
+            proxy()
+
+    assert not producers[ANY].acquire.called
+
+
+def test_wait_for_reply():
+    reply_listener = ReplyListener()
+
+    event = reply_listener.get_reply_event('id')
+    eventlet.spawn_after(0.01, event.send, 'reply')
+    assert reply_listener.wait_for_reply('id', event, 1) == 'reply'
+
+    event = reply_listener.get_reply_event('id')
+    with pytest.raises(DeadlineExceeded):
+        reply_listener.wait_for_reply('id', event, 0.01)
+    assert reply_listener._reply_events == {}
+
+
+def test_wait_for_reply_ignores_other_timeouts():
+    reply_listener = ReplyListener()
+    event = reply_listener.get_reply_event('id')
+
+    with pytest.raises(eventlet.Timeout):
+        with eventlet.Timeout(0.01):
+            reply_listener.wait_for_reply('id', event, 1)
+
+
+def test_deadline_propagation(container_factory, rabbit_config):
+
+    class Callee(object):
+        name = 'callee'
+
+        @rpc
+        def slow(self):
+            eventlet.sleep(0.5)
+
+    class Caller(object):
+        name = 'caller'
+
+        callee = rpc_proxy('callee', timeout=0.1)
+
+        @rpc
+        def call_slow(self):
+            return self.callee.slow()
+
+    callee = container_factory(Callee, rabbit_config)
+    caller = container_factory(Caller, rabbit_config)
+    callee.start()
+    caller.start()
+
+    with RpcProxy('caller', rabbit_config, timeout=5) as proxy:
+        with pytest.raises(RemoteError) as exc_info:
+            proxy.call_slow()
+    assert exc_info.value.exc_type == 'DeadlineExceeded'
+
+    with RpcProxy('callee', rabbit_config, timeout=0.1) as proxy:
+        with pytest.raises(DeadlineExceeded):
+            proxy.slow()
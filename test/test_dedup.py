@@ -0,0 +1,213 @@
+from mock import Mock, patch
+
+from nameko.containers import WorkerContext, ServiceContainer
+from nameko.dedup import SeenSet, SqliteStore
+from nameko.messaging import ConsumeProvider
+from nameko.metrics import ContainerMetrics
+
+
+def test_seen_set():
+    seen = SeenSet('service.method')
+    assert 'abc' not in seen
+
+    seen.add('abc')
+    assert 'abc' in seen
+    assert 'xyz' not in seen
+
+
+def test_seen_set_window():
+    with patch('nameko.cache.time') as time:
+        time.time.return_value = 100
+        seen = SeenSet('service.method', window=10)
+        seen.add('abc')
+
+        time.time.return_value = 109
+        assert 'abc' in seen
+
+        time.time.return_value = 111
+        assert 'abc' not in seen
+
+
+def test_seen_set_max_size():
+    seen = SeenSet('service.method', max_size=2)
+    for message_id in ('a', 'b', 'c'):
+        seen.add(message_id)
+
+    assert 'a' not in seen
+    assert 'b' in seen
+    assert 'c' in seen
+
+
+def test_seen_set_survives_restart(tmpdir):
+    path = tmpdir.join('seen.db').strpath
+
+    seen = SeenSet('service.method', path=path)
+    seen.add('abc')
+    seen.close()
+
+    seen = SeenSet('service.method', path=path)
+    assert 'abc' in seen
+
+    # ids are stored per scope
+    other = SeenSet('service.other', path=path)
+    assert 'abc' not in other
+
+    seen.close()
+    other.close()
+
+
+def test_seen_set_store_window(tmpdir):
+    path = tmpdir.join('seen.db').strpath
+
+    with patch('nameko.dedup.time') as time:
+        time.time.return_value = 100
+        seen = SeenSet('service.method', window=10, path=path)
+        seen.add('abc')
+        seen.close()
+
+        time.time.return_value = 111
+        seen = SeenSet('service.method', window=10, path=path)
+        assert 'abc' not in seen
+        seen.close()
+
+
+def test_sqlite_store_prune(tmpdir):
+    store = SqliteStore(tmpdir.join('seen.db').strpath)
+    store.add('scope', 'old', 100)
+    store.add('scope', 'new', 200)
+
+    store.prune(150)
+    assert store.get('scope', 'old') is None
+    assert store.get('scope', 'new') == 200
+    store.close()
+
+
+def test_sqlite_store_batches_commits(tmpdir):
+    path = tmpdir.join('seen.db').strpath
+    store = SqliteStore(path, batch_size=2, interval=60)
+    other = SqliteStore(path)
+
+    # uncommitted ids are only visible to the store that added them
+    store.add('scope', 'a', 100)
+    assert store.get('scope', 'a') == 100
+    assert other.get('scope', 'a') is None
+
+    store.add('scope', 'b', 100)
+    assert other.get('scope', 'a') == 100
+
+    # as are ids uncommitted for longer than the interval
+    store.interval = 0
+    store.add('scope', 'c', 100)
+    assert other.get('scope', 'c') == 100
+
+    store.close()
+    other.close()
+
+
+def test_consume_provider_dedup(empty_config):
+
+    container = Mock(spec=ServiceContainer)
+    container.worker_ctx_cls = WorkerContext
+    container.service_name = "service"
+    container.config = empty_config
+    container.metrics = ContainerMetrics()
+
+    worker_ctx = WorkerContext(container, None, None)
+    spawn_worker = container.spawn_worker
+    spawn_worker.return_value = worker_ctx
+
+    queue_consumer = Mock()
+
+    consume_provider = ConsumeProvider(
+        queue=Mock(), requeue_on_error=True, dedup={'max_size': 10})
+    consume_provider.queue_consumer = queue_consumer
+    consume_provider.bind("name", container)
+    consume_provider.prepare()
+
+    message = Mock(headers={}, properties={'message_id': 'abc'})
+
+    # a failed, requeued message is not remembered
+    consume_provider.handle_message("body", message)
+    handle_result = spawn_worker.call_args[1]['handle_result']
+    handle_result(worker_ctx, None, Exception('Error'))
+    queue_consumer.requeue_message.assert_called_once_with(message)
+    assert 'abc' not in consume_provider.seen
+
+    # a processed message is
+    spawn_worker.reset_mock()
+    consume_provider.handle_message("body", message)
+    handle_result = spawn_worker.call_args[1]['handle_result']
+    handle_result(worker_ctx, 'result')
+    queue_consumer.ack_message.assert_called_once_with(message)
+    assert 'abc' in consume_provider.seen
+
+    # redeliveries are acked without spawning a worker
+    spawn_worker.reset_mock()
+    queue_consumer.reset_mock()
+    consume_provider.handle_message("body", message)
+    assert not spawn_worker.called
+    queue_consumer.ack_message.assert_called_once_with(message)
+    assert container.metrics.counters == {'dedup.hits': 1}
+
+    # messages without an id are always handled
+    message = Mock(headers={}, properties={})
+    consume_provider.handle_message("body", message)
+    consume_provider.handle_message("body", message)
+    assert spawn_worker.call_count == 2
+
+
+def test_consume_provider_dedup_after_stop(empty_config, tmpdir):
+
+    container = Mock(spec=ServiceContainer)
+    container.worker_ctx_cls = WorkerContext
+    container.service_name = "service"
+    container.config = empty_config
+
+    worker_ctx = WorkerContext(container, None, None)
+    container.spawn_worker.return_value = worker_ctx
+
+    consume_provider = ConsumeProvider(
+        queue=Mock(), requeue_on_error=False,
+        dedup={'path': tmpdir.join('seen.db').strpath})
+    consume_provider.queue_consumer = Mock()
+    consume_provider.bind("name", container)
+    consume_provider.prepare()
+
+    message = Mock(headers={}, properties={'message_id': 'abc'})
+    consume_provider.handle_message("body", message)
+
+    # workers may finish after the entrypoint has stopped
+    seen = consume_provider.seen
+    with patch.object(seen, 'close', wraps=seen.close) as close:
+        consume_provider.stop()
+        assert not close.called
+
+        handle_result = container.spawn_worker.call_args[1]['handle_result']
+        handle_result(worker_ctx, 'result')
+
+        # the store is closed once the last worker has finished
+        assert close.called
+    assert consume_provider.seen is None
+
+    seen = SeenSet('service.name', path=tmpdir.join('seen.db').strpath)
+    assert 'abc' in seen
+    seen.close()
+
+
+def test_consume_provider_kill_closes_seen_set(empty_config, tmpdir):
+    container = Mock(spec=ServiceContainer)
+    container.config = empty_config
+    container.service_name = "service"
+
+    consume_provider = ConsumeProvider(
+        queue=Mock(), requeue_on_error=False,
+        dedup={'path': tmpdir.join('seen.db').strpath})
+    consume_provider.queue_consumer = Mock()
+    consume_provider.bind("name", container)
+    consume_provider.prepare()
+
+    seen = consume_provider.seen
+    with patch.object(seen, 'close', wraps=seen.close) as close:
+        consume_provider.kill()
+    assert close.called
+    assert consume_provider.seen is None
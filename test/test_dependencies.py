@@ -6,7 +6,8 @@ from nameko.dependencies import (
     entrypoint, EntrypointProvider, prepare_entrypoint_providers,
     injection, InjectionProvider, prepare_injection_providers,
     DependencyFactory, DependencyTypeError, dependency,
-    DependencyProvider, PROCESS_SHARED, CONTAINER_SHARED, ProviderCollector)
+    DependencyProvider, PROCESS_SHARED, CONTAINER_SHARED, ProviderCollector,
+    introspect, invalidate_introspection, get_members, DependencySet)
 from nameko.containers import ServiceContainer, WorkerContext
 
 
@@ -254,3 +255,177 @@ def test_provider_collector():
     with eventlet.Timeout(0):
         collector.unregister_provider(provider2)
         collector.stop()
+
+
+class LazyProvider(InjectionProvider):
+    def __init__(self):
+        self.acquired = []
+
+    def acquire_injection(self, worker_ctx):
+        eventlet.sleep()
+        if worker_ctx.data.get('broken'):
+            raise ValueError()
+        self.acquired.append(worker_ctx)
+        return 'lazy'
+
+
+@injection
+def lazy():
+    return DependencyFactory(LazyProvider)
+
+
+class LazyService(object):
+    spam = lazy()
+    ham = lazy()
+
+
+def test_lazy_injection():
+    container = Mock(spec=ServiceContainer, config={}, service_name='lazy')
+    spam, ham = LazyProvider(), LazyProvider()
+    spam.bind('spam', container)
+    ham.bind('ham', container)
+
+    service = LazyService()
+    worker_ctx = WorkerContext(container, service, 'method')
+    spam.inject_lazily(worker_ctx)
+    ham.inject_lazily(worker_ctx)
+    assert not spam.is_injected(worker_ctx)
+
+    # threads accessing the injection at once share the acquisition
+    threads = [eventlet.spawn(getattr, service, 'spam') for _ in range(3)]
+    assert [gt.wait() for gt in threads] == ['lazy'] * 3
+    assert spam.acquired == [worker_ctx]
+    assert spam.is_injected(worker_ctx)
+    assert not ham.is_injected(worker_ctx)
+    assert ham.acquired == []
+
+    # the class attribute is unaffected
+    assert isinstance(LazyService.spam, DependencyFactory)
+
+
+def test_lazy_injection_failure():
+    container = Mock(spec=ServiceContainer, config={}, service_name='lazy')
+    spam = LazyProvider()
+    spam.bind('spam', container)
+
+    service = LazyService()
+    worker_ctx = WorkerContext(
+        container, service, 'method', data={'broken': True})
+    spam.inject_lazily(worker_ctx)
+
+    with pytest.raises(ValueError):
+        service.spam
+
+    # acquisition is retried on the next access
+    del worker_ctx.data['broken']
+    assert service.spam == 'lazy'
+
+
+def test_injections_acquired_on_access():
+    class Service(object):
+        spam = lazy()
+        ham = lazy()
+
+        @foobar
+        def use_spam(self):
+            return self.spam
+
+    container = ServiceContainer(Service, WorkerContext, {})
+    spam, = [dep for dep in container.dependencies if dep.name == 'spam']
+    ham, = [dep for dep in container.dependencies if dep.name == 'ham']
+    entrypoint, = container.dependencies.entrypoints
+    release = Mock()
+    ham.release = release
+
+    handle_result = Mock()
+    worker_ctx = container.spawn_worker(
+        entrypoint, (), {}, handle_result=handle_result)
+    container._worker_pool.waitall()
+
+    handle_result.assert_called_once_with(worker_ctx, 'lazy', None)
+    assert spam.acquired == [worker_ctx]
+    assert ham.acquired == []
+    assert not release.called
+
+    # injections are removed when the worker is torn down
+    assert isinstance(worker_ctx.service.spam, DependencyFactory)
+
+
+def test_introspection_cached():
+    class Service(object):
+        injected = barfoo()
+
+        @foobar
+        def echo(self, value):
+            return value
+
+    introspection = introspect(Service)
+    assert introspect(Service) is introspection
+    assert [name for name, _ in introspection.injections] == ['injected']
+    assert [name for name, _ in introspection.entrypoints] == ['echo']
+
+    # containers reuse the introspection of the service and provider classes
+    ServiceContainer(Service, WorkerContext, {})
+    with patch('nameko.dependencies.inspect.getmembers') as getmembers:
+        container = ServiceContainer(Service, WorkerContext, {})
+    assert not getmembers.called
+    assert len(container.dependencies) == 4
+
+
+def test_introspection_invalidated():
+    class Service(object):
+        injected = barfoo()
+
+    introspection = introspect(Service)
+
+    # changes to the class aren't seen until it's invalidated
+    Service.other = barfoo()
+    assert introspect(Service) is introspection
+
+    invalidate_introspection(Service)
+    changed = introspect(Service)
+    assert changed is not introspection
+    assert [name for name, _ in changed.injections] == ['injected', 'other']
+
+    # invalidating a base class invalidates its subclasses
+    class Subclass(Service):
+        pass
+
+    introspect(Subclass)
+    del Service.other
+    invalidate_introspection(Service)
+    assert [name for name, _ in introspect(Subclass).injections] == [
+        'injected']
+
+    invalidate_introspection()
+    assert introspect(Service) is not changed
+
+
+def test_get_members():
+    provider = BarProvider()
+    assert [name for name, _ in get_members(provider, DependencyFactory)] == [
+        'nested_provider', 'shared_provider']
+
+    # instance attributes take precedence
+    provider.nested_provider = None
+    provider.extra = nested_provider()
+    assert [name for name, _ in get_members(provider, DependencyFactory)] == [
+        'extra', 'shared_provider']
+
+
+def test_dependency_set():
+    entrypoint, injection, nested = FooProvider(), BarProvider(), Mock()
+    dependencies = DependencySet([injection, nested, entrypoint])
+    assert list(dependencies) == [injection, nested, entrypoint]
+    assert list(dependencies.injections) == [injection]
+    assert list(dependencies.entrypoints) == [entrypoint]
+    assert list(dependencies.nested) == [nested]
+
+    # the views follow changes to the set
+    replacement = BarProvider()
+    dependencies.remove(injection)
+    dependencies.add(replacement)
+    dependencies.discard(entrypoint)
+    assert list(dependencies) == [nested, replacement]
+    assert dependencies.injections[0] is replacement
+    assert not dependencies.entrypoints
@@ -1,15 +1,16 @@
+import gc
 import pytest
 import eventlet
 from collections import defaultdict
 
-from mock import Mock, patch
+from mock import Mock, patch, call, ANY
 
 from nameko.containers import WorkerContext, ServiceContainer
-from nameko.dependencies import ENTRYPOINT_PROVIDERS_ATTR
+from nameko.dependencies import ENTRYPOINT_PROVIDERS_ATTR, DependencyFactory
 from nameko.events import (
     EventDispatcher, Event, EventTypeTooLong, EventTypeMissing,
     EventHandlerConfigurationError, event_handler, SINGLETON, BROADCAST,
-    SERVICE_POOL, EventHandler)
+    SERVICE_POOL, PARTITIONED, PARTITION_KEY_HEADER, EventHandler)
 from nameko.standalone.events import event_dispatcher as standalone_dispatcher
 from nameko.testing.utils import as_context_manager
 
@@ -41,6 +42,14 @@ def test_reliable_broadcast_config_error():
             pass
 
 
+def test_partitioned_coalesce_config_error():
+    with pytest.raises(EventHandlerConfigurationError):
+        @event_handler(
+            'foo', 'bar', handler_type=PARTITIONED, coalesce_key=len)
+        def foo():
+            pass
+
+
 def test_event_handler_decorator():
     """ Verify that the event_handler decorator generates an EventProvider
     """
@@ -70,7 +79,7 @@ def test_event_dispatcher(empty_config):
         assert event_dispatcher.exchange.name == "srcservice.events"
         assert prepare.called
 
-    evt = Mock(type="eventtype", data="msg")
+    evt = Mock(type="eventtype", data="msg", partition_key=None)
     event_dispatcher.inject(worker_ctx)
 
     producer = Mock()
@@ -84,7 +93,206 @@ def test_event_dispatcher(empty_config):
         headers = event_dispatcher.get_message_headers(worker_ctx)
         producer.publish.assert_called_once_with(
             evt.data, exchange=event_dispatcher.exchange, headers=headers,
-            routing_key=evt.type)
+            routing_key=evt.type, message_id=ANY)
+
+
+def test_event_dispatcher_dispatch_many(empty_config):
+
+    container = Mock(spec=ServiceContainer)
+    container.service_name = "srcservice"
+    container.config = empty_config
+
+    service = Mock()
+    worker_ctx = WorkerContext(container, service, "dispatch")
+
+    event_dispatcher = EventDispatcher()
+    event_dispatcher.bind("dispatch", container)
+    event_dispatcher.exchange = Mock()
+    event_dispatcher.inject(worker_ctx)
+
+    events = [Mock(type="spam", data="msg1", partition_key=None),
+              Mock(type="ham", data="msg2", partition_key=None)]
+    producer = Mock()
+
+    with patch.object(
+            event_dispatcher, 'get_producer', autospec=True) as get_producer:
+        get_producer.return_value = as_context_manager(producer)
+
+        service.dispatch.dispatch_many(events)
+        assert get_producer.call_count == 1
+
+        headers = event_dispatcher.get_message_headers(worker_ctx)
+        assert producer.publish.call_args_list == [
+            call(evt.data, exchange=event_dispatcher.exchange,
+                 headers=headers, routing_key=evt.type, message_id=ANY)
+            for evt in events
+        ]
+
+
+def buffered_dispatcher(container, **kwargs):
+    event_dispatcher = EventDispatcher(buffered=True, **kwargs)
+    event_dispatcher.bind("dispatch", container)
+    event_dispatcher.exchange = Mock()
+    return event_dispatcher
+
+
+def test_buffered_event_dispatcher(mock_container):
+    event_dispatcher = buffered_dispatcher(
+        mock_container("srcservice"), flush_interval=0.05)
+
+    service = Mock()
+    worker_ctx = WorkerContext(
+        event_dispatcher.container, service, "dispatch")
+    producer = Mock()
+
+    with patch.object(
+            event_dispatcher, 'get_producer', autospec=True) as get_producer:
+        get_producer.side_effect = lambda: as_context_manager(producer)
+
+        event_dispatcher.start()
+        event_dispatcher.inject(worker_ctx)
+
+        # dispatching returns before the events are published
+        service.dispatch(Mock(type="spam", data="msg1", partition_key=None))
+        service.dispatch.dispatch_many(
+            [Mock(type="ham", data="msg2", partition_key=None)])
+        assert not producer.publish.called
+
+        # events are published in a single batch
+        with eventlet.Timeout(1):
+            while not producer.publish.called:
+                eventlet.sleep(0.01)
+        assert get_producer.call_count == 1
+        assert [args[0] for args, _ in producer.publish.call_args_list] == [
+            "msg1", "msg2"]
+
+        # stopping drains the buffer
+        service.dispatch(Mock(type="spam", data="msg3", partition_key=None))
+        event_dispatcher.stop()
+        assert producer.publish.call_count == 3
+
+
+def test_buffered_event_dispatcher_flush_before_ack(mock_container):
+    event_dispatcher = buffered_dispatcher(
+        mock_container("srcservice"), flush_interval=0.05,
+        flush_before_ack=True)
+
+    service = Mock()
+    worker_ctx = WorkerContext(
+        event_dispatcher.container, service, "dispatch")
+    producer = Mock()
+
+    with patch.object(
+            event_dispatcher, 'get_producer', autospec=True) as get_producer:
+        get_producer.side_effect = lambda: as_context_manager(producer)
+
+        event_dispatcher.start()
+        event_dispatcher.inject(worker_ctx)
+        service.dispatch(Mock(type="spam", data="msg", partition_key=None))
+
+        # teardown waits for the worker's events to be published
+        event_dispatcher.worker_teardown(worker_ctx)
+        assert producer.publish.called
+        event_dispatcher.stop()
+
+
+def test_buffered_event_dispatcher_flush_failure(mock_container):
+    event_dispatcher = buffered_dispatcher(
+        mock_container("srcservice"), flush_interval=0.05,
+        flush_before_ack=True)
+
+    service = Mock()
+    worker_ctx = WorkerContext(
+        event_dispatcher.container, service, "dispatch")
+    error = Exception('broker down')
+
+    with patch.object(
+            event_dispatcher, 'get_producer', autospec=True) as get_producer:
+        get_producer.side_effect = error
+
+        event_dispatcher.start()
+        event_dispatcher.inject(worker_ctx)
+        service.dispatch(Mock(type="spam", data="msg", partition_key=None))
+
+        # teardown raises, so the triggering message isn't acknowledged
+        with pytest.raises(Exception) as exc_info:
+            event_dispatcher.worker_teardown(worker_ctx)
+        assert exc_info.value is error
+        event_dispatcher.stop()
+
+    assert event_dispatcher.container.metrics.counters == {
+        'events.dropped': 1}
+
+
+def test_buffered_event_dispatcher_forgets_killed_workers(mock_container):
+    event_dispatcher = buffered_dispatcher(
+        mock_container("srcservice"), flush_before_ack=True)
+    event_dispatcher._buffer = eventlet.queue.Queue()
+
+    worker_ctx = WorkerContext(
+        event_dispatcher.container, Mock(), "dispatch")
+    event_dispatcher.enqueue({}, Mock(), 'id', worker_ctx)
+    assert len(event_dispatcher._pending) == 1
+
+    # the worker was killed, so its teardown never ran
+    del worker_ctx
+    gc.collect()
+    assert len(event_dispatcher._pending) == 0
+
+
+def test_buffered_event_dispatcher_backpressure(mock_container):
+    event_dispatcher = buffered_dispatcher(
+        mock_container("srcservice"), buffer_size=1, batch_size=1)
+
+    service = Mock()
+    worker_ctx = WorkerContext(
+        event_dispatcher.container, service, "dispatch")
+
+    published = []
+    release = eventlet.event.Event()
+
+    def publish(msg, **kwargs):
+        release.wait()
+        published.append(msg)
+
+    producer = Mock()
+    producer.publish.side_effect = publish
+
+    with patch.object(
+            event_dispatcher, 'get_producer', autospec=True) as get_producer:
+        get_producer.side_effect = lambda: as_context_manager(producer)
+
+        event_dispatcher.start()
+        event_dispatcher.inject(worker_ctx)
+
+        # the flusher takes the first event and blocks publishing it;
+        # the second fills the buffer and the third has to wait
+        service.dispatch(Mock(type="spam", data="msg1", partition_key=None))
+        eventlet.sleep()
+        service.dispatch(Mock(type="spam", data="msg2", partition_key=None))
+        gt = eventlet.spawn(
+            service.dispatch,
+            Mock(type="spam", data="msg3", partition_key=None))
+        eventlet.sleep(0.01)
+        assert not gt.dead
+
+        counters = event_dispatcher.container.metrics.counters
+        assert counters == {'events.buffer_full': 1}
+
+        release.send()
+        gt.wait()
+        event_dispatcher.stop()
+        assert published == ["msg1", "msg2", "msg3"]
+
+
+def test_buffered_event_dispatcher_kill(mock_container):
+    event_dispatcher = buffered_dispatcher(
+        mock_container("srcservice"), flush_interval=1)
+    event_dispatcher.start()
+    flusher = event_dispatcher._flusher
+
+    event_dispatcher.kill()
+    assert flusher.dead
 
 
 @pytest.fixture
@@ -96,9 +304,10 @@ def handler_factory(request):
     """
     def make_handler(queue_consumer, service_name="srcservice",
                      event_type="eventtype", handler_type=SERVICE_POOL,
-                     reliable_delivery=True, requeue_on_error=False):
+                     reliable_delivery=True, requeue_on_error=False,
+                     **kwargs):
         handler = EventHandler(service_name, event_type, handler_type,
-                               reliable_delivery, requeue_on_error)
+                               reliable_delivery, requeue_on_error, **kwargs)
         handler.queue_consumer = queue_consumer
         return handler
     return make_handler
@@ -145,6 +354,247 @@ def test_event_handler(handler_factory):
     event_handler.prepare()
     assert event_handler.queue.auto_delete is False
 
+    # test partitioned handler
+    event_handler = handler_factory(queue_consumer, handler_type=PARTITIONED)
+    event_handler.bind("foobar", container)
+    event_handler.prepare()
+    assert (event_handler.queue.name ==
+            "evt-srcservice-eventtype--destservice.foobar")
+
+
+def test_dispatch_partition_key(empty_config):
+
+    container = Mock(spec=ServiceContainer)
+    container.service_name = "srcservice"
+    container.config = empty_config
+
+    service = Mock()
+    worker_ctx = WorkerContext(container, service, "dispatch")
+
+    event_dispatcher = EventDispatcher()
+    event_dispatcher.bind("dispatch", container)
+    event_dispatcher.exchange = Mock()
+    event_dispatcher.inject(worker_ctx)
+
+    producer = Mock()
+    with patch.object(
+            event_dispatcher, 'get_producer', autospec=True) as get_producer:
+        get_producer.return_value = as_context_manager(producer)
+        service.dispatch(ExampleEvent("msg", partition_key="order-1"))
+
+    headers = producer.publish.call_args[1]['headers']
+    assert headers[PARTITION_KEY_HEADER] == "order-1"
+    assert ExampleEvent("msg").partition_key is None
+
+
+def partitioned_message(key=None):
+    headers = {}
+    if key is not None:
+        headers[PARTITION_KEY_HEADER] = key
+    return Mock(headers=headers, properties={})
+
+
+def test_partitioned_event_handler(handler_factory, mock_container):
+    handler = handler_factory(Mock(), handler_type=PARTITIONED)
+    handler.bind("foobar", mock_container())
+    handler.prepare()
+    spawn_worker = handler.container.spawn_worker
+
+    def handled():
+        return [kwargs['handle_result'].args[0]
+                for _, kwargs in spawn_worker.call_args_list]
+
+    def finish(message):
+        for _, kwargs in spawn_worker.call_args_list:
+            handle_result = kwargs['handle_result']
+            if handle_result.args[0] is message:
+                handle_result(Mock(), 'result')
+        eventlet.sleep()
+
+    a1, a2, a3 = [partitioned_message("a") for _ in range(3)]
+    b1 = partitioned_message("b")
+    unkeyed = partitioned_message()
+
+    for message in (a1, a2, b1, a3, unkeyed):
+        handler.handle_message("body", message)
+
+    # one event per key at a time; events without a key aren't held back
+    assert handled() == [a1, b1, unkeyed]
+
+    finish(b1)
+    assert "b" not in handler._lanes
+
+    # the next event for a key is handled once the previous one is
+    finish(a1)
+    assert handled() == [a1, b1, unkeyed, a2]
+    finish(a2)
+    assert handled() == [a1, b1, unkeyed, a2, a3]
+    finish(a3)
+    assert handler._lanes == {}
+
+    assert handler.queue_consumer.ack_message.call_args_list == [
+        call(b1), call(a1), call(a2), call(a3)]
+
+
+def test_partitioned_event_handler_stop(handler_factory, mock_container):
+    handler = handler_factory(Mock(), handler_type=PARTITIONED)
+    handler.bind("foobar", mock_container())
+    handler.prepare()
+    spawn_worker = handler.container.spawn_worker
+
+    message = partitioned_message("a")
+    handler.handle_message("body", message)
+    handler.handle_message("body", partitioned_message("a"))
+
+    # stopping waits for the events already received for each key
+    gt = eventlet.spawn(handler.stop)
+    eventlet.sleep()
+    assert not gt.dead
+
+    spawn_worker.call_args[1]['handle_result'](Mock(), 'result')
+    eventlet.sleep()
+    assert not gt.dead
+
+    spawn_worker.call_args[1]['handle_result'](Mock(), 'result')
+    gt.wait()
+    assert spawn_worker.call_count == 2
+
+
+def by_id(data):
+    return data['id']
+
+
+def test_coalescing_event_handler(handler_factory, mock_container):
+    handler = handler_factory(Mock(), coalesce_key=by_id, window=0.01)
+    handler.bind("foobar", mock_container())
+    handler.prepare()
+    spawn_worker = handler.container.spawn_worker
+
+    messages = [Mock(headers={}) for _ in range(3)]
+    handler.handle_message({'id': 1, 'version': 1}, messages[0])
+    handler.handle_message({'id': 1, 'version': 2}, messages[1])
+    handler.handle_message({'id': 2, 'version': 1}, messages[2])
+    assert not spawn_worker.called
+
+    # one worker per key once the window closes, with the latest payload
+    eventlet.sleep(0.02)
+    assert sorted(args for (_, args, _), _ in spawn_worker.call_args_list) == [
+        ({'id': 1, 'version': 2},), ({'id': 2, 'version': 1},)]
+    assert handler.container.metrics.counters == {'events.coalesced': 1}
+
+    # superseded messages are acked with the coalesced worker's result
+    for _, kwargs in spawn_worker.call_args_list:
+        kwargs['handle_result'](Mock(), 'result')
+    ack_message = handler.queue_consumer.ack_message
+    assert sorted(ack_message.call_args_list) == sorted(
+        call(message) for message in messages)
+
+
+def test_coalescing_event_handler_all(handler_factory, mock_container):
+    handler = handler_factory(
+        Mock(), coalesce_key=by_id, window=0.01, coalesce_all=True,
+        requeue_on_error=True)
+    handler.bind("foobar", mock_container())
+    handler.prepare()
+    spawn_worker = handler.container.spawn_worker
+
+    messages = [Mock(headers={}) for _ in range(2)]
+    handler.handle_message({'id': 1, 'version': 1}, messages[0])
+    handler.handle_message({'id': 1, 'version': 2}, messages[1])
+
+    eventlet.sleep(0.02)
+    (_, args, _), kwargs = spawn_worker.call_args
+    assert args == ([{'id': 1, 'version': 1}, {'id': 1, 'version': 2}],)
+
+    # all the held messages are requeued if the worker fails
+    kwargs['handle_result'](Mock(), None, Exception('Error'))
+    assert handler.queue_consumer.requeue_message.call_args_list == [
+        call(message) for message in messages]
+
+
+def test_coalescing_event_handler_stop(handler_factory, mock_container):
+    handler = handler_factory(Mock(), coalesce_key=by_id, window=60)
+    handler.bind("foobar", mock_container())
+    handler.prepare()
+    spawn_worker = handler.container.spawn_worker
+
+    handler.handle_message({'id': 1}, Mock(headers={}))
+    (timer, _, _), = handler._coalescing.values()
+
+    # stopping flushes open windows immediately, and their timers exit
+    # rather than being killed
+    handler.stop()
+    assert spawn_worker.call_count == 1
+    assert timer.dead
+    timer.wait()
+
+
+def test_coalescing_event_handler_kill(handler_factory, mock_container):
+    handler = handler_factory(Mock(), coalesce_key=by_id, window=60)
+    handler.bind("foobar", mock_container())
+    handler.prepare()
+    handler.handle_message({'id': 1}, Mock(headers={}))
+    (timer, _, _), = handler._coalescing.values()
+
+    # killing discards the held events
+    handler.kill()
+    timer.wait()
+    assert not handler.container.spawn_worker.called
+
+
+def broadcast_handler(handler_factory, container, **kwargs):
+    handler = handler_factory(
+        Mock(), handler_type=BROADCAST, reliable_delivery=False, **kwargs)
+    handler.bind("handle", container)
+    handler.prepare()
+    return handler
+
+
+def test_broadcast_fanout(handler_factory, mock_container):
+    foo = broadcast_handler(handler_factory, mock_container("foo"))
+    bar = broadcast_handler(handler_factory, mock_container("bar"))
+
+    # handlers in the same process share a queue
+    assert foo.queue.name == bar.queue.name
+    assert foo.queue.name.startswith("evt-srcservice-eventtype--broadcast-")
+    assert foo.queue.auto_delete is True
+
+    # whichever receives an event hands it to both
+    message = Mock(headers={})
+    bar.handle_message("msg", message)
+    for handler in (foo, bar):
+        (provider, args, _), kwargs = handler.container.spawn_worker.call_args
+        assert provider is handler
+        assert args == ("msg",)
+
+    # and acks it once both have handled it
+    foo_result = foo.container.spawn_worker.call_args[1]['handle_result']
+    bar_result = bar.container.spawn_worker.call_args[1]['handle_result']
+    foo_result(Mock(), 'result')
+    assert not bar.queue_consumer.ack_message.called
+    bar_result(Mock(), None, Exception('Error'))
+    bar.queue_consumer.ack_message.assert_called_once_with(message)
+    assert not foo.queue_consumer.ack_message.called
+
+    # stopped handlers no longer receive events
+    foo.stop()
+    foo.container.spawn_worker.reset_mock()
+    bar.handle_message("msg", Mock(headers={}))
+    assert not foo.container.spawn_worker.called
+    assert bar.container.spawn_worker.call_count == 2
+
+
+def test_broadcast_requeue_on_error_own_queue(handler_factory, mock_container):
+    foo = broadcast_handler(handler_factory, mock_container("foo"))
+    bar = broadcast_handler(
+        handler_factory, mock_container("bar"), requeue_on_error=True)
+
+    assert foo.queue.name != bar.queue.name
+    assert bar.queue.name.startswith("evt-srcservice-eventtype--bar.handle-")
+
+    foo.handle_message("msg", Mock(headers={}))
+    assert not bar.container.spawn_worker.called
+
 
 #==============================================================================
 # INTEGRATION TESTS
@@ -407,15 +857,14 @@ def test_broadcast_events(rabbit_manager, rabbit_config, start_containers):
     vhost = rabbit_config['vhost']
     start_containers(BroadcastHandler, ("foo", "foo", "bar"))
 
-    # each broadcast queue should have one consumer
+    # the handlers share a single broadcast queue
     queues = rabbit_manager.get_queues(vhost)
     queue_names = [queue['name'] for queue in queues
                    if queue['name'].startswith("evt-srcservice-eventtype-")]
 
-    assert len(queue_names) == 3
-    for name in queue_names:
-        queue = rabbit_manager.get_queue(vhost, name)
-        assert len(queue['consumer_details']) == 1
+    assert len(queue_names) == 1
+    queue = rabbit_manager.get_queue(vhost, queue_names[0])
+    assert len(queue['consumer_details']) == 3
 
     exchange_name = "srcservice.events"
     rabbit_manager.publish(vhost, exchange_name, 'eventtype', 'msg')
@@ -611,9 +1060,10 @@ def test_dispatch_to_rabbit(rabbit_manager, rabbit_config):
     service = Mock()
     worker_ctx = WorkerContext(container, service, None)
 
-    dispatcher = EventDispatcher()
-    dispatcher.bind("dispatch", container)
+    dispatcher = DependencyFactory(EventDispatcher).create_and_bind_instance(
+        "dispatch", container)
     dispatcher.prepare()
+    dispatcher.declarer.prepare()
     dispatcher.start()
 
     # we should have an exchange but no queues
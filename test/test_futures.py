@@ -0,0 +1,127 @@
+from concurrent.futures import (
+    CancelledError, TimeoutError, FIRST_EXCEPTION, as_completed, wait)
+import eventlet
+from greenlet import GreenletExit
+from mock import Mock
+import pytest
+
+from nameko.containers import ServiceContainer
+from nameko.futures import GreenFuture, spawn_future
+from nameko.standalone.rpc import RpcProxy
+
+
+def test_result():
+    future = GreenFuture()
+    assert future.set_running_or_notify_cancel()
+    assert future.running()
+
+    eventlet.spawn_after(0, future.set_result, 'spam')
+    assert future.result() == 'spam'
+    assert future.done()
+    assert future.exception() is None
+    assert not future.cancel()
+
+
+def test_exception():
+    future = GreenFuture()
+    exc = ValueError()
+    future.set_exception(exc)
+
+    with pytest.raises(ValueError):
+        future.result()
+    assert future.exception() is exc
+
+
+def test_timeout():
+    future = GreenFuture()
+    with pytest.raises(TimeoutError):
+        future.result(timeout=0.01)
+    with pytest.raises(TimeoutError):
+        future.exception(timeout=0)
+
+
+def test_cancel():
+    future = GreenFuture()
+    callback = Mock()
+    future.add_done_callback(callback)
+
+    assert future.cancel()
+    assert future.cancelled()
+    assert future.cancel()
+    callback.assert_called_once_with(future)
+    assert not future.set_running_or_notify_cancel()
+    with pytest.raises(CancelledError):
+        future.result()
+
+
+def test_done_callbacks():
+    future = GreenFuture()
+    calls = []
+
+    def broken(future):
+        raise Exception()
+
+    future.add_done_callback(broken)
+    future.add_done_callback(calls.append)
+    future.set_result(None)
+
+    # callbacks added once the future is done are called immediately, and
+    # exceptions raised by callbacks are logged
+    future.add_done_callback(calls.append)
+    assert calls == [future, future]
+
+
+def test_concurrent_futures_wait():
+    finished, cancelled, failed, pending = futures = [
+        GreenFuture() for _ in range(4)]
+    finished.set_result(None)
+    cancelled.cancel()
+    eventlet.spawn_after(0, failed.set_exception, ValueError())
+
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    assert done == set([finished, cancelled, failed])
+    assert not_done == set([pending])
+
+    done, not_done = wait(futures, timeout=0.01)
+    assert not_done == set([pending])
+
+    eventlet.spawn_after(0, pending.set_result, None)
+    assert list(as_completed(futures))[-1] is pending
+    assert all(not future._waiters for future in futures)
+
+
+def test_unexpected_state():
+    future = GreenFuture()
+    future.set_result(None)
+    with pytest.raises(RuntimeError):
+        future.set_running_or_notify_cancel()
+
+
+@pytest.fixture
+def container():
+    class Service(object):
+        pass
+    return ServiceContainer(Service, None, {})
+
+
+def test_spawn_future(container):
+    assert spawn_future(container, lambda a, b: a + b, 1, b=2).result() == 3
+
+    def broken():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        spawn_future(container, broken).result()
+
+
+def test_spawn_future_standalone_container():
+    # the stub container of a standalone proxy doesn't manage threads
+    container = RpcProxy.ServiceContainer({})
+    assert spawn_future(container, lambda a, b: a + b, 1, b=2).result() == 3
+
+
+def test_spawn_future_container_killed(container):
+    future = spawn_future(container, eventlet.sleep, 1)
+    container.kill(Exception())
+    with pytest.raises(GreenletExit):
+        future.result()
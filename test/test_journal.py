@@ -0,0 +1,226 @@
+import os
+
+from mock import Mock, patch
+import pytest
+
+from nameko.containers import WorkerContext, ServiceContainer
+from nameko.events import EventHandler, SERVICE_POOL
+from nameko.journal import Journal, replay
+from nameko.metrics import ContainerMetrics
+
+
+@pytest.fixture
+def path(tmpdir):
+    return tmpdir.join('journal').strpath
+
+
+def test_append_and_read(path):
+    journal = Journal(path)
+    assert journal.append('spam', {'n': 1}, {'nameko.language': 'en'}) == 0
+    assert journal.append('ham', [1, 2]) == 1
+
+    first, second = journal.read()
+    assert (first.offset, first.event_type, first.body, first.headers) == (
+        0, 'spam', {'n': 1}, {'nameko.language': 'en'})
+    assert (second.offset, second.event_type, second.body) == (
+        1, 'ham', [1, 2])
+
+    assert [entry.offset for entry in journal.read(1)] == [1]
+    journal.close()
+
+
+def test_reopen(path):
+    journal = Journal(path)
+    for n in range(3):
+        journal.append('spam', n)
+    journal.close()
+
+    journal = Journal(path)
+    assert [entry.body for entry in journal.read()] == [0, 1, 2]
+    assert journal.append('spam', 3) == 3
+    journal.close()
+
+
+def test_recover_unflushed_index(path):
+    journal = Journal(path)
+    for n in range(3):
+        journal.append('spam', n)
+    segment = journal.segments[0]
+    segment.flush()
+
+    # as if the process died before the last index writes were flushed,
+    # part way through an entry
+    with open(segment.index_path, 'r+b') as index:
+        index.truncate(20)
+
+    journal = Journal(path)
+    assert [entry.offset for entry in journal.read()] == [0, 1, 2]
+    assert [entry.body for entry in journal.read(2)] == [2]
+    assert journal.append('spam', 3) == 3
+    journal.close()
+
+    journal = Journal(path)
+    assert [entry.body for entry in journal.read()] == [0, 1, 2, 3]
+    journal.close()
+
+
+def test_segments(path):
+    journal = Journal(path, segment_size=200)
+    for n in range(10):
+        journal.append('spam', n)
+
+    assert len(journal.segments) > 1
+    assert sorted(os.listdir(path))[0] == '{:020d}.index'.format(0)
+    assert [entry.body for entry in journal.read(4)] == range(4, 10)
+    journal.close()
+
+    journal = Journal(path, segment_size=200)
+    assert [entry.offset for entry in journal.read()] == range(10)
+    journal.close()
+
+
+def test_entry_too_large(path):
+    journal = Journal(path, segment_size=100)
+    with pytest.raises(ValueError):
+        journal.append('spam', 'x' * 100)
+    journal.close()
+
+
+def test_entry_too_large_after_others(path):
+    journal = Journal(path, segment_size=100)
+    journal.append('spam', 1)
+    with pytest.raises(ValueError):
+        journal.append('spam', 'x' * 100)
+
+    # no segment is started for the rejected entry
+    assert len(journal.segments) == 1
+    assert journal.append('spam', 2) == 1
+    journal.close()
+
+
+def test_retention(path):
+    with patch('nameko.journal.time') as time:
+        time.time.return_value = 1000
+        journal = Journal(path, segment_size=200, retention=60)
+        for n in range(5):
+            journal.append('spam', n)
+        segments = len(journal.segments)
+        assert segments > 1
+
+        # segments are deleted once all their entries have expired
+        time.time.return_value = 1100
+        for n in range(5, 10):
+            journal.append('spam', n)
+        assert len(journal.segments) < 2 * segments
+        assert [entry.body for entry in journal.read()][0] > 0
+        assert [entry.body for entry in journal.read()][-1] == 9
+        journal.close()
+
+
+def test_compact(path):
+    journal = Journal(path, segment_size=300)
+    for n in range(12):
+        journal.append('spam', {'id': n % 3, 'n': n})
+    journal.append('ham', None)
+
+    journal.compact(lambda entry: entry.body and entry.body['id'])
+    entries = list(journal.read())
+
+    # only the latest entry for each key is kept, with its offset; the
+    # current segment isn't compacted
+    current = journal.segments[-1].offsets
+    for entry in entries:
+        if entry.body and entry.offset not in current:
+            assert entry.offset == entry.body['n'] >= 9
+    latest = dict((entry.body['id'], entry.body['n'])
+                  for entry in entries if entry.body)
+    assert latest == {0: 9, 1: 10, 2: 11}
+    assert entries[-1].event_type == 'ham'
+    assert len(entries) < 13
+    journal.close()
+
+    journal = Journal(path, segment_size=300)
+    assert [entry.offset for entry in journal.read()] == [
+        entry.offset for entry in entries]
+    assert journal.append('spam', None) == 13
+    journal.close()
+
+
+def test_compact_discards_stale_compacting_dir(path):
+    journal = Journal(path, segment_size=300)
+    for n in range(12):
+        journal.append('spam', {'id': n % 2 or None, 'n': n})
+
+    # leftovers of a compaction that crashed part way through
+    stale = Journal(os.path.join(path, 'compacting'), segment_size=300)
+    stale.append('spam', {'id': None, 'n': -1})
+    stale.close()
+
+    journal.compact(lambda entry: entry.body['id'])
+    assert [entry.body['n'] for entry in journal.read()][:2] == [0, 2]
+    journal.close()
+
+
+@pytest.fixture
+def handler(empty_config, path):
+    container = Mock(spec=ServiceContainer)
+    container.service_name = "destservice"
+    container.config = empty_config
+    container.metrics = ContainerMetrics()
+    container.worker_ctx_cls = WorkerContext
+
+    handler = EventHandler("srcservice", "eventtype", SERVICE_POOL, True,
+                           False, journal=path)
+    handler.queue_consumer = Mock()
+    handler.bind("handle", container)
+    handler.prepare()
+    container.entrypoints = [handler]
+    return handler
+
+
+def test_journaled_event_handler(handler, path):
+    headers = {'nameko.language': 'en', 'nameko.call_id_stack': ['a.b.0']}
+    handler.handle_message({'n': 1}, Mock(headers=headers))
+    handler.handle_message({'n': 2}, Mock(headers={}))
+
+    journal = handler.journal
+    assert journal.path == os.path.join(path, 'destservice.handle')
+    assert [(entry.body, entry.headers) for entry in journal.read()] == [
+        ({'n': 1}, headers), ({'n': 2}, {})]
+
+    # replay re-drives the handler without going through the broker
+    spawn_worker = handler.container.spawn_worker
+    spawn_worker.reset_mock()
+    assert replay(handler.container, "handle", from_offset=1) == 2
+    spawn_worker.assert_called_once_with(
+        handler, ({'n': 2},), {}, context_data={})
+
+    spawn_worker.reset_mock()
+    with patch('nameko.journal.eventlet') as eventlet:
+        assert replay(handler.container, "handle", rate=10) == 2
+    assert eventlet.sleep.call_count == 2
+    (_, _, _), kwargs = spawn_worker.call_args_list[0]
+    assert kwargs['context_data'] == {
+        'language': 'en', 'call_id_stack': ['a.b.0']}
+
+    handler.stop()
+    assert handler.journal is None
+
+
+def test_replay_errors(handler):
+    with pytest.raises(ValueError):
+        replay(handler.container, "missing")
+
+    handler.journal = None
+    with pytest.raises(ValueError):
+        replay(handler.container, "handle")
+
+
+def test_journal_errors_dont_stop_handling(handler):
+    handler.journal.segment_size = 100
+    handler.handle_message('x' * 100, Mock(headers={}))
+    handler.journal.append = Mock(side_effect=IOError('disk full'))
+    handler.handle_message({'n': 1}, Mock(headers={}))
+
+    assert handler.container.spawn_worker.call_count == 2
+    assert handler.container.metrics.counters['journal.errors'] == 2
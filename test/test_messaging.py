@@ -2,11 +2,14 @@ import eventlet
 import pytest
 
 from kombu import Exchange, Queue
-from mock import patch, Mock
+from mock import patch, Mock, call, ANY
 
-from nameko.dependencies import DependencyFactory
+from nameko.dependencies import (
+    DependencyFactory, DependencyProvider, InjectionProvider, dependency,
+    injection, CONTAINER_SHARED)
 from nameko.messaging import (
-    PublishProvider, ConsumeProvider, HeaderEncoder, HeaderDecoder)
+    PublishProvider, ConsumeProvider, HeaderEncoder, HeaderDecoder, Declarer,
+    declarer, publisher as publisher_injection)
 from nameko.containers import (
     WorkerContext, WorkerContextBase, NAMEKO_CONTEXT_KEYS, ServiceContainer)
 from nameko.testing.utils import (
@@ -122,8 +125,9 @@ def test_publish_to_exchange(empty_config, maybe_declare, patch_publisher):
     get_producer.return_value = as_context_manager(producer)
 
     # test declarations
+    publisher.declarer = Mock()
     publisher.prepare()
-    maybe_declare.assert_called_once_with(foobar_ex, connection)
+    publisher.declarer.declare.assert_called_once_with(foobar_ex)
 
     # test publish
     msg = "msg"
@@ -133,7 +137,7 @@ def test_publish_to_exchange(empty_config, maybe_declare, patch_publisher):
         'nameko.call_id_stack': ['srcservice.publish.0']
     }
     producer.publish.assert_called_once_with(
-        msg, headers=headers, exchange=foobar_ex)
+        msg, headers=headers, exchange=foobar_ex, message_id=ANY)
 
 
 @pytest.mark.usefixtures("predictable_call_ids")
@@ -159,8 +163,9 @@ def test_publish_to_queue(empty_config, maybe_declare, patch_publisher):
     get_producer.return_value = as_context_manager(producer)
 
     # test declarations
+    publisher.declarer = Mock()
     publisher.prepare()
-    maybe_declare.assert_called_once_with(foobar_queue, connection)
+    publisher.declarer.declare.assert_called_once_with(foobar_queue)
 
     # test publish
     msg = "msg"
@@ -171,7 +176,8 @@ def test_publish_to_queue(empty_config, maybe_declare, patch_publisher):
     publisher.inject(worker_ctx)
     service.publish(msg)
     producer.publish.assert_called_once_with(msg, headers=headers,
-                                             exchange=foobar_ex)
+                                             exchange=foobar_ex,
+                                             message_id=ANY)
 
 
 @pytest.mark.usefixtures("predictable_call_ids")
@@ -198,8 +204,9 @@ def test_publish_custom_headers(empty_config, maybe_declare, patch_publisher):
     get_producer.return_value = as_context_manager(producer)
 
     # test declarations
+    publisher.declarer = Mock()
     publisher.prepare()
-    maybe_declare.assert_called_once_with(foobar_queue, connection)
+    publisher.declarer.declare.assert_called_once_with(foobar_queue)
 
     # test publish
     msg = "msg"
@@ -209,7 +216,124 @@ def test_publish_custom_headers(empty_config, maybe_declare, patch_publisher):
     publisher.inject(worker_ctx)
     service.publish(msg)
     producer.publish.assert_called_once_with(msg, headers=headers,
-                                             exchange=foobar_ex)
+                                             exchange=foobar_ex,
+                                             message_id=ANY)
+
+
+def test_declarer(maybe_declare):
+    container = Mock(spec=ServiceContainer)
+    container.config = {'AMQP_URI': 'memory://'}
+
+    declarer = Declarer()
+    declarer.bind("declarer", container)
+
+    # entities are collected, without duplicates, and declared together
+    declarer.declare(foobar_ex)
+    declarer.declare(foobar_queue)
+    declarer.declare(foobar_ex)
+    assert not maybe_declare.called
+
+    declarer.prepare()
+    assert maybe_declare.call_args_list == [
+        call(foobar_ex, ANY), call(foobar_queue, ANY)]
+    (_, channel), (_, other_channel) = [
+        args for args, _ in maybe_declare.call_args_list]
+    assert channel is other_channel
+
+    maybe_declare.reset_mock()
+    declarer.prepare()
+    assert not maybe_declare.called
+
+    # entities declared once it's prepared are declared straight away
+    declarer.declare(foobar_ex)
+    maybe_declare.assert_called_once_with(foobar_ex, ANY)
+
+
+relay_ex = Exchange('relay_ex', durable=False)
+
+
+class RelayPublisher(DependencyProvider):
+    declarer = declarer(shared=CONTAINER_SHARED)
+
+    def prepare(self):
+        self.declarer.declare(relay_ex)
+
+
+@dependency
+def relay_publisher():
+    return DependencyFactory(RelayPublisher)
+
+
+class RelayProvider(InjectionProvider):
+    publisher = relay_publisher()
+
+    def acquire_injection(self, worker_ctx):
+        return self.publisher
+
+
+@injection
+def relay():
+    return DependencyFactory(RelayProvider)
+
+
+def test_declarer_nested_publisher(maybe_declare):
+
+    class Service(object):
+        publish = publisher_injection(exchange=foobar_ex)
+        relay = relay()
+
+    container = ServiceContainer(
+        Service, WorkerContext, {'AMQP_URI': 'memory://'})
+    container.start()
+
+    # the relay's publisher is a nested dependency, prepared alongside the
+    # declarer it shares with the service's publisher, so it declares its
+    # exchange after the declarer has been prepared
+    declared = [args[0] for args, _ in maybe_declare.call_args_list]
+    assert foobar_ex in declared
+    assert relay_ex in declared
+    container.stop()
+
+
+@pytest.mark.usefixtures("predictable_call_ids")
+def test_publish_many(empty_config, maybe_declare, patch_publisher):
+    container = Mock(spec=ServiceContainer)
+    container.service_name = "srcservice"
+    container.config = empty_config
+
+    service = Mock()
+    worker_ctx = WorkerContext(container, service, "publish")
+
+    publisher = PublishProvider(exchange=foobar_ex)
+    publisher.bind("publish", container)
+
+    producer = Mock()
+    get_connection, get_producer = patch_publisher(publisher)
+    get_producer.side_effect = lambda: as_context_manager(producer)
+
+    publisher.inject(worker_ctx)
+    with patch.object(publisher, 'get_message_headers',
+                      wraps=publisher.get_message_headers) as get_headers:
+        service.publish.publish_many(["msg1", "msg2"], routing_key="spam")
+        service.publish("msg3")
+
+    headers = {
+        'nameko.call_id_stack': ['srcservice.publish.0']
+    }
+    assert producer.publish.call_args_list == [
+        call(msg, headers=headers, exchange=foobar_ex, routing_key="spam",
+             message_id=ANY)
+        for msg in ("msg1", "msg2")
+    ] + [call("msg3", headers=headers, exchange=foobar_ex, message_id=ANY)]
+
+    # every message has its own id
+    message_ids = set(
+        kwargs['message_id'] for _, kwargs in producer.publish.call_args_list)
+    assert len(message_ids) == 3
+
+    # a single producer for the batch, headers computed once per worker
+    assert get_producer.call_count == 2
+    assert get_headers.call_count == 1
 
 
 def test_header_encoder(empty_config):
@@ -277,11 +401,13 @@ def test_publish_to_rabbit(rabbit_manager, rabbit_config):
     worker_ctx = CustomWorkerContext(container, service, 'method',
                                      data=ctx_data)
 
-    publisher = PublishProvider(exchange=foobar_ex, queue=foobar_queue)
-    publisher.bind("publish", container)
+    factory = DependencyFactory(
+        PublishProvider, exchange=foobar_ex, queue=foobar_queue)
+    publisher = factory.create_and_bind_instance("publish", container)
 
     # test queue, exchange and binding created in rabbit
     publisher.prepare()
+    publisher.declarer.prepare()
     publisher.start()
 
     exchanges = rabbit_manager.get_exchanges(vhost)
@@ -321,10 +447,12 @@ def test_unserialisable_headers(rabbit_manager, rabbit_config):
     worker_ctx = CustomWorkerContext(container, service, 'method',
                                      data=ctx_data)
 
-    publisher = PublishProvider(exchange=foobar_ex, queue=foobar_queue)
-    publisher.bind("publish", container)
+    factory = DependencyFactory(
+        PublishProvider, exchange=foobar_ex, queue=foobar_queue)
+    publisher = factory.create_and_bind_instance("publish", container)
 
     publisher.prepare()
+    publisher.declarer.prepare()
     publisher.start()
 
     publisher.inject(worker_ctx)
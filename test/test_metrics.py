@@ -0,0 +1,177 @@
+import socket
+
+import eventlet
+from eventlet.event import Event
+import pytest
+
+from nameko.containers import ServiceContainer, WorkerContext
+from nameko.metrics import (
+    Histogram, ContainerMetrics, PrometheusExporter, StatsdExporter)
+from nameko.runners import ServiceRunner
+from nameko.testing.services import dummy, entrypoint_hook
+
+release = Event()
+
+
+class Service(object):
+
+    @dummy
+    def ok(self):
+        return 'ok'
+
+    @dummy
+    def broken(self):
+        raise Exception('broken')
+
+    @dummy
+    def blocked(self):
+        release.wait()
+
+
+@pytest.yield_fixture
+def container():
+    global release
+    release = Event()
+
+    container = ServiceContainer(Service, WorkerContext, {'max_workers': 1})
+    container.start()
+    yield container
+    container.stop()
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(1, 5, 10))
+    for value in (0.5, 1, 3, 7, 20):
+        histogram.observe(value)
+
+    assert histogram.snapshot() == {
+        'buckets': [(1, 2), (5, 3), (10, 4), (float('inf'), 5)],
+        'sum': 31.5,
+        'count': 5,
+    }
+
+
+def test_counters():
+    metrics = ContainerMetrics()
+    metrics.increment('spam')
+    metrics.increment('spam', 2)
+    assert metrics.snapshot()['counters'] == {'spam': 3}
+
+
+def test_entrypoint_metrics(container):
+    with entrypoint_hook(container, 'ok') as ok:
+        ok()
+        ok()
+
+    with entrypoint_hook(container, 'broken') as broken:
+        with pytest.raises(Exception):
+            broken()
+
+    entrypoints = container.metrics_snapshot()['entrypoints']
+
+    assert entrypoints['ok']['successes'] == 2
+    assert entrypoints['ok']['errors'] == 0
+    assert entrypoints['ok']['run']['count'] == 2
+    assert entrypoints['ok']['queue_wait']['count'] == 2
+    assert entrypoints['ok']['teardown']['count'] == 2
+
+    assert entrypoints['broken']['successes'] == 0
+    assert entrypoints['broken']['errors'] == 1
+
+
+def test_in_flight_and_queue_wait(container):
+    provider = next(entrypoint for entrypoint in container.entrypoints
+                    if entrypoint.name == 'blocked')
+
+    # the second worker has to wait for the first as max_workers is 1
+    container.spawn_worker(provider, (), {})
+    eventlet.spawn(container.spawn_worker, provider, (), {})
+    eventlet.sleep(0.1)
+
+    metrics = container.metrics.entrypoint('blocked')
+    assert metrics.in_flight == 1
+
+    release.send()
+    with eventlet.Timeout(1):
+        while metrics.successes < 2 or metrics.in_flight:
+            eventlet.sleep()
+
+    assert metrics.in_flight == 0
+    assert metrics.queue_wait.sum >= 0.1
+
+
+def test_runner_snapshot():
+    runner = ServiceRunner({})
+    runner.add_service(Service)
+
+    snapshot = runner.metrics_snapshot()
+    assert snapshot == {
+        'service': {
+            'entrypoints': {},
+            'counters': {},
+            'histograms': {},
+            'max_workers': 10,
+            'blocking': {},
+        }
+    }
+
+
+def make_snapshot():
+    histogram = Histogram(buckets=(0.1,))
+    histogram.observe(0.05)
+    histogram.observe(0.2)
+
+    metrics = ContainerMetrics()
+    entrypoint = metrics.entrypoint('method')
+    entrypoint.run = histogram
+    entrypoint.successes = 2
+    entrypoint.in_flight = 1
+    metrics.increment('cache.hits', 3)
+    metrics.histogram('publish.confirm_latency').observe(0.01)
+
+    return {'service': metrics.snapshot()}
+
+
+def test_prometheus_exporter():
+    text = PrometheusExporter().export(make_snapshot())
+    lines = text.splitlines()
+
+    labels = 'service="service",entrypoint="method"'
+    assert 'nameko_in_flight{%s} 1' % labels in lines
+    assert 'nameko_successes_total{%s} 2' % labels in lines
+    assert 'nameko_errors_total{%s} 0' % labels in lines
+    assert 'nameko_run_seconds_bucket{%s,le="0.1"} 1' % labels in lines
+    assert 'nameko_run_seconds_bucket{%s,le="+Inf"} 2' % labels in lines
+    assert 'nameko_run_seconds_count{%s} 2' % labels in lines
+    assert 'nameko_cache_hits_total{service="service"} 3' in lines
+    assert ('nameko_publish_confirm_latency_seconds_count'
+            '{service="service"} 1') in lines
+
+
+def test_statsd_exporter():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    _, port = server.getsockname()
+
+    exporter = StatsdExporter(host='127.0.0.1', port=port, prefix='app')
+    snapshot = make_snapshot()
+    exporter.export(snapshot)
+
+    expected = StatsdExporter(prefix='app').format(snapshot)
+    received = set()
+    with eventlet.Timeout(1):
+        while len(received) < len(expected):
+            received.add(server.recv(1024))
+
+    assert 'app.service.cache.hits:3|c' in received
+    assert 'app.service.method.in_flight:1|g' in received
+    assert 'app.service.method.successes:2|c' in received
+    assert 'app.service.method.run:125.000|ms' in received
+    assert 'app.service.publish.confirm_latency:10.000|ms' in received
+
+    # counters are sent as deltas, histograms only when observed
+    lines = exporter.format(snapshot)
+    assert 'app.service.method.successes:0|c' in lines
+    assert not any(line.startswith('app.service.method.run:')
+                   for line in lines)
+    server.close()
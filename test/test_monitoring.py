@@ -0,0 +1,127 @@
+import time
+
+import eventlet
+import greenlet
+from mock import patch, Mock
+import pytest
+
+from nameko.containers import ServiceContainer, WorkerContext
+from nameko.monitoring import (
+    BlockingMonitor, SwitchTracer, tracer, MANAGED_THREAD)
+from nameko.testing.services import dummy, entrypoint_hook
+
+
+def block_hub(duration):
+    end = time.time() + duration
+    while time.time() < end:
+        pass
+
+
+class Service(object):
+
+    @dummy
+    def hog(self):
+        block_hub(0.1)
+
+    @dummy
+    def polite(self):
+        eventlet.sleep(0.1)
+
+
+@pytest.yield_fixture
+def logger():
+    with patch('nameko.monitoring._log', autospec=True) as patched:
+        yield patched
+
+
+@pytest.yield_fixture
+def container():
+    config = {'blocking_budget': 0.05, 'blocking_log_interval': 60}
+    container = ServiceContainer(Service, WorkerContext, config)
+    container.start()
+    yield container
+    container.stop()
+
+
+def test_detection_disabled_by_default():
+    container = ServiceContainer(Service, WorkerContext, {})
+    container.start()
+
+    with entrypoint_hook(container, 'hog') as hog:
+        hog()
+
+    assert container.blocking_stats == {}
+    container.stop()
+    assert greenlet.gettrace() is None
+
+
+def test_blocking_worker_attributed_to_entrypoint(container):
+    with entrypoint_hook(container, 'polite') as polite:
+        polite()
+    assert container.blocking_stats == {}
+
+    with entrypoint_hook(container, 'hog') as hog:
+        hog()
+
+    stats = container.blocking_stats
+    assert list(stats) == ['hog']
+    assert stats['hog']['count'] == 1
+    assert stats['hog']['max'] >= 0.1
+    assert stats['hog']['last_call_id'].startswith('service.hog.')
+
+
+def test_blocking_managed_thread(container):
+    gt = container.spawn_managed_thread(lambda: block_hub(0.1))
+    gt.wait()
+
+    stats = container.blocking_stats
+    assert stats[MANAGED_THREAD]['count'] == 1
+    assert stats[MANAGED_THREAD]['last_call_id'] is None
+
+
+def test_other_greenthreads_ignored(container):
+    eventlet.spawn(block_hub, 0.1).wait()
+    assert container.blocking_stats == {}
+
+
+def test_logs_rate_limited(container, logger):
+    with entrypoint_hook(container, 'hog') as hog:
+        hog()
+        hog()
+        hog()
+
+    container._blocking_monitor.report()
+    assert logger.warning.call_count == 1
+
+    # suppressed reports are counted in the next message
+    container._blocking_monitor._last_logged.clear()
+    with entrypoint_hook(container, 'hog') as hog:
+        hog()
+
+    container._blocking_monitor.report()
+    assert logger.warning.call_count == 2
+    (_, _, _, _, suppressed) = logger.warning.call_args[0][1:]
+    assert suppressed == 2
+
+
+def test_tracer_uninstalled_on_stop(container):
+    assert greenlet.gettrace() is tracer
+    container.stop()
+    assert greenlet.gettrace() is None
+
+
+def test_tracer_chains_previous_tracer():
+    previous = Mock()
+    greenlet.settrace(previous)
+
+    switch_tracer = SwitchTracer()
+    monitor = BlockingMonitor(Mock(), budget=1)
+    switch_tracer.register(monitor)
+    try:
+        eventlet.sleep()
+        assert previous.called
+    finally:
+        switch_tracer.unregister(monitor)
+
+    assert greenlet.gettrace() is previous
+    greenlet.settrace(None)
@@ -1,10 +1,12 @@
+from concurrent import futures
 from greenlet import GreenletExit
 import eventlet
+from eventlet.event import Event
 from mock import Mock, MagicMock
 import pytest
 from nameko.parallel import (
     ParallelExecutor, parallel_provider, ParallelProvider,
-    ParallelProxyFactory, ProxySettingUnsupportedException)
+    ParallelProxyFactory, ProxySettingUnsupportedException, as_completed)
 from nameko.containers import ServiceContainer, WorkerContext
 from nameko.runners import ServiceRunner
 from nameko.testing.utils import wait_for_call
@@ -106,6 +108,147 @@ def test_proxy_read_only(container):
             wrapped.set_me = 1
 
 
+def test_max_parallelism(container):
+    running = []
+    most_running = []
+
+    def call(n):
+        running.append(n)
+        most_running.append(len(running))
+        eventlet.sleep(0.001)
+        running.remove(n)
+        return n
+
+    with ParallelExecutor(container, max_parallelism=2) as executor:
+        fs = [executor.submit(call, n) for n in range(6)]
+
+    assert [f.result() for f in fs] == range(6)
+    assert max(most_running) == 2
+
+
+def test_unbounded_by_default(container):
+    release = Event()
+
+    with ParallelExecutor(container) as executor:
+        assert executor.max_parallelism is None
+
+        # submit doesn't wait for a free slot, however many calls are running
+        with eventlet.Timeout(1):
+            fs = [executor.submit(release.wait)
+                  for _ in range(2 * container.max_workers)]
+        release.send(True)
+
+    assert [f.result() for f in fs] == [True] * len(fs)
+
+
+def test_map(container):
+    consumed = []
+
+    def items():
+        for n in range(10):
+            consumed.append(n)
+            yield n
+
+    def square(n):
+        eventlet.sleep(0.001 * (n % 3))
+        return n * n
+
+    with ParallelExecutor(container, max_parallelism=2) as executor:
+        results = executor.map(square, items(), chunksize=2)
+        assert not consumed
+
+        # the iterable is consumed as the results are
+        assert next(results) == 0
+        assert len(consumed) <= 6
+        assert list(results) == [n * n for n in range(1, 10)]
+
+
+def test_map_lazy_by_default(container):
+    consumed = []
+
+    def items():
+        for n in range(100):
+            consumed.append(n)
+            yield n
+
+    with ParallelExecutor(container) as executor:
+        results = executor.map(lambda n: n, items())
+        assert next(results) == 0
+        assert len(consumed) <= container.max_workers + 1
+        assert list(results) == range(1, 100)
+
+
+def test_map_multiple_iterables(container):
+    with ParallelExecutor(container) as executor:
+        assert list(executor.map(pow, [2, 3, 4], [3, 2])) == [8, 9]
+
+        with pytest.raises(ValueError):
+            executor.map(pow, [], chunksize=0)
+
+
+def test_map_error(container):
+    def check(n):
+        if n == 3:
+            raise ValueError(n)
+        return n
+
+    with ParallelExecutor(container) as executor:
+        results = executor.map(check, range(5))
+        assert next(results) == 0
+        with pytest.raises(ValueError):
+            list(results)
+
+
+def test_map_timeout(container):
+    executor = ParallelExecutor(container)
+    results = executor.map(eventlet.sleep, [0, 0.1], timeout=0.01)
+    with pytest.raises(futures.TimeoutError):
+        list(results)
+
+
+def test_as_completed(container):
+    def sleep(delay):
+        eventlet.sleep(delay)
+        return delay
+
+    with ParallelExecutor(container) as executor:
+        fs = [executor.submit(sleep, delay) for delay in (0.02, 0, 0.01)]
+        assert [f.result() for f in as_completed(fs)] == [0, 0.01, 0.02]
+
+        slow = executor.submit(eventlet.sleep, 0.1)
+        with pytest.raises(futures.TimeoutError):
+            list(as_completed([slow], timeout=0.01))
+
+
+def test_concurrent_futures_wait(container):
+    def sleep(delay):
+        eventlet.sleep(delay)
+        return delay
+
+    with ParallelExecutor(container) as executor:
+        fs = [executor.submit(sleep, delay)
+              for delay in (0.01, 0, 0.1)]
+        done, not_done = futures.wait(
+            fs, return_when=futures.FIRST_COMPLETED)
+        assert done == set([fs[1]])
+
+        done, not_done = futures.wait(fs, timeout=0.05)
+        assert done == set(fs[:2])
+        assert not_done == set(fs[2:])
+
+        # finished futures are yielded first, in no particular order
+        results = [f.result() for f in futures.as_completed(fs)]
+        assert results[-1] == 0.1
+        assert sorted(results) == [0, 0.01, 0.1]
+
+
+def test_parallel_proxy_factory_executor(container):
+    factory = ParallelProxyFactory(container, max_parallelism=3)
+    with factory() as executor:
+        assert isinstance(executor, ParallelExecutor)
+        assert executor.max_parallelism == 3
+
+
 def everlasting_call():
     while True:
         eventlet.sleep(1)
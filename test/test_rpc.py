@@ -9,16 +9,19 @@ from kombu import Connection
 from mock import patch, Mock, call
 
 from nameko.containers import (
-    ServiceContainer, WorkerContextBase, NAMEKO_CONTEXT_KEYS)
+    ServiceContainer, WorkerContext, WorkerContextBase, NAMEKO_CONTEXT_KEYS)
 from nameko.dependencies import InjectionProvider, injection, DependencyFactory
 from nameko.events import event_handler
 from nameko.exceptions import RemoteError, MethodNotFound
 from nameko.messaging import AMQP_URI_CONFIG_KEY, QueueConsumer
+from nameko.metrics import ContainerMetrics
 from nameko.rpc import (
-    rpc, rpc_proxy, RpcConsumer, RpcProvider, ReplyListener)
+    rpc, rpc_proxy, RpcConsumer, RpcProvider, ReplyListener, MethodProxy,
+    RpcProxyProvider, ServiceProxy, call_key, invalidate_cache)
 from nameko.standalone.rpc import RpcProxy
 from nameko.testing.services import entrypoint_hook
 from nameko.testing.utils import get_dependency
+from nameko.utils import SingleFlight
 
 
 class ExampleError(Exception):
@@ -165,6 +168,48 @@ def test_rpc_consumer(get_rpc_exchange):
     assert consumer._providers == set()
 
 
+def test_rpc_provider_memoize():
+    container = Mock(spec=ServiceContainer)
+    container.service_name = "exampleservice"
+    container.worker_ctx_cls = WorkerContext
+    container.metrics = ContainerMetrics()
+
+    provider = RpcProvider(memoize={'max_size': 1})
+    provider.rpc_consumer = Mock()
+    provider.bind("rpcmethod", container)
+    provider.prepare()
+
+    def make_call(*args):
+        message = Mock(headers={})
+        provider.handle_message({'args': args, 'kwargs': {}}, message)
+        return message
+
+    def complete(args, result, exc=None):
+        _, kwargs = container.spawn_worker.call_args
+        worker_ctx = Mock(args=args, kwargs={})
+        kwargs['handle_result'](worker_ctx, result, exc)
+
+    make_call(1)
+    assert container.spawn_worker.call_count == 1
+    complete((1,), 'one')
+
+    # the second call is answered without spawning a worker
+    message = make_call(1)
+    assert container.spawn_worker.call_count == 1
+    provider.rpc_consumer.handle_result.assert_called_with(
+        message, container, 'one', None)
+
+    # errors are not memoized
+    make_call(2)
+    complete((2,), None, ExampleError())
+    make_call(2)
+    assert container.spawn_worker.call_count == 3
+    complete((2,), 'two')
+
+    assert container.metrics.counters == {
+        'memoize.hits': 1, 'memoize.misses': 3, 'memoize.evictions': 1}
+
+
 def test_reply_listener(get_rpc_exchange):
 
     container = Mock(spec=ServiceContainer)
@@ -495,3 +540,167 @@ def test_rpc_consumer_cannot_exit_with_providers(
 
     # kill off task_a's misbehaving rpc provider
     container.kill(Exception('test-end'))
+
+
+def test_call_key():
+    key = call_key('service', 'method', (1,), {'a': 1, 'b': 2})
+    assert key == call_key('service', 'method', [1], {'b': 2, 'a': 1})
+    assert key != call_key('service', 'method', (2,), {'a': 1, 'b': 2})
+    assert key != call_key('service', 'other', (1,), {'a': 1, 'b': 2})
+
+    assert call_key('service', 'method', (object(),), {}) is None
+
+
+def test_method_proxy_coalescing():
+    worker_ctx = Mock()
+    worker_ctx.container.metrics = ContainerMetrics()
+    single_flight = SingleFlight()
+    release = Event()
+    calls = []
+
+    def make_call(*args, **kwargs):
+        calls.append(args)
+        release.wait()
+        return args
+
+    def proxy():
+        method_proxy = MethodProxy(worker_ctx, 'service', 'method', Mock(),
+                                   single_flight=single_flight)
+        method_proxy._call = make_call
+        return method_proxy
+
+    threads = [eventlet.spawn(proxy(), 'spam') for _ in range(3)]
+    threads.append(eventlet.spawn(proxy(), 'ham'))
+    threads.append(eventlet.spawn(proxy(), object()))
+    eventlet.sleep()
+
+    release.send()
+    results = [gt.wait() for gt in threads]
+    assert results[:4] == [('spam',), ('spam',), ('spam',), ('ham',)]
+    assert len(calls) == 3
+
+    counters = worker_ctx.container.metrics.counters
+    assert counters == {'coalesce.hits': 2, 'coalesce.misses': 2}
+
+
+def test_method_proxy_caching():
+    worker_ctx = Mock()
+    worker_ctx.container.metrics = metrics = ContainerMetrics()
+
+    provider = RpcProxyProvider(
+        'service', cache={'get': {'ttl': 10, 'max_size': 2}})
+    provider.prepare()
+
+    proxy = ServiceProxy(worker_ctx, 'service', Mock(),
+                         caches=provider.caches)
+    calls = []
+
+    def make_call(self, *args, **kwargs):
+        calls.append((self.method_name, args))
+        if args == ('broken',):
+            raise ExampleError()
+        return {'args': list(args)}
+
+    with patch.object(MethodProxy, '_call', make_call):
+        assert proxy.get('spam') == {'args': ['spam']}
+        assert proxy.get('spam') == {'args': ['spam']}
+        assert calls == [('get', ('spam',))]
+
+        # results are copied rather than shared between callers
+        proxy.get('spam')['args'] = 'changed'
+        assert proxy.get('spam') == {'args': ['spam']}
+
+        # only configured methods are cached
+        proxy.other('spam')
+        proxy.other('spam')
+        assert len(calls) == 3
+
+        # errors are not cached
+        for _ in range(2):
+            with pytest.raises(ExampleError):
+                proxy.get('broken')
+        assert len(calls) == 5
+
+        proxy.get('ham')
+        proxy.get('eggs')
+        assert metrics.counters == {
+            'cache.hits': 3, 'cache.misses': 5, 'cache.evictions': 1}
+
+        invalidate_cache('service', 'get', args=('eggs',))
+        proxy.get('eggs')
+        assert calls[-1] == ('get', ('eggs',))
+
+        invalidate_cache('service', 'get')
+        proxy.get('ham')
+        assert calls[-1] == ('get', ('ham',))
+
+        # unknown caches are ignored
+        invalidate_cache('service', 'other')
+
+
+def test_method_proxy_caching_sizes_results():
+    worker_ctx = Mock()
+    worker_ctx.container.metrics = ContainerMetrics()
+
+    provider = RpcProxyProvider('service', cache={'count': {'max_bytes': 10}})
+    provider.prepare()
+    proxy = ServiceProxy(worker_ctx, 'service', Mock(),
+                         caches=provider.caches)
+
+    # results are measured as JSON, so any result can be cached
+    with patch.object(MethodProxy, '_call', return_value=12345):
+        assert proxy.count() == 12345
+        assert proxy.count() == 12345
+    assert provider.caches['count'].bytes == 5
+    assert worker_ctx.container.metrics.counters == {
+        'cache.hits': 1, 'cache.misses': 1}
+
+
+def test_method_proxy_caching_stampede():
+    worker_ctx = Mock()
+    worker_ctx.container.metrics = ContainerMetrics()
+
+    provider = RpcProxyProvider('service', cache={'get': {}})
+    provider.prepare()
+
+    release = Event()
+    calls = []
+
+    def make_call(self, *args, **kwargs):
+        calls.append(args)
+        release.wait()
+        return args
+
+    def get():
+        proxy = ServiceProxy(worker_ctx, 'service', Mock(),
+                             caches=provider.caches)
+        return proxy.get('spam')
+
+    with patch.object(MethodProxy, '_call', make_call):
+        threads = [eventlet.spawn(get) for _ in range(3)]
+        eventlet.sleep()
+        release.send()
+        assert [gt.wait() for gt in threads] == [('spam',)] * 3
+
+    assert len(calls) == 1
+
+
+def test_method_proxy_call_async():
+    worker_ctx = Mock()
+    worker_ctx.container.spawn_managed_thread = eventlet.spawn
+    proxy = ServiceProxy(worker_ctx, 'service', Mock())
+
+    def make_call(self, *args, **kwargs):
+        eventlet.sleep()
+        if args == ('broken',):
+            raise ExampleError()
+        return self.method_name, args, kwargs
+
+    with patch.object(MethodProxy, '_call', make_call):
+        first = proxy.get.call_async('spam', n=1)
+        second = proxy.get.call_async('broken')
+        assert not first.done()
+
+        assert first.result() == ('get', ('spam',), {'n': 1})
+        with pytest.raises(ExampleError):
+            second.result()
@@ -49,6 +49,7 @@ def test_runner_lifecycle():
 
         def start(self):
             events.add(('start', self.service_cls.name, self.service_cls))
+            return 'report-{}'.format(self.service_cls.name)
 
         def stop(self):
             events.add(('stop', self.service_cls.name, self.service_cls))
@@ -65,7 +66,10 @@ def test_runner_lifecycle():
     runner.add_service(TestService1)
     runner.add_service(TestService2)
 
-    runner.start()
+    assert runner.start() == {
+        'foobar_1': 'report-foobar_1',
+        'foobar_2': 'report-foobar_2',
+    }
 
     assert events == {
         ('start', 'foobar_1', TestService1),
@@ -0,0 +1,135 @@
+import threading
+import time
+
+import eventlet
+from eventlet.event import Event
+from mock import Mock
+import pytest
+
+from nameko.containers import ServiceContainer, WorkerContext
+from nameko.testing.services import dummy, entrypoint_hook
+from nameko.threadpool import (
+    ThreadPoolProvider, ThreadPoolStopped, thread_pool,
+    DEFAULT_THREADPOOL_SIZE)
+
+
+@pytest.fixture
+def provider():
+    container = Mock(spec=ServiceContainer)
+    container.config = {'pool_size': 2}
+
+    provider = ThreadPoolProvider(config_key='pool_size')
+    provider.bind('blocking', container)
+    provider.prepare()
+    return provider
+
+
+def test_size_defaults():
+    provider = ThreadPoolProvider()
+    provider.bind('blocking', Mock(config={}))
+    provider.prepare()
+    assert provider.size == DEFAULT_THREADPOOL_SIZE
+
+    provider = ThreadPoolProvider(size=5, config_key='pool_size')
+    provider.bind('blocking', Mock(config={}))
+    provider.prepare()
+    assert provider.size == 5
+
+
+def test_execute_runs_in_native_thread(provider):
+    main_thread = threading.current_thread()
+
+    def get_thread(arg, kwarg=None):
+        return threading.current_thread(), arg, kwarg
+
+    execute = provider.acquire_injection(Mock())
+    thread, arg, kwarg = execute(get_thread, 1, kwarg=2)
+
+    assert thread is not main_thread
+    assert (arg, kwarg) == (1, 2)
+    assert provider.stats == {
+        'size': 2, 'active': 0, 'queued': 0, 'completed': 1}
+
+
+def test_execute_reraises(provider):
+    def broken():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        provider.execute(broken)
+    assert provider.stats['completed'] == 1
+
+
+def test_execute_does_not_block_hub(provider):
+    ticks = [0]
+    stopped = []
+
+    def ticker():
+        while not stopped:
+            ticks[0] += 1
+            eventlet.sleep(0)
+
+    gt = eventlet.spawn(ticker)
+    provider.execute(time.sleep, 0.1)
+    # count the ticks before yielding to the ticker again
+    ticks_during_call = ticks[0]
+    stopped.append(True)
+    gt.wait()
+
+    # the ticker kept running while the call blocked its native thread
+    assert ticks_during_call > 10
+
+
+def test_concurrency_bounded_by_size(provider):
+    calls = [eventlet.spawn(provider.execute, time.sleep, 0.1)
+             for _ in range(3)]
+    eventlet.sleep(0.05)
+
+    assert provider.stats['active'] == 2
+    assert provider.stats['queued'] == 1
+
+    for gt in calls:
+        gt.wait()
+    assert provider.stats == {
+        'size': 2, 'active': 0, 'queued': 0, 'completed': 3}
+
+
+def test_stop_waits_for_pending_calls(provider):
+    gt = eventlet.spawn(provider.execute, time.sleep, 0.1)
+    eventlet.sleep()
+
+    stopped = Event()
+    eventlet.spawn(lambda: stopped.send(provider.stop()))
+    eventlet.sleep(0.05)
+    assert not stopped.ready()
+
+    gt.wait()
+    with eventlet.Timeout(1):
+        stopped.wait()
+
+    with pytest.raises(ThreadPoolStopped):
+        provider.execute(time.sleep, 0)
+
+
+def test_stop_when_idle(provider):
+    with eventlet.Timeout(1):
+        provider.stop()
+
+
+class Service(object):
+
+    blocking = thread_pool(size=1)
+
+    @dummy
+    def checksum(self, data):
+        return self.blocking(sum, data)
+
+
+def test_thread_pool_injection():
+    container = ServiceContainer(Service, WorkerContext, {})
+    container.start()
+
+    with entrypoint_hook(container, 'checksum') as checksum:
+        assert checksum([1, 2, 3]) == 6
+
+    container.stop()
@@ -1,10 +1,15 @@
 import eventlet
 from eventlet import Timeout
 
-from mock import Mock
+from kombu import Connection
+from mock import Mock, patch
+import pytest
 
-from nameko.timer import TimerProvider
-from nameko.containers import ServiceContainer
+from nameko.timer import (
+    timer as timer_entrypoint, TimerProvider, TimerScheduler, LeaderElection,
+    get_scheduler, FIXED_DELAY)
+from nameko.containers import ServiceContainer, WorkerContext
+from nameko.metrics import ContainerMetrics
 from nameko.testing.utils import wait_for_call
 
 
@@ -28,9 +33,10 @@ def test_provider():
 
     # the timer should have stopped and should only have spawned
     # a single worker
-    spawn_worker.assert_called_once_with(timer, (), {})
+    assert spawn_worker.call_count == 1
+    assert spawn_worker.call_args[0] == (timer, (), {})
 
-    assert timer.gt.dead
+    assert timer not in get_scheduler()
 
 
 def test_provider_uses_config_for_interval():
@@ -62,16 +68,19 @@ def test_stop_timer_immediatly():
     container = Mock(spec=ServiceContainer)
     container.service_name = "service"
     container.config = {}
+    container.spawn_managed_thread = eventlet.spawn
 
     timer = TimerProvider(interval=5, config_key=None)
     timer.bind('foobar', container)
     timer.prepare()
     timer.start()
     eventlet.sleep(0.1)
-    timer.stop()
+    with Timeout(1):
+        timer.stop()
 
-    assert container.spawn_worker.call_count == 0
-    assert timer.gt.dead
+    # fired once on start, and stopped without waiting for the interval
+    assert container.spawn_worker.call_count == 1
+    assert timer not in get_scheduler()
 
 
 def test_kill_stops_timer():
@@ -91,3 +100,338 @@ def test_kill_stops_timer():
     # to trigger
     eventlet.sleep(0.1)
     assert container.spawn_worker.call_count == 1
+
+
+def make_timer(interval, **kwargs):
+    container = Mock(spec=ServiceContainer)
+    container.service_name = "service"
+    container.config = {}
+    container.metrics = ContainerMetrics()
+    container.spawn_managed_thread = eventlet.spawn
+
+    timer = TimerProvider(interval=interval, config_key=None, **kwargs)
+    timer.bind('foobar', container)
+    timer.prepare()
+    return timer
+
+
+def test_scheduler_order():
+    fired = []
+    scheduler = TimerScheduler()
+    now = eventlet.hubs.get_hub().clock()
+
+    for name, delay in (('c', 0.03), ('a', 0.01), ('b', 0.02)):
+        timer = Mock(name=name)
+        timer.fire.side_effect = lambda name=name: fired.append(name)
+        scheduler.schedule(timer, now + delay)
+
+    eventlet.sleep(0.05)
+    assert fired == ['a', 'b', 'c']
+
+    # the scheduler's greenthread exits once nothing is scheduled
+    assert scheduler._gt is None
+
+
+def test_scheduler_reschedule_and_cancel():
+    scheduler = TimerScheduler()
+    early, late = Mock(), Mock()
+
+    with patch('nameko.timer.time') as time:
+        time.time.return_value = 0
+        scheduler.schedule(late, 0.01)
+        scheduler.schedule(early, 100)
+
+        # rescheduling replaces the previous schedule
+        scheduler.schedule(early, 0.01)
+        scheduler.cancel(late)
+        time.time.return_value = 1
+        eventlet.sleep()
+
+    assert early.fire.call_count == 1
+    assert not late.fire.called
+    assert early not in scheduler
+
+
+def test_timers_share_scheduler():
+    timers = [make_timer(60) for _ in range(3)]
+    for timer in timers:
+        timer.start()
+    eventlet.sleep(0.01)
+
+    scheduler = get_scheduler()
+    assert all(timer in scheduler for timer in timers)
+    assert all(timer.container.spawn_worker.call_count == 1
+               for timer in timers)
+
+    for timer in timers:
+        timer.stop()
+    eventlet.sleep()
+    assert scheduler._gt is None
+
+
+def test_fixed_rate_skips_missed_fires():
+    timer = make_timer(10)
+
+    with patch('nameko.timer.time') as time:
+        time.time.return_value = 100
+        timer.schedule(100)
+
+        # a late fire is followed by the next fire on the original schedule
+        time.time.return_value = 135
+        timer.fire()
+
+    assert timer._next_fire == 140
+    assert timer.container.metrics.counters == {'timer.missed': 3}
+    timer.stop()
+
+
+def test_fixed_delay():
+    timer = make_timer(10, mode=FIXED_DELAY)
+
+    with patch('nameko.timer.time') as time:
+        time.time.return_value = 100
+        timer.start()
+        eventlet.sleep(0.01)
+        assert timer.container.spawn_worker.call_count == 1
+        assert timer not in get_scheduler()
+
+        # the next fire is scheduled once the worker completes
+        time.time.return_value = 107
+        handle_result = timer.container.spawn_worker.call_args[1][
+            'handle_result']
+        handle_result(Mock(), 'result')
+        eventlet.sleep()
+        assert timer._next_fire == 117
+    timer.stop()
+
+
+def test_fixed_delay_killed_worker():
+    timer = make_timer(10, mode=FIXED_DELAY)
+
+    with patch('nameko.timer.time') as time:
+        time.time.return_value = 100
+        gt = eventlet.spawn(timer.handle_timer_tick)
+        eventlet.sleep()
+        assert timer.running == 1
+
+        # the container kills the tick's thread along with its worker
+        time.time.return_value = 107
+        gt.kill()
+
+    assert timer.running == 0
+    assert timer._next_fire == 117
+    assert timer in get_scheduler()
+    timer.stop()
+
+
+def test_blocked_container_does_not_stall_scheduler():
+    blocked = make_timer(0.01)
+    blocked.container.spawn_worker.side_effect = lambda *args, **kwargs: (
+        eventlet.sleep(60))
+    other = make_timer(0.01)
+
+    blocked.start()
+    other.start()
+    eventlet.sleep(0.05)
+
+    # e.g. the first container's worker pool is full; its fires while one
+    # waits are missed, but the other timer keeps firing
+    assert blocked.container.spawn_worker.call_count == 1
+    assert blocked.container.metrics.counters['timer.missed'] > 0
+    assert other.container.spawn_worker.call_count > 1
+    blocked.kill(None)
+    other.kill(None)
+
+
+def test_slow_workers_bound_pending_ticks():
+
+    class Service(object):
+
+        @timer_entrypoint(interval=0.01)
+        def tick(self):
+            eventlet.sleep(0.1)
+
+    container = ServiceContainer(Service, WorkerContext, {'max_workers': 2})
+    container.start()
+    eventlet.sleep(0.2)
+
+    # a worker and the thread waiting for it per slot, and one tick waiting
+    # for a slot; fires meanwhile are counted as missed
+    assert len(container._active_threads) <= 2 * container.max_workers + 1
+    assert container.metrics.counters['timer.missed'] > 0
+
+    with Timeout(1):
+        container.stop()
+
+
+def tick(timer):
+    eventlet.spawn(timer.handle_timer_tick)
+    eventlet.sleep(0.01)
+
+
+def test_overlap():
+    timer = make_timer(10, overlap=False)
+    tick(timer)
+    tick(timer)
+
+    # the second fire is skipped while the first worker runs
+    spawn_worker = timer.container.spawn_worker
+    assert spawn_worker.call_count == 1
+    assert timer.container.metrics.counters == {'timer.skipped': 1}
+
+    spawn_worker.call_args[1]['handle_result'](Mock(), 'result')
+    eventlet.sleep()
+    tick(timer)
+    assert spawn_worker.call_count == 2
+
+
+def test_jitter():
+    timer = make_timer(10, jitter=5)
+
+    with patch.object(get_scheduler(), 'schedule') as schedule:
+        for _ in range(10):
+            timer.schedule(100)
+
+    for (_, due), _ in schedule.call_args_list:
+        assert 100 <= due <= 105
+    assert timer._next_fire == 100
+
+
+@pytest.yield_fixture
+def singleton_factory(mock_container):
+    created = []
+
+    def make_singleton(service_name="singleton", renew_interval=0.01):
+        container = mock_container(
+            service_name, {'AMQP_URI': 'memory://',
+                           'TIMER_LEASE_RENEW_INTERVAL': renew_interval})
+
+        election = LeaderElection()
+        election.bind('leader_election', container)
+        timer = TimerProvider(60, None, singleton=True)
+        timer.leader_election = election
+        timer.bind('foobar', container)
+        timer.prepare()
+        created.append(timer)
+        return timer
+
+    yield make_singleton
+
+    for timer in created:
+        timer.kill(None)
+        timer.leader_election.kill()
+
+
+def test_singleton(singleton_factory):
+    leader = singleton_factory()
+    follower = singleton_factory()
+    leader.start()
+    follower.start()
+    eventlet.sleep(0.05)
+
+    # only the leader spawns workers
+    assert leader.leader_election.is_leader
+    assert not follower.leader_election.is_leader
+    assert leader.container.spawn_worker.call_count == 1
+    assert not follower.container.spawn_worker.called
+
+    leader.fire()
+    follower.fire()
+    eventlet.sleep(0.05)
+    assert leader.container.spawn_worker.call_count == 2
+    assert not follower.container.spawn_worker.called
+
+    # the follower takes over when it next renews after the leader stops
+    with Timeout(1):
+        leader.stop()
+        leader.leader_election.stop()
+    eventlet.sleep(0.05)
+    follower.fire()
+    eventlet.sleep(0.05)
+    assert follower.leader_election.is_leader
+    assert follower.container.spawn_worker.call_count == 1
+
+
+def test_singleton_per_service(singleton_factory):
+    spam = singleton_factory("spam")
+    ham = singleton_factory("ham")
+    spam.start()
+    ham.start()
+    eventlet.sleep(0.05)
+    assert spam.leader_election.is_leader
+    assert ham.leader_election.is_leader
+
+
+def test_lost_lease(singleton_factory):
+    leader = singleton_factory()
+    follower = singleton_factory()
+    election = leader.leader_election
+    assert election.claim()
+    connection = election._connection
+
+    # e.g. the broker deleted the lease queue when the leader's connection
+    # dropped; the leader notices when it next renews, and claims it again
+    with Connection('memory://') as conn:
+        conn.default_channel.queue_delete('timer-leader-singleton')
+    assert election.claim()
+    assert not follower.leader_election.claim()
+
+    assert election.is_leader
+    assert election._connection is not connection
+    assert not follower.leader_election.is_leader
+
+
+def test_singleton_fires_use_cached_lease(singleton_factory):
+    leader = singleton_factory(renew_interval=60)
+    leader.start()
+    eventlet.sleep(0.05)
+    election = leader.leader_election
+    assert election.is_leader
+
+    # fires don't go to the broker between renewals
+    with patch('nameko.timer.Connection') as connection:
+        with patch.object(election, '_channel') as channel:
+            leader.fire()
+            eventlet.sleep(0.01)
+            leader.fire()
+            eventlet.sleep(0.05)
+
+    assert not connection.called
+    assert not channel.queue_declare.called
+    assert leader.container.spawn_worker.call_count == 3
+
+
+def test_singleton_failover():
+    calls = []
+
+    class Service(object):
+
+        @timer_entrypoint(interval=0.01, singleton=True)
+        def tick(self):
+            calls.append(self)
+
+    config = {'AMQP_URI': 'memory://', 'TIMER_LEASE_RENEW_INTERVAL': 0.01}
+    first = ServiceContainer(Service, WorkerContext, config)
+    second = ServiceContainer(Service, WorkerContext, config)
+    first.start()
+    second.start()
+
+    def is_leader(container):
+        election, = [dep for dep in container.dependencies
+                     if isinstance(dep, LeaderElection)]
+        return election.is_leader
+
+    eventlet.sleep(0.05)
+    assert calls
+    assert is_leader(first)
+    assert not is_leader(second)
+    del calls[:]
+
+    with Timeout(1):
+        first.stop()
+    eventlet.sleep(0.05)
+    assert calls
+    assert is_leader(second)
+
+    with Timeout(1):
+        second.stop()
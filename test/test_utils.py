@@ -1,7 +1,9 @@
+import eventlet
 from eventlet import GreenPool, sleep
 from eventlet.event import Event
+from mock import Mock
 import pytest
-from nameko.utils import fail_fast_imap
+from nameko.utils import fail_fast_imap, SingleFlight, OrderedSpawningSet
 
 
 def test_fail_fast_imap():
@@ -31,3 +33,82 @@ def test_fail_fast_imap():
     # The slow call won't go past the sleep as it was killed
     assert not slow_call_returned.ready()
     assert pool.free() == 2
+
+
+class ExampleError(Exception):
+    pass
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    release = Event()
+    calls = []
+
+    def fetch(value):
+        calls.append(value)
+        release.wait()
+        return {'value': value}
+
+    leader = eventlet.spawn(single_flight.do, 'key', fetch, 1)
+    sleep()
+    assert 'key' in single_flight
+
+    follower = eventlet.spawn(single_flight.do, 'key', fetch, 1)
+    other = eventlet.spawn(single_flight.do, 'other', fetch, 2)
+    sleep()
+
+    release.send()
+    assert leader.wait() == follower.wait() == {'value': 1}
+    assert other.wait() == {'value': 2}
+    assert calls == [1, 2]
+
+    # followers get their own copy of the result
+    assert leader.wait() is not follower.wait()
+
+    # completed calls are forgotten
+    assert 'key' not in single_flight
+    assert single_flight.do('key', fetch, 3) == {'value': 3}
+
+
+def test_single_flight_error():
+    single_flight = SingleFlight()
+    release = Event()
+
+    def broken():
+        release.wait()
+        raise ExampleError('broken')
+
+    leader = eventlet.spawn(single_flight.do, 'key', broken)
+    first = eventlet.spawn(single_flight.do, 'key', broken)
+    second = eventlet.spawn(single_flight.do, 'key', broken)
+    sleep()
+
+    release.send()
+    errors = []
+    for caller in (leader, first, second):
+        with pytest.raises(ExampleError) as exc_info:
+            caller.wait()
+        errors.append(exc_info.value)
+    assert 'key' not in single_flight
+
+    # each follower raises its own copy of the exception
+    assert len(set(map(id, errors))) == 3
+    assert [error.args for error in errors] == [('broken',)] * 3
+
+
+def test_ordered_spawning_set():
+    items = [Mock(name=str(i)) for i in range(5)]
+    ordered = OrderedSpawningSet(reversed(items))
+    ordered.add(items[4])
+    assert list(ordered) == items[::-1]
+    assert ordered[0] is items[4]
+
+    ordered.discard(items[2])
+    assert items[2] not in ordered
+    assert len(ordered) == 4
+    assert ordered == set(items) - {items[2]}
+
+    ordered.all.method('arg')
+    for item in ordered:
+        item.method.assert_called_once_with('arg')
+    assert not items[2].method.called